@@ -7,7 +7,3 @@ __author__ = "Francisco Silveira, Georgy Angelov, Eric Pruitt, Isis Lovecruft"
 __date__ = "25 July 2017"
 __version__ = (0, 1, 0)
 __license__ = "Unlicense"
-
-import hashlib
-
-from .pyzsync import *
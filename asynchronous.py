@@ -1,6 +1,63 @@
+import asyncio
+import bisect
+import hashlib
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import chunking
 import common
+import core
+import fanout
+import metrics
+import ranges
+import signature
+import sources
+import transfer
 
 _DEFAULT_BLOCKSIZE = 4096
+_DEFAULT_CHUNKSIZE = 4 * 1024 * 1024
+# Number of block records written or read at once in signature files
+_SIGNATURE_BATCH = 65536
+
+
+"""
+Runs the CPU-bound work of the coroutines, such as hashing blocks and scanning
+chunks, in "executor" (the event loop's default executor if None) so that it
+never blocks the event loop
+At most "limit" jobs (os.cpu_count() by default) run at once, and the jobs waiting
+for their turn are served in order, so simultaneous syncs that share an Offloader
+take turns chunk by chunk instead of one of them taking every core
+The jobs modify the caller's hashes, so the executor must run threads and not
+processes. Hashing runs in parallel, since hashlib and zlib release the GIL while
+they work on large buffers, but the default engine of get_instructions rolls
+through every window in Python and holds the GIL, so simultaneous scans take turns
+on a single core. Pass engine="numpy" to scan in parallel: it checksums whole
+chunks in numpy, which releases the GIL, and only looks the candidates up in Python
+"""
+class Offloader:
+	def __init__(self, executor=None, limit=None):
+		if isinstance(executor, ProcessPoolExecutor):
+			raise ValueError("The offloaded jobs share the hashes with the caller, so they need a thread pool")
+		self.executor = executor
+		self.limit = limit or os.cpu_count() or 1
+		# Semaphores can only be used by the loop they were first used in
+		self._semaphores = weakref.WeakKeyDictionary()
+
+	"""
+	Receives a function and its arguments
+	Returns its result once it's run in the executor
+	"""
+	async def run(self, function, *args):
+		loop = asyncio.get_running_loop()
+		semaphore = self._semaphores.get(loop)
+		if semaphore is None:
+			semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+		async with semaphore:
+			return await loop.run_in_executor(self.executor, function, *args)
+
+# Used by every coroutine that isn't given an Offloader, which makes the limit process-wide
+_OFFLOADER = Offloader()
 
 
 """
@@ -16,18 +73,167 @@ Returns
 Consider that a weak hash can have several matching strong hashes, and every
 (weak hash, strong hash) block pair can occur on several parts of the file,
 but we only need one offset for retrieving that block
+If "compact" is set to True, the hashes are returned as a signature.SignatureTable
+instead, which stores them in packed arrays and can be used in place of the dictionaries
+The strong hashes are calculated with "algorithm" (see common.strong_hash), and
+"seq_matches" sets how many consecutive blocks get_instructions requires to match
+their weak hashes. The table records both, but the dictionaries don't, so in that
+case they have to be given to get_instructions (and the algorithm to patch_remote_blocks) too
+With a cache.SignatureCache as "cache", the signature of a regular file is only
+calculated if the file changed since it was cached. If the (start, end) byte ranges
+"modified" in place since then are given, only the blocks in them are hashed again
+With blocksize="auto" it's chosen from the size of the stream (see choose_blocksize,
+which is given the "previous" table), and the table records it along with the
+checksum lengths write_signature keeps (see tuning.tune_table). Only the table can
+record them, so it requires compact=True
+The stream is read in large chunks, which are hashed by the "offloader" (see Offloader),
+and the cache reads and writes its signature files in it as well
+The time and bytes are added to the "block_checksums" stage of "stats" (see metrics.Stats)
+"""
+async def block_checksums(instream, blocksize=_DEFAULT_BLOCKSIZE, compact=False, algorithm=None, seq_matches=1, cache=None, modified=None, offloader=None, stats=None, previous=None):
+	offloader = offloader or _OFFLOADER
+	stats = stats or metrics.NO_STATS
+	build = core.SignatureBuild(blocksize, compact, algorithm, seq_matches)
+	if build.auto:
+		build.blocksize = await choose_blocksize(instream, previous, build.seq_matches, offloader=offloader)
+	if cache is not None:
+		found = await offloader.run(cache.lookup, instream, build.blocksize, common.hash_algorithm(algorithm, None), build.seq_matches, modified)
+		cached = build.cached(*found)
+		if cached is not None:
+			return cached
+	hasher = build.hasher()
+	# Read whole blocks at a time
+	chunksize = max(1, _DEFAULT_CHUNKSIZE // build.blocksize) * build.blocksize
+	with stats.timing("block_checksums"):
+		chunk = await instream.read(chunksize)
+		while chunk:
+			await offloader.run(hasher.feed, chunk)
+			stats.processed("block_checksums", len(chunk))
+			chunk = await instream.read(chunksize)
+
+		count, hashes = await offloader.run(hasher.finish)
+	if build.key is not None:
+		await offloader.run(cache.put, build.key, hashes)
+	return build.result(count, hashes)
+
+
+"""
+Receives a readable stream whose size can be told (see tuning.auto_blocksize)
+Returns the blocksize for its signature. Given the signature.SignatureTable of the
+previous version of the file, "samples" windows of the stream are compared with it
+by the "offloader" (see Offloader) and the blocksize is refined for the edits found
+(see tuning.refine_blocksize). The stream is left where it was
+Raises a ValueError if the size of the stream can't be told
+"""
+async def choose_blocksize(instream, previous=None, seq_matches=1, samples=64, offloader=None):
+	offloader = offloader or _OFFLOADER
+	chooser = core.BlocksizeChooser(await _stream_size(instream), previous, seq_matches, samples)
+	if not chooser.offsets:
+		return chooser.blocksize
+	position = await instream.tell()
+	windows = []
+	for offset in chooser.offsets:
+		await instream.seek(offset)
+		windows.append(await _read_exactly(instream, chooser.window))
+	await instream.seek(position)
+	return await offloader.run(chooser.choose, windows)
+
+
+"""
+Receives a writable outstream and a signature.SignatureTable
+Writes the table as a binary signature file, keeping only the most significant
+"weak_bytes" of every weak hash and the first "strong_bytes" of every strong hash
+(by default the table's record_bytes, chosen with blocksize="auto", or else all of it)
 """
-async def block_checksums(instream, blocksize=_DEFAULT_BLOCKSIZE):
-	hashes = {}
-	block = await instream.read(blocksize)
-	offset = 0
+async def write_signature(outstream, table, weak_bytes=None, strong_bytes=None):
+	await outstream.write(signature.encode_header(table, weak_bytes, strong_bytes))
+	count = len(table.entries)
+	for start in range(0, count, _SIGNATURE_BATCH):
+		stop = min(start + _SIGNATURE_BATCH, count)
+		await outstream.write(signature.encode_records(table, start, stop, weak_bytes, strong_bytes))
 
-	while block:
-		common.populate_block_checksums(block, hashes, offset)
-		offset += blocksize
-		block = await instream.read(blocksize)
 
-	return offset/blocksize, hashes
+"""
+Receives a readable instream positioned at the start of a binary signature file
+Returns the signature.SignatureTable it describes
+"""
+async def read_signature(instream):
+	header = signature.decode_header(await _read_exactly(instream, signature.HEADER_SIZE))
+	algorithm = (await _read_exactly(instream, header["algorithm_size"])).decode("ascii")
+	filehash = await _read_exactly(instream, header["digest_size"])
+	reader = signature.TableReader(header, filehash, algorithm)
+	while reader.remaining():
+		data = await instream.read(min(reader.remaining(), _SIGNATURE_BATCH * reader.record_size))
+		if not data:
+			break
+		reader.feed(data)
+	return reader.build()
+
+
+"""
+Receives a readable instream and a size
+Returns exactly that many bytes, or less if the stream ended first
+"""
+async def _read_exactly(instream, size):
+	data = b""
+	while len(data) < size:
+		chunk = await instream.read(size - len(data))
+		if not chunk:
+			break
+		data += chunk
+	return data
+
+
+"""
+Receives a readable stream
+Returns its length and whole file digest, like the ones recorded by a signature.SignatureTable
+The chunks are hashed by the "offloader" (see Offloader)
+"""
+async def file_digest(instream, offloader=None):
+	offloader = offloader or _OFFLOADER
+	filehash = hashlib.md5()
+	length = 0
+	chunk = await instream.read(_DEFAULT_CHUNKSIZE)
+	while chunk:
+		await offloader.run(filehash.update, chunk)
+		length += len(chunk)
+		chunk = await instream.read(_DEFAULT_CHUNKSIZE)
+	return length, filehash.digest()
+
+
+"""
+Receives a readable stream, the signature.SignatureTable of a file and optionally
+the already known whole file "digest" of the stream (see file_digest)
+Returns whether the stream is identical to that file. The lengths are compared
+first, so a file of a different size is never read. Use it to confirm the result
+of a patch, or to skip the whole patch when nothing changed
+"""
+async def verify_file(instream, remote_hashes, digest=None, offloader=None):
+	length, filehash = core.recorded_digest(remote_hashes)
+	size = await _stream_size(instream)
+	if size is not None and size != length:
+		return False
+	if digest is None:
+		size, digest = await file_digest(instream, offloader)
+	return size in (None, length) and digest == filehash
+
+
+"""
+Receives a stream
+Returns its size without reading it, or None if that isn't possible
+"""
+async def _stream_size(stream):
+	try:
+		return os.fstat(stream.fileno()).st_size
+	except (AttributeError, OSError, ValueError):
+		pass
+	try:
+		position = await stream.tell()
+		size = await stream.seek(0, os.SEEK_END)
+		await stream.seek(position)
+		return size
+	except (AttributeError, OSError, ValueError):
+		return None
 
 
 """
@@ -40,104 +246,550 @@ Returns:
 	2 - A dictionary where each key is a missing block's first offset and the values are
 	    tuples with its (weak, strong, offsets)
 	    464 : (598213681, b'\x80\xfd\xa7T[\x1f\xc3\xf7\n\xf9V\xe7\xcb\xdf3\xbf', [464, 480]) 
+The stream is read in chunks of "chunksize" bytes and scanned with "engine"
+(see common.get_engine). Strong hashes are calculated with "algorithm", which defaults
+to the one recorded by a signature.SignatureTable or otherwise "md5"
+With "seq_matches" set to 2 (or recorded by the table), a block is only matched if
+the window after it also matches the weak hash of the next block, so the strong hash
+is rarely calculated in vain, even with small blocks
+If "precheck" is set to True or the whole file "digest" of the unpatched file is
+given (see file_digest), and the remote hashes record the length and digest of the
+patched file (a signature.SignatureTable), identical files are recognized before
+scanning and every block is kept in place. Without the digest the stream has to be
+seekable, since it's read once to calculate it
+Every chunk is scanned by the "offloader" (see Offloader) while the event loop goes on
 The blocks needed to request can be obtained with list(remote_instructions.keys())
 """
+async def get_instructions(datastream, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE, chunksize=_DEFAULT_CHUNKSIZE, engine=None, algorithm=None, seq_matches=None, precheck=False, digest=None, offloader=None, stats=None):
+	offloader = offloader or _OFFLOADER
+	stats = stats or metrics.NO_STATS
+	algorithm = common.hash_algorithm(algorithm, remote_hashes)
+	with stats.timing("get_instructions"):
+		if (precheck or digest is not None) and await _identical(datastream, remote_hashes, digest, offloader):
+			local_instructions, remote_instructions = remote_hashes.claim_all(), common.Instructions((), algorithm)
+			# The digest stands for the whole file, and every block matched, so every
+			# block counts as a weak hit too and none of them was a false positive
+			stats.processed("get_instructions", remote_hashes.length)
+			stats.hit(len(local_instructions))
+		else:
+			scanner = await offloader.run(core.DeltaScanner, remote_hashes, blocksize, engine, algorithm, seq_matches, 0, stats)
+			chunk = await datastream.read(chunksize)
+			while chunk:
+				await offloader.run(scanner.feed, chunk)
+				stats.processed("get_instructions", len(chunk))
+				chunk = await datastream.read(chunksize)
+			local_instructions, remote_instructions = await offloader.run(scanner.finish)
+	stats.matched(len(local_instructions))
+	return local_instructions, remote_instructions
 
 
-async def get_instructions(datastream, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE):
-	match = True
-	local_offset = -blocksize
-	local_instructions = []
-
-	while True:
-		if match and datastream is not None:
-			# Whenever there is a match or the loop is running for the first
-			# time, populate the window using weakchecksum instead of rolling
-			# through every single byte which takes at least twice as long.
-			block = bytearray(await datastream.read(blocksize))
-			local_offset += blocksize
-			checksum = common.adler32(block)
-		#match = False
-
-		match = common.check_block(block, checksum, remote_hashes, local_instructions, local_offset)
-
-		if not match:
-			# The current block wasn't matched
-			if datastream:
-				try:
-					# Get the next byte and affix to the window
-					newbyte = ord(await datastream.read(1))
-					block.append(newbyte)
-				except TypeError:
-					# No more data from the file; the window will slowly shrink.
-					# "newbyte" needs to be zero from here on to keep the checksum correct.
-					newbyte = 0  # Not necessary to add to the window
-					tailsize = await datastream.tell() % blocksize
-					datastream = None
-
-			if datastream is None and len(block) <= tailsize:
-				# The likelihood that any blocks will match after this is
-				# nearly nil so call it quits.
-				break
+"""
+Receives the unpatched datastream, the remote hashes and the cached digest, if any
+Returns whether the unpatched file is identical to the patched one, leaving the
+stream where it was. It's False whenever that can't be told cheaply
+"""
+async def _identical(datastream, remote_hashes, digest, offloader):
+	try:
+		length, filehash = core.recorded_digest(remote_hashes)
+	except ValueError:
+		return False
+	if await _stream_size(datastream) != length:
+		return False
+	if digest is None:
+		position = await datastream.tell()
+		digest = (await file_digest(datastream, offloader))[1]
+		await datastream.seek(position)
+	return digest == filehash
 
-			# Remove the first byte from the window and cheaply calculate
-			# the new checksum for it using the previous checksum
-			oldbyte = block.pop(0)
-			local_offset += 1
-			checksum = common.adler32_roll(checksum, oldbyte, newbyte, blocksize)
 
-	# Now put the block offsets in a dictionary where the key is the first offset
-	remote_instructions = {offsets[0]: (weak, strong, offsets)
-						   for weak, strongs in remote_hashes.items()
-						   for strong, offsets in strongs.items()}
+"""
+Receives several unpatched files, the seeds, and the hashes of the patched file
+The seeds can be a dictionary of readable async streams by any seed id, or a list
+of them whose ids are their positions. They are scanned in that order (see
+get_instructions for the other parameters), every block is taken from the first seed
+that has it, and the seeds after the one that leaves no block missing aren't read
+Returns
+	1 - A dictionary with the local instructions (see get_instructions) of every seed
+	    that has any blocks, by seed id, for patch_seed_blocks
+	2 - The remote instructions of the blocks no seed has
+The chunks are scanned by the "offloader" (see Offloader)
+"""
+async def get_seed_instructions(seeds, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE, chunksize=_DEFAULT_CHUNKSIZE, engine=None, algorithm=None, seq_matches=None, offloader=None):
+	offloader = offloader or _OFFLOADER
+	seeds = core.seed_dict(seeds)
+	seeder = await offloader.run(core.SeedScanner, remote_hashes, blocksize, list(seeds), engine, algorithm, seq_matches)
+	for seed_id, stream in seeds.items():
+		if seeder.complete():
+			break
+		scanner = seeder.scanners[seed_id]
+		chunk = await stream.read(chunksize)
+		while chunk:
+			await offloader.run(scanner.feed, chunk)
+			chunk = await stream.read(chunksize)
+		await offloader.run(scanner.flush)
+	return await offloader.run(seeder.finish)
 
-	return local_instructions, remote_instructions
+
+"""
+Receives a readable stream
+Returns the number of chunks and the chunking.ChunkHashes of its content-defined chunks
+(see chunking.py), which are between "min_size" and "max_size" bytes and "avg_size"
+on average, with the strong hashes calculated with "algorithm" (see common.strong_hash)
+"engine" is None to cut the chunks in pure Python, or "numpy" (see chunking.Chunker)
+The chunks are cut and hashed by the "offloader" (see Offloader)
+"""
+async def chunk_checksums(instream, min_size=2048, avg_size=8192, max_size=65536, algorithm=None, engine=None, offloader=None):
+	offloader = offloader or _OFFLOADER
+	hasher = chunking.ChunkHasher(min_size, avg_size, max_size, algorithm, engine)
+	chunk = await instream.read(_DEFAULT_CHUNKSIZE)
+	while chunk:
+		await offloader.run(hasher.feed, chunk)
+		chunk = await instream.read(_DEFAULT_CHUNKSIZE)
+	return await offloader.run(hasher.finish)
+
+
+"""
+Receives a readable stream of the unpatched file and the chunking.ChunkHashes of the
+patched one, which are consumed like the hashes in get_instructions
+Returns the local and remote instructions of the chunks (see chunking.ChunkScanner.finish)
+for patch_local_blocks, get_blocks and patch_remote_blocks. The unpatched file is cut
+the same way as the patched one and read in chunks of "chunksize" bytes, and every
+chunk is found with a single lookup instead of rolling a checksum over every byte
+Since the chunks have different sizes, pass chunking.chunk_sizes(remote_instructions)
+instead of the blocksize to get_blocks and patch_remote_stream
+The chunks are cut, hashed and looked up by the "offloader" (see Offloader)
+"""
+async def get_chunk_instructions(datastream, remote_hashes, chunksize=_DEFAULT_CHUNKSIZE, engine=None, offloader=None):
+	offloader = offloader or _OFFLOADER
+	scanner = chunking.ChunkScanner(remote_hashes, engine)
+	chunk = await datastream.read(chunksize)
+	while chunk:
+		await offloader.run(scanner.feed, chunk)
+		chunk = await datastream.read(chunksize)
+	return await offloader.run(scanner.finish)
 
 
 """
 ! This function is a generator !
 Receives an instream and a list of offsets
 Yields the blocks in that instream at those offsets
+The blocks are read as ranges of adjacent blocks (see ranges.plan_ranges), which
+also include gaps of up to "gap" bytes between blocks when one larger read is
+cheaper than two
+The time spent reading, but not while the blocks are consumed, and the bytes read are
+added to the "get_blocks" stage of "stats" (see metrics.Stats)
+"""
+async def get_blocks(datastream, requests, blocksize=_DEFAULT_BLOCKSIZE, gap=0, stats=None):
+	stats = stats or metrics.NO_STATS
+	splitter = ranges.RangeSplitter(requests, blocksize)
+	for start, end in ranges.plan_ranges(requests, blocksize, gap):
+		await datastream.seek(start)
+		while start < end:
+			with stats.timing("get_blocks"):
+				data = await datastream.read(min(end - start, _DEFAULT_CHUNKSIZE))
+				blocks = splitter.feed(start, data) if data else []
+			if not data:
+				break
+			stats.processed("get_blocks", len(data))
+			for block in blocks:
+				yield block
+			start += len(data)
+	for block in splitter.finish():
+		yield block
+
+
+"""
+! This function is a generator !
+Receives an instream and a list of offsets, like get_blocks
+Yields the frames of the ranges with those blocks, compressed with "codec" (see transfer.py),
+for patch_remote_stream. Every frame holds at most "chunksize" bytes of the patched
+file and, if "dictionary_size" is set, is primed with up to that many bytes before it
+The frames are compressed by the "offloader" (see Offloader)
+"""
+async def compress_blocks(datastream, requests, blocksize=_DEFAULT_BLOCKSIZE, gap=0, codec="zlib", level=None, dictionary_size=0, chunksize=_DEFAULT_CHUNKSIZE, offloader=None):
+	offloader = offloader or _OFFLOADER
+	for start, end in ranges.cut_ranges(ranges.plan_ranges(requests, blocksize, gap), blocksize, chunksize):
+		dictionary = await _read_dictionary(datastream, start, dictionary_size)
+		await datastream.seek(start)
+		data = await _read_exactly(datastream, end - start)
+		yield transfer.encode_frame(start, await offloader.run(transfer.compress, data, codec, level, dictionary))
+
+
+"""
+Receives a readable stream of the patched file, the start of a frame and the size of its dictionary
+Returns the dictionary of the frame (see transfer.py)
 """
-async def get_blocks(datastream, requests, blocksize=_DEFAULT_BLOCKSIZE):
-	for offset in requests:
-		await datastream.seek(offset)
-		content = await datastream.read(blocksize)
-		yield (offset, content)
+async def _read_dictionary(datastream, start, size):
+	if not size or not start:
+		return b""
+	first = max(0, start - size)
+	await datastream.seek(first)
+	return await _read_exactly(datastream, start - first)
+
+
+"""
+! This function is a generator !
+Receives a block source (see sources.py) or a function of (start, end), and a list of offsets
+Yields the blocks at those offsets in the order they arrive, for patch_remote_stream
+The blocks are requested as ranges (see ranges.plan_ranges) of at most "range_size" bytes,
+"concurrency" of them at a time, so that a slow link is kept busy instead of waiting
+for every request before sending the next one. A range that fails with a transient
+error (see sources.transient) is requested again up to "retries" times, waiting
+"backoff" seconds before the first retry and twice as long before each of the next ones
+"""
+async def fetch_blocks(source, requests, blocksize=_DEFAULT_BLOCKSIZE, gap=0, concurrency=8, retries=3, backoff=0.1, range_size=_DEFAULT_CHUNKSIZE):
+	if not hasattr(source, "fetch"):
+		source = sources.CallableSource(source)
+	offsets = sorted(requests)
+	planned = iter(ranges.cut_ranges(ranges.plan_ranges(offsets, blocksize, gap), blocksize, range_size))
+
+	pending, done = set(), set()
+	try:
+		while True:
+			for start, end in planned:
+				included = offsets[bisect.bisect_left(offsets, start):bisect.bisect_left(offsets, end)]
+				pending.add(asyncio.ensure_future(_fetch_range(source, start, end, included, blocksize, retries, backoff)))
+				if len(pending) >= concurrency:
+					break
+			if not pending:
+				break
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				for block in task.result():
+					yield block
+	finally:
+		# Only the first failure is raised, the other ranges are abandoned
+		for task in pending | done:
+			if not task.done():
+				task.cancel()
+			elif not task.cancelled():
+				task.exception()
+
+
+async def _fetch_range(source, start, end, offsets, blocksize, retries, backoff):
+	for attempt in range(retries + 1):
+		try:
+			data = await source.fetch(start, end)
+			break
+		except Exception as error:
+			if attempt == retries or not sources.transient(error):
+				raise
+			await asyncio.sleep(backoff * 2**attempt)
+	return list(ranges.split_ranges(((start, data),), offsets, blocksize))
 
 
 """
 Receives a readable instream, a writable outstream, a list of instructions and a blocksize
 Sets outstream to the expected size with the blocks from instream in their positions according to the blueprint
+The copies are sorted and adjacent blocks merged into runs (see common.plan_local_copies),
+so that each run only takes one seek and a few large reads and writes
+If the final "length" of the patched file is given the outstream is also resized to it
 WARNING: There is a possibility that a local block will overwrite another
-if the instream and outstream are the same. Avoid this by using different streams.
+if the instream and outstream are the same. Avoid this by using different streams,
+or patch the file in place with patch_in_place instead
+The time and bytes copied are added to the "patch_local_blocks" stage of "stats" (see metrics.Stats)
+"""
+async def patch_local_blocks(instream, outstream, local_instructions, blocksize=_DEFAULT_BLOCKSIZE, length=None, stats=None):
+	stats = stats or metrics.NO_STATS
+	for local_offset, final_offset, size in common.plan_local_copies(local_instructions, blocksize):
+		with stats.timing("patch_local_blocks"):
+			await instream.seek(local_offset)
+			await outstream.seek(final_offset)
+			while size > 0:
+				block = await instream.read(min(size, _DEFAULT_CHUNKSIZE))
+				if not block:
+					break
+				await outstream.write(block)
+				size -= len(block)
+				stats.processed("patch_local_blocks", len(block))
+	if length is not None:
+		await outstream.truncate(length)
+
+
+"""
+Receives the seeds given to get_seed_instructions, a writable outstream, the seed
+instructions it returned and a blocksize
+Copies the blocks of every seed into the outstream (see patch_local_blocks), which
+is also resized to "length" if it's given
+"""
+async def patch_seed_blocks(seeds, outstream, seed_instructions, blocksize=_DEFAULT_BLOCKSIZE, length=None):
+	seeds = core.seed_dict(seeds)
+	for seed_id, local_instructions in seed_instructions.items():
+		await patch_local_blocks(seeds[seed_id], outstream, local_instructions, blocksize, length)
+
+
+"""
+Receives a stream of the unpatched file opened for reading and writing (like "r+b"),
+the local and remote instructions (see get_instructions) and a blocksize
+Patches the local blocks into the same file instead of a second one, in the order
+planned by common.plan_in_place, keeping at most "scratch" bytes in memory to break
+the cycles of blocks that take each other's place. The blocks that didn't fit are
+hashed before they're overwritten and added to the remote instructions
+If "length" is given the stream is resized to it once every block is in place
+The plan is made by the "offloader" (see Offloader)
+Returns the remote instructions of every block that still has to be patched
+(see patch_remote_blocks), which are a copy: the given ones aren't modified
 """
-async def patch_local_blocks(instream, outstream, local_instructions, blocksize=_DEFAULT_BLOCKSIZE):
-	for instruction in local_instructions:
-		local_offset = instruction[0]
-		final_offsets = instruction[1]
+async def patch_in_place(stream, local_instructions, remote_instructions, blocksize=_DEFAULT_BLOCKSIZE, length=None, scratch=_DEFAULT_CHUNKSIZE, algorithm=None, offloader=None):
+	offloader = offloader or _OFFLOADER
+	patcher = await offloader.run(core.InPlacePatcher, local_instructions, remote_instructions, blocksize, scratch, algorithm)
+	# Dropped bytes are read whole blocks at a time
+	chunksize = max(1, _DEFAULT_CHUNKSIZE // blocksize) * blocksize
+	for action, local_offset, final_offset, size in patcher.steps(await stream.seek(0, os.SEEK_END)):
+		if action == "copy":
+			await _move(stream, local_offset, final_offset, size)
+		elif action == "save":
+			await stream.seek(local_offset)
+			patcher.save(final_offset, await _read_exactly(stream, size))
+		elif action == "restore":
+			await stream.seek(final_offset)
+			await stream.write(patcher.restore(final_offset))
+		else:
+			await stream.seek(local_offset)
+			for start in range(0, size, chunksize):
+				data = await _read_exactly(stream, min(chunksize, size - start))
+				await offloader.run(patcher.drop, final_offset + start, data)
+	if length is not None:
+		await stream.truncate(length)
+	return patcher.remote_instructions
 
-		await instream.seek(local_offset)
-		block = await instream.read(blocksize)
 
-		for offset in final_offsets:
-			await outstream.seek(offset)
-			await outstream.write(block)
+"""
+Receives a stream and the source, target and size of a copy inside it
+Copies the bytes like memmove, backwards when the target overlaps the end of the
+source so that no byte is overwritten before it's read
+"""
+async def _move(stream, source, target, size):
+	pieces = [(start, min(_DEFAULT_CHUNKSIZE, size - start)) for start in range(0, size, _DEFAULT_CHUNKSIZE)]
+	if source < target < source + size:
+		pieces.reverse()
+	for start, piece in pieces:
+		await stream.seek(source + start)
+		block = await _read_exactly(stream, piece)
+		await stream.seek(target + start)
+		await stream.write(block)
 
 
 """
 Receives a list of tuples of missing blocks in the form (offset, content),
-a dictionary with remote instructions (2nd result of get_instructions) and a writable outstream
+a dictionary with remote instructions (2nd result of get_instructions, or the
+signature.SignatureTable itself) and a writable outstream
 Sets those those offsets in the outstream to their expected content according to the instructions
-If check_hashes is set to True, it will also confirm that both the weak and strong hash match the expected
+If check_hashes is set to True, it will also confirm that the block's hashes match the expected (see common.verify_block)
+using "algorithm", which defaults to the one recorded by the instructions or otherwise "md5"
+The time and bytes received are added to the "patch_remote_blocks" stage of "stats" (see metrics.Stats)
+"""
+async def patch_remote_blocks(remote_blocks, outstream, remote_instructions, check_hashes=False, algorithm=None, stats=None):
+	await _patch_blocks(remote_blocks, outstream, core.Patcher(remote_instructions, check_hashes, algorithm), stats)
+
+
+"""
+Receives the missing blocks, a writable outstream, the core.Patcher of their
+instructions and the stats of patch_remote_blocks
+Writes the blocks and returns how many there were
 """
-async def patch_remote_blocks(remote_blocks, outstream, remote_instructions, check_hashes=False):
+async def _patch_blocks(remote_blocks, outstream, patcher, stats):
+	stats = stats or metrics.NO_STATS
+	count = 0
 	for first_offset, block in remote_blocks:
-		# Optionally check if this block's hashes match the expected hashes
-		instruction = remote_instructions[first_offset]
-		if check_hashes and (common.adler32(block) != instruction[0] or common.stronghash(block) != instruction[1]):
-			#print(str(first_offset)+" had an error:\n"+str(common.adler32(block))+" != "+str(instruction[0])+" or "+str(common.stronghash(block))+" != "+str(instruction[1]))
-			raise Exception
-		for offset in instruction[2]:
-			await outstream.seek(offset)
-			await outstream.write(block)
+		with stats.timing("patch_remote_blocks"):
+			for offset in patcher.writes(first_offset, block):
+				await outstream.seek(offset)
+				await outstream.write(block)
+		stats.processed("patch_remote_blocks", len(block))
+		count += 1
+	return count
+
+
+"""
+Receives a source of missing blocks, a writable outstream and the remote instructions
+Patches the blocks into the outstream as they arrive instead of collecting them first.
+Fetching the next blocks runs concurrently with writing the previous ones, but at most
+"budget" bytes of blocks are held at once: the source isn't read any further until
+enough of them are written. The source can be:
+	- An async iterable or async generator of (offset, block) tuples, such as get_blocks
+	- A regular iterable of (offset, block) tuples
+	- A readable async stream with the content of the planned ranges back to back (see
+	  ranges.plan_ranges with the same "gap"). In that case remote_instructions must be
+	  the dictionary returned by get_instructions, since its keys are the blocks that
+	  were requested
+	- A readable async stream of the frames from compress_blocks, if "codec" is set.
+	  Their dictionaries are read from the outstream, which must then be readable and
+	  already patched with the local blocks, and "dictionary_size" must be the same.
+	  Before each frame is decompressed, every block of the previous ones is written
+If check_hashes is set to True, every block is verified before it's written (see patch_remote_blocks)
+The frames are decompressed by the "offloader" (see Offloader)
+The writes are added to the "patch_remote_blocks" stage of "stats" (see metrics.Stats)
+Returns the number of blocks patched
+"""
+async def patch_remote_stream(source, outstream, remote_instructions, blocksize=_DEFAULT_BLOCKSIZE, check_hashes=False, gap=0, budget=_DEFAULT_CHUNKSIZE, algorithm=None, codec=None, dictionary_size=0, stats=None, offloader=None):
+	offloader = offloader or _OFFLOADER
+	queue = asyncio.Queue()
+	written = asyncio.Condition()
+	inflight = 0
+
+	async def settle():
+		async with written:
+			await written.wait_for(lambda: not inflight)
+
+	if codec is not None:
+		source = _read_frames(source, outstream, list(remote_instructions), blocksize, budget, codec, dictionary_size, settle, offloader)
+	elif hasattr(source, "read"):
+		source = _read_ranges(source, list(remote_instructions), blocksize, gap, budget)
+	elif not hasattr(source, "__aiter__"):
+		source = _iterate(source)
+
+	async def produce():
+		nonlocal inflight
+		try:
+			async for block in source:
+				async with written:
+					# Backpressure: wait until there's room in the budget, but
+					# always let a block through if nothing else is held
+					await written.wait_for(lambda: not inflight or inflight + len(block[1]) <= budget)
+					inflight += len(block[1])
+				await queue.put(block)
+		finally:
+			await queue.put(None)
+
+	patcher = core.Patcher(remote_instructions, check_hashes, algorithm)
+	producer = asyncio.ensure_future(produce())
+	count = 0
+	try:
+		while True:
+			block = await queue.get()
+			if block is None:
+				break
+			count += await _patch_blocks((block,), outstream, patcher, stats)
+			async with written:
+				inflight -= len(block[1])
+				written.notify_all()
+		# Raises whatever went wrong while reading the source
+		await producer
+	finally:
+		producer.cancel()
+	return count
+
+
+async def _iterate(iterable):
+	for item in iterable:
+		yield item
+
+
+"""
+! This function is a generator !
+Receives a readable async stream with the planned ranges of "requests" back to back
+Yields the (offset, block) tuples in it, reading at most "budget" bytes at a time
+"""
+async def _read_ranges(datastream, requests, blocksize, gap, budget):
+	reader = core.RangeReader(requests, blocksize, gap)
+	size = reader.wanted()
+	while size:
+		data = await datastream.read(min(size, budget))
+		if not data:
+			break
+		for block in reader.feed(data):
+			yield block
+		size = reader.wanted()
+	for block in reader.finish():
+		yield block
+
+
+"""
+! This function is a generator !
+Receives a readable async stream of compressed frames (see compress_blocks), the
+outstream their dictionaries are read from, the parameters of patch_remote_stream,
+a coroutine function that waits until every block yielded so far is written and the
+offloader that decompresses the frames
+Yields the (offset, block) tuples in the frames, reading at most "budget" bytes at a time
+"""
+async def _read_frames(datastream, outstream, requests, blocksize, budget, codec, dictionary_size, settle, offloader):
+	reader = core.FrameReader(requests, blocksize, codec)
+	header = await _read_exactly(datastream, transfer.FRAME_HEADER.size)
+	while header:
+		start = reader.header(header)
+		dictionary = b""
+		if dictionary_size:
+			# The outstream is only read once nothing else is using it
+			await settle()
+			dictionary = await _read_dictionary(outstream, start, dictionary_size)
+		reader.prime(dictionary)
+		while reader.left > 0:
+			data = await datastream.read(min(reader.left, budget))
+			for block in await offloader.run(reader.feed, data):
+				yield block
+		header = await _read_exactly(datastream, transfer.FRAME_HEADER.size)
+	for block in reader.finish():
+		yield block
+
+
+"""
+Receives a fanout.DeltaCache, the fingerprint of a client's unpatched file (see
+fanout.fingerprint), a dictionary with readable streams of the old versions of the
+file by their fingerprints, a readable stream of the new version and its
+signature.SignatureTable
+Returns the fanout.Delta that patches the client's file into the new version, which
+is only built (see build_delta) the first time it's asked for with these parameters,
+or None if the client's file isn't one of the old versions, so it has to get the
+instructions on its own
+Coroutines that ask for the same delta wait for a single build, while different deltas
+are built at the same time. Each stream is only read by one of them at a time
+"""
+async def fan_out(cache, client, versions, new, table, gap=0, codec=None, level=None, dictionary_size=0, engine=None, offloader=None):
+	target = fanout.fingerprint(table)
+	delta = cache.get(client, target, gap, codec, level, dictionary_size)
+	if delta is not None or client not in versions:
+		return delta
+	future, build = cache.claim(client, target, gap, codec, level, dictionary_size)
+	if build:
+		try:
+			async with cache.async_stream_lock(versions[client]):
+				local_instructions, remote_instructions = await _scan_delta(versions[client], table, engine, offloader)
+			async with cache.async_stream_lock(new):
+				delta = await _pack_delta(new, table, local_instructions, remote_instructions, gap, codec, level, dictionary_size, offloader)
+			cache.put(client, target, delta)
+		except BaseException as error:
+			cache.release(future, error)
+			raise
+		cache.release(future, delta)
+	# Shielded, so that a caller that is cancelled doesn't cancel the build for the others
+	return await asyncio.shield(asyncio.wrap_future(future))
+
+
+"""
+Receives readable streams of the old and new versions of a file and the
+signature.SignatureTable of the new one
+Returns the fanout.Delta between them: the instructions for the old version, which
+is scanned from its start with a copy of the table, and the missing blocks packed
+as the ranges planned with "gap" or, if "codec" is set, as compressed frames (see compress_blocks)
+The scan and the compression are run by the "offloader" (see Offloader)
+"""
+async def build_delta(old, new, table, gap=0, codec=None, level=None, dictionary_size=0, engine=None, offloader=None):
+	local_instructions, remote_instructions = await _scan_delta(old, table, engine, offloader)
+	return await _pack_delta(new, table, local_instructions, remote_instructions, gap, codec, level, dictionary_size, offloader)
+
+
+"""
+Receives a readable stream of the old version of a file, the signature.SignatureTable
+of the new one, the engine and the offloader
+Returns the instructions of build_delta for the old version
+"""
+async def _scan_delta(old, table, engine, offloader):
+	await old.seek(0)
+	return await get_instructions(old, table.copy(), table.blocksize, engine=engine, offloader=offloader)
+
+
+"""
+Receives a readable stream of the new version of a file, its signature.SignatureTable,
+the instructions of the old version and the parameters of build_delta
+Returns the fanout.Delta, with the missing blocks read from the new version
+"""
+async def _pack_delta(new, table, local_instructions, remote_instructions, gap, codec, level, dictionary_size, offloader):
+	offloader = offloader or _OFFLOADER
+	builder = core.DeltaBuilder(table, gap, codec, level, dictionary_size, _DEFAULT_CHUNKSIZE)
+	for start, end in builder.reads(remote_instructions):
+		dictionary = await _read_dictionary(new, start, builder.dictionary_size)
+		await new.seek(start)
+		data = await _read_exactly(new, end - start)
+		await offloader.run(builder.add, start, data, dictionary)
+	return builder.finish(local_instructions, remote_instructions)
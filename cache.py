@@ -0,0 +1,181 @@
+"""
+=== CACHE ===
+A server usually publishes the signatures of the same files over and over, and
+they only change when the files do. The cache keeps each signature in a file of
+its own, named after the device, inode, size and modification time of the file
+it describes, so a file that is replaced or touched simply stops being found
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import signature
+import synchronous
+
+_SUFFIX = ".sig"
+
+
+"""
+A directory of binary signature files (see synchronous.write_signature), evicted
+in least recently used order once there are more than "max_entries" of them or
+they take more than "max_bytes" together. Either limit can be None
+The order survives restarts, since every hit also touches the signature file
+Several processes may share a directory: signatures are written to a temporary
+file and renamed, and files removed by someone else are simply forgotten. Threads
+can share the cache too, which lets the asynchronous module run it in its offloader
+"""
+class SignatureCache:
+	def __init__(self, directory, max_entries=None, max_bytes=None):
+		self.directory = directory
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+		# Guards the order and sizes of the signatures
+		self._lock = threading.RLock()
+		self._sizes = OrderedDict()
+		self._total = 0
+		names = [name for name in os.listdir(directory) if name.endswith(_SUFFIX)]
+		stats = {}
+		for name in names:
+			try:
+				stats[name] = os.stat(os.path.join(directory, name))
+			except FileNotFoundError:
+				pass
+		for name in sorted(stats, key=lambda name: stats[name].st_mtime_ns):
+			self._sizes[name] = stats[name].st_size
+			self._total += stats[name].st_size
+
+	"""
+	Receives an open regular file and the parameters of its signature
+	Returns the key of its signature, or None if the stream isn't a regular file
+	"""
+	def key(self, stream, blocksize, algorithm="md5", seq_matches=1):
+		try:
+			stat = os.fstat(stream.fileno())
+		except (AttributeError, OSError, ValueError):
+			return None
+		return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, blocksize, algorithm, seq_matches)
+
+	"""
+	Receives a key
+	Returns the cached signature.SignatureTable, or None if there is none
+	"""
+	def get(self, key):
+		with self._lock:
+			return self._load(self._name(key))
+
+	"""
+	Receives a key
+	Returns the newest cached table of any other version of the same file (the
+	same device, inode and signature parameters), or None if there is none
+	"""
+	def previous(self, key):
+		prefix = self._prefix(key)
+		with self._lock:
+			for name in reversed(self._sizes):
+				if name.startswith(prefix) and name != self._name(key):
+					return self._load(name)
+		return None
+
+	"""
+	Receives an open file, the parameters of its signature and optionally the
+	(start, end) byte ranges modified in place since its signature was last cached
+	Returns the key of its signature and either the cached signature.SignatureTable or
+	the signature.TableBuilder to build it with, which is a TableUpdater if "modified"
+	is given and a previous version of the file is cached. For streams that aren't
+	regular files it returns (None, None)
+	A TableUpdater only hashes the modified blocks again, but every byte of the file
+	still has to be fed to it, since the table records the digest of the whole file
+	that verify_file, the precheck of get_instructions and fan-out rely on
+	"""
+	def lookup(self, stream, blocksize, algorithm="md5", seq_matches=1, modified=None):
+		key = self.key(stream, blocksize, algorithm, seq_matches)
+		if key is None:
+			return None, None
+		table = self.get(key)
+		if table is not None:
+			return key, table
+		previous = self.previous(key) if modified is not None else None
+		if previous is not None:
+			return key, signature.TableUpdater(previous, modified)
+		return key, signature.TableBuilder(blocksize, algorithm, seq_matches)
+
+	"""
+	Receives a key and its signature.SignatureTable
+	Stores the table, replacing any other version of the same file, and evicts
+	the least recently used signatures that don't fit anymore
+	"""
+	def put(self, key, table):
+		name = self._name(key)
+		path = os.path.join(self.directory, name)
+		temporary = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+		with open(temporary, "wb") as f:
+			# Every byte of the hashes, so that the table can still be updated
+			synchronous.write_signature(f, table, table.weak_bytes, table.digest_size)
+		os.replace(temporary, path)
+
+		prefix = self._prefix(key)
+		with self._lock:
+			for other in [other for other in self._sizes if other.startswith(prefix) and other != name]:
+				self._remove(other)
+			self._forget(name)
+			self._sizes[name] = os.path.getsize(path)
+			self._total += self._sizes[name]
+			self._evict()
+
+	"""
+	Removes every cached signature
+	"""
+	def clear(self):
+		with self._lock:
+			for name in list(self._sizes):
+				self._remove(name)
+
+	def __len__(self):
+		return len(self._sizes)
+
+	def _load(self, name):
+		path = os.path.join(self.directory, name)
+		try:
+			with open(path, "rb") as f:
+				table = synchronous.read_signature(f)
+			os.utime(path)
+		except FileNotFoundError:
+			self._forget(name)
+			return None
+		except ValueError:
+			# Truncated or from an older version
+			self._remove(name)
+			return None
+		if name not in self._sizes:
+			# Written by another process
+			self._sizes[name] = os.path.getsize(path)
+			self._total += self._sizes[name]
+		self._sizes.move_to_end(name)
+		return table
+
+	def _evict(self):
+		while self._sizes and ((self.max_entries is not None and len(self._sizes) > self.max_entries)
+				or (self.max_bytes is not None and self._total > self.max_bytes)):
+			self._remove(next(iter(self._sizes)))
+
+	def _remove(self, name):
+		try:
+			os.remove(os.path.join(self.directory, name))
+		except FileNotFoundError:
+			pass
+		self._forget(name)
+
+	def _forget(self, name):
+		self._total -= self._sizes.pop(name, 0)
+
+	# Every version of a file shares the prefix of its name, and the size and
+	# modification time tell the versions apart
+	def _prefix(self, key):
+		device, inode, size, mtime, blocksize, algorithm, seq_matches = key
+		file_id = "%d:%d:%d:%s:%d" % (device, inode, blocksize, algorithm, seq_matches)
+		return hashlib.sha1(file_id.encode()).hexdigest()[:20] + "-"
+
+	def _name(self, key):
+		return self._prefix(key) + "%d-%d" % (key[2], key[3]) + _SUFFIX
@@ -0,0 +1,247 @@
+"""
+=== CHUNKING ===
+Content-defined chunking (FastCDC), an alternative to fixed blocks. The file is
+cut wherever the gear hash of the last 64 bytes has its top bits set to zero, so
+the cuts depend on the content around them and not on their offsets: an insertion
+only changes the chunks around it, and the unpatched file is chunked the same way
+and matched by a plain digest lookup, without rolling a checksum over every byte
+The chunks are between "min_size" and "max_size" bytes long. Before "avg_size" a
+cut needs more zero bits and after it fewer, which keeps most chunks close to it
+"""
+import functools
+import hashlib
+
+import common
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+_DEFAULT_MIN_SIZE = 2048
+_DEFAULT_AVG_SIZE = 8192
+_DEFAULT_MAX_SIZE = 65536
+# The gear hash of a position only depends on the bytes in this window before it
+_WINDOW = 64
+_MASK64 = (1 << 64) - 1
+# A fixed table, so that every version of the module cuts the same files the same way
+_GEAR = [int.from_bytes(hashlib.md5(bytes((i,))).digest()[:8], "big") for i in range(256)]
+
+
+"""
+Cuts a file into chunks. It is fed the bytes of the file in pieces of any size, and
+returns every chunk completed by them. "engine" is either None (or "python"), which
+hashes byte by byte, or "numpy", which hashes whole pieces at once (requires numpy).
+Both cut in the same places
+Raises a ValueError unless 64 <= min_size <= avg_size <= max_size
+"""
+class Chunker:
+	def __init__(self, min_size=_DEFAULT_MIN_SIZE, avg_size=_DEFAULT_AVG_SIZE, max_size=_DEFAULT_MAX_SIZE, engine=None):
+		if not _WINDOW <= min_size <= avg_size <= max_size:
+			raise ValueError("The chunk sizes must be 64 <= min_size <= avg_size <= max_size")
+		if engine not in (None, "python", "numpy"):
+			raise ValueError("Unknown engine: "+str(engine))
+		self.min_size = min_size
+		self.avg_size = avg_size
+		self.max_size = max_size
+		self.vectorized = engine == "numpy"
+		bits = max(1, avg_size.bit_length() - 1)
+		# Normalized chunking: two more bits before the average size, two less after it
+		self.strict_mask = _top_bits(min(bits + 2, 63))
+		self.loose_mask = _top_bits(max(bits - 2, 1))
+		self.offset = 0
+		self.buffer = b""
+
+	"""
+	Receives the next bytes of the file
+	Returns a list with the (offset, chunk) tuples completed by them
+	"""
+	def feed(self, data):
+		return self._cut(data, False)
+
+	"""
+	Returns a list with the last chunk, if there is one left
+	"""
+	def finish(self):
+		return self._cut(b"", True)
+
+	def _cut(self, data, eof):
+		buffer = self.buffer + data if self.buffer else data
+		view = memoryview(buffer)
+		cuts = self._numpy_cuts(buffer) if self.vectorized else None
+		chunks = []
+		start = 0
+		while start < len(buffer):
+			end = self._next_cut(buffer, start, cuts)
+			if end is None:
+				if not eof:
+					break
+				end = len(buffer)
+			chunks.append((self.offset + start, bytes(view[start:end])))
+			start = end
+		self.buffer = bytes(view[start:])
+		self.offset += start
+		return chunks
+
+	# Returns where the chunk that begins at "start" ends, or None if it needs more data
+	def _next_cut(self, buffer, start, cuts):
+		average = start + self.avg_size
+		largest = start + self.max_size
+		if cuts is not None:
+			strict, loose = cuts
+			for candidates, first, last in ((strict, start + self.min_size, average), (loose, average, largest)):
+				index = numpy.searchsorted(candidates, first)
+				if index < len(candidates) and candidates[index] < last:
+					return int(candidates[index])
+		elif start + self.min_size <= len(buffer):
+			gear = _GEAR
+			strict_mask = self.strict_mask
+			loose_mask = self.loose_mask
+			position = start + self.min_size - _WINDOW
+			checksum = 0
+			for byte in buffer[position:position + _WINDOW]:
+				checksum = ((checksum << 1) + gear[byte]) & _MASK64
+			position += _WINDOW
+			stop = min(largest, len(buffer))
+			while True:
+				if not checksum & (strict_mask if position < average else loose_mask):
+					return position
+				if position >= stop:
+					break
+				checksum = ((checksum << 1) + gear[buffer[position]]) & _MASK64
+				position += 1
+		return largest if largest <= len(buffer) else None
+
+	# Returns the sorted positions (exclusive ends) where the buffer could be cut
+	# with either mask, from the gear hash of every window at once
+	def _numpy_cuts(self, buffer):
+		data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+		checksums = _numpy_gear()[data]
+		# Doubling the window each time: h(2w)[i] = h(w)[i] + h(w)[i-w] << w
+		width = 1
+		while width < _WINDOW:
+			checksums[width:] += checksums[:-width] << numpy.uint64(width)
+			width *= 2
+		ends = numpy.arange(1, len(buffer) + 1)
+		# Windows shorter than 64 bytes are never tested, since min_size is larger
+		strict = ends[(checksums & numpy.uint64(self.strict_mask)) == 0]
+		loose = ends[(checksums & numpy.uint64(self.loose_mask)) == 0]
+		return strict, loose
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy_gear():
+	return numpy.array(_GEAR, dtype=numpy.uint64)
+
+
+def _top_bits(count):
+	return (_MASK64 >> (64 - count)) << (64 - count)
+
+
+"""
+The signature of a chunked file: a dictionary like so
+	{ stronghash : (weakhash, size, [ offset1, offset2, ... ]) }
+which also remembers the chunk sizes, the strong hash "algorithm" and the "length"
+of the file. Like the block hashes, it is consumed by the instructions that match it
+"""
+class ChunkHashes(dict):
+	def __init__(self, min_size=_DEFAULT_MIN_SIZE, avg_size=_DEFAULT_AVG_SIZE, max_size=_DEFAULT_MAX_SIZE, algorithm="md5", length=0):
+		super().__init__()
+		self.min_size = min_size
+		self.avg_size = avg_size
+		self.max_size = max_size
+		self.algorithm = algorithm
+		self.length = length
+
+	"""
+	Returns the remote instructions (see ChunkScanner.finish) for every chunk left
+	"""
+	def remote_instructions(self):
+		return common.Instructions(((offsets[0], (weak, strong, offsets, size))
+			for strong, (weak, size, offsets) in self.items()), self.algorithm)
+
+
+"""
+Builds the ChunkHashes of a file from its contents, which it's fed in pieces of any size
+"""
+class ChunkHasher:
+	def __init__(self, min_size=_DEFAULT_MIN_SIZE, avg_size=_DEFAULT_AVG_SIZE, max_size=_DEFAULT_MAX_SIZE, algorithm=None, engine=None):
+		self.chunker = Chunker(min_size, avg_size, max_size, engine)
+		algorithm = common.hash_algorithm(algorithm, None)
+		self.strong = common.strong_hash(algorithm)
+		self.hashes = ChunkHashes(min_size, avg_size, max_size, algorithm)
+		self.count = 0
+
+	"""
+	Receives the next bytes of the file
+	Hashes every chunk completed by them
+	"""
+	def feed(self, data):
+		self._add_chunks(self.chunker.feed(data))
+
+	"""
+	Hashes the last chunk
+	Returns the number of chunks and the ChunkHashes
+	"""
+	def finish(self):
+		self._add_chunks(self.chunker.finish())
+		self.hashes.length = self.chunker.offset
+		return self.count, self.hashes
+
+	def _add_chunks(self, chunks):
+		for offset, chunk in chunks:
+			strong = self.strong(chunk)
+			entry = self.hashes.get(strong)
+			if entry is None:
+				self.hashes[strong] = (common.adler32(chunk), len(chunk), [offset])
+			else:
+				entry[2].append(offset)
+			self.count += 1
+
+
+"""
+Finds the chunks of a patched file, described by its ChunkHashes, in the unpatched
+file it is fed: the unpatched file is cut into chunks the same way, and every chunk
+is looked up by its strong hash
+"""
+class ChunkScanner:
+	def __init__(self, remote_hashes, engine=None):
+		self.remote_hashes = remote_hashes
+		self.chunker = Chunker(remote_hashes.min_size, remote_hashes.avg_size, remote_hashes.max_size, engine)
+		self.strong = common.strong_hash(remote_hashes.algorithm)
+		self.local_instructions = []
+
+	"""
+	Receives the next bytes of the unpatched file
+	Looks up every chunk completed by them
+	"""
+	def feed(self, data):
+		self._match(self.chunker.feed(data))
+
+	"""
+	Looks up the last chunk
+	Returns
+		1 - A list of tuples containing the local offset, the offsets in the patched
+		    file where the chunk goes and its size, which patch_local_blocks accepts
+		    just like the instructions of fixed blocks
+		2 - The remote instructions, a dictionary where each key is a missing chunk's
+		    first offset and the values are tuples with its (weak, strong, offsets, size)
+	"""
+	def finish(self):
+		self._match(self.chunker.finish())
+		return self.local_instructions, self.remote_hashes.remote_instructions()
+
+	def _match(self, chunks):
+		for offset, chunk in chunks:
+			entry = self.remote_hashes.pop(self.strong(chunk), None)
+			if entry is not None:
+				self.local_instructions.append((offset, entry[2], entry[1]))
+
+
+"""
+Receives the remote instructions of chunks (see ChunkScanner.finish)
+Returns a dictionary with the size of every missing chunk by its first offset, which
+get_blocks, patch_remote_stream and the ranges module accept in place of the blocksize
+"""
+def chunk_sizes(remote_instructions):
+	return {offset: instruction[3] for offset, instruction in remote_instructions.items()}
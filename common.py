@@ -1,6 +1,14 @@
+import bisect
+import functools
 import hashlib
+import heapq
 import zlib
 
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
 """
 === HASHING ===
 """
@@ -8,6 +16,55 @@ def stronghash(block):
 	return hashlib.md5(block).digest()
 _PRIME_MOD = 65521
 
+"""
+Strong hash algorithms, as name : (function(block, digest_size), full digest size)
+The BLAKE2 functions produce a native digest of the requested size, while the
+others are truncated to it
+"""
+_STRONG_HASHES = {
+	"md5": (lambda block, size: hashlib.md5(block).digest()[:size], 16),
+	"blake2b": (lambda block, size: hashlib.blake2b(block, digest_size=size).digest(), 64),
+	"blake2s": (lambda block, size: hashlib.blake2s(block, digest_size=size).digest(), 32),
+}
+if xxhash is not None:
+	_STRONG_HASHES["xxh3"] = (lambda block, size: xxhash.xxh3_64_digest(block)[:size], 8)
+	_STRONG_HASHES["xxh128"] = (lambda block, size: xxhash.xxh3_128_digest(block)[:size], 16)
+
+
+"""
+Receives the name of a strong hash algorithm, optionally followed by a digest size
+in bytes, such as "md5", "md5-8", "blake2b-16" or "xxh128" (None means "md5")
+	md5 - the zsync default, with 16 byte digests
+	blake2b, blake2s - from hashlib, with digests of any size up to 64 and 32 bytes
+	xxh3, xxh128 - non-cryptographic and the fastest by far (requires xxhash)
+Returns a function that receives a block and returns its strong hash
+"""
+@functools.lru_cache(maxsize=None)
+def strong_hash(algorithm=None):
+	if algorithm is None or algorithm == "md5":
+		return stronghash
+	name, _, size = algorithm.rpartition("-")
+	if not name or not size.isdigit():
+		name, size = algorithm, None
+	if name not in _STRONG_HASHES:
+		raise ValueError("Unknown strong hash: "+str(algorithm))
+	function, full_size = _STRONG_HASHES[name]
+	size = full_size if size is None else int(size)
+	if not 1 <= size <= full_size:
+		raise ValueError("The digest size of "+name+" must be between 1 and "+str(full_size))
+	return functools.partial(function, size=size)
+
+
+"""
+Receives a strong hash algorithm name and the remote hashes or instructions
+Returns the given algorithm, or otherwise the one recorded by the hashes
+(a signature.SignatureTable or Instructions) or "md5"
+"""
+def hash_algorithm(algorithm, hashes):
+	if algorithm is None:
+		algorithm = getattr(hashes, "algorithm", None)
+	return algorithm or "md5"
+
 """
 Receives the unsigned integers "checksum", "removed" and "added", as well as a blocksize
 Generates the Adler-32 checksum for the new value using the old checksum, the removed value and the added value
@@ -15,8 +72,8 @@ Generates the Adler-32 checksum for the new value using the old checksum, the re
 def adler32_roll(checksum, removed, added, blocksize):
 	a = checksum & 0xffff
 	b = (checksum >> 16) & 0xffff
-	a += added - removed % _PRIME_MOD
-	b += a - 1 - (removed * blocksize) % _PRIME_MOD
+	a = (a + added - removed) % _PRIME_MOD
+	b = (b + a - 1 - removed * blocksize) % _PRIME_MOD
 	return (b << 16) | a
 
 """
@@ -35,15 +92,17 @@ def adler32(data):
 """
 === TOOLS ===
 """
+def populate_block_checksums(block, hashes, offset, strong=stronghash):
+	add_block_checksums(hashes, adler32(block), strong(block), offset)
+
+
 """
+Same as populate_block_checksums, for a block whose hashes are already known
 1 - no weak
 2 - weak, no strong
 3 - weak and strong, new offset
 """
-def populate_block_checksums(block, hashes, offset):
-	weak = adler32(block)
-	strong = stronghash(block)
-
+def add_block_checksums(hashes, weak, strong, offset):
 	try:
 		hashes[weak][strong].append(offset) # 3
 	except KeyError:
@@ -53,27 +112,334 @@ def populate_block_checksums(block, hashes, offset):
 			hashes[weak] = {strong: [offset]} # 1
 
 
-def check_block(block, checksum, hashes, local_instructions, local_offset):
+def check_block(block, checksum, hashes, local_instructions, local_offset, strong=stronghash):
 	match = False
 	if checksum in hashes:
 		# Matched the weak hash
-		print("matched something")
-		strong = stronghash(block)
-		try:
-			remote_offset = hashes[checksum][strong]
+		remote_offset = claim_block(hashes, checksum, strong(block))
+		if remote_offset is not None:
 			# Matched the strong hash too, so the local block matches to a remote block
 			match = True
 			local_instructions.append((local_offset, remote_offset))
-			# After the block match we don't care about this block anymore,
-			# so remove it from the dictionary
-			del hashes[checksum][strong]
-			if not hashes[checksum]:  # empty dicts evaluate to false
-				del hashes[checksum]
-		except KeyError:
-			# Did not match the strong hash
-			pass
 	return match
 
+
+"""
+Receives the remote hashes (either the dictionaries from block_checksums or a
+signature.SignatureTable), a weak and a strong hash
+Returns the final offsets of the matching block and removes it from the hashes,
+since after the block match we don't care about this block anymore
+Returns None if the strong hash doesn't match
+"""
+def claim_block(hashes, weak, strong):
+	if not isinstance(hashes, dict):
+		return hashes.claim(weak, strong)
+	try:
+		offsets = hashes[weak].pop(strong)
+	except KeyError:
+		return None
+	if not hashes[weak]:  # empty dicts evaluate to false
+		del hashes[weak]
+	return offsets
+
+
+"""
+The remote instructions returned by get_instructions: a regular dictionary that also
+remembers the strong hash "algorithm" of its hashes, so that patch_remote_blocks
+verifies the blocks with the same one
+"""
+class Instructions(dict):
+	def __init__(self, instructions=(), algorithm="md5"):
+		super().__init__(instructions)
+		self.algorithm = algorithm
+
+
+"""
+Receives the remote hashes left over by get_instructions and their strong hash algorithm
+Returns an Instructions dictionary where each key is a missing block's first offset and
+the values are tuples with its (weak, strong, offsets)
+"""
+def remote_instructions(hashes, algorithm=None):
+	algorithm = hash_algorithm(algorithm, hashes)
+	if not isinstance(hashes, dict):
+		return Instructions(hashes.remote_instructions(), algorithm)
+	return Instructions({ offsets[0] : (weak, strong, offsets)
+		for weak, strongs in hashes.items()
+		for strong, offsets in strongs.items() }, algorithm)
+
+
+"""
+Receives the "seq_matches" given to get_instructions and the remote hashes
+Returns how many consecutive blocks must match their weak hashes before a block's
+strong hash is checked: the given number, or otherwise the one recorded by the hashes
+(a signature.SignatureTable) or 1. Only 1 and 2 are supported, like in zsync
+"""
+def sequence_matches(seq_matches, hashes):
+	if seq_matches is None:
+		seq_matches = getattr(hashes, "seq_matches", None) or 1
+	if seq_matches not in (1, 2):
+		raise ValueError("seq_matches must be 1 or 2")
+	return seq_matches
+
+
+"""
+Filters the weak hash hits of get_instructions with seq_matches=2: a window only
+matches a block if the window after it also matches the weak hash of the next block
+The pairs of consecutive weak hashes are taken from the remote hashes before any of
+them is claimed. The last two blocks are accepted on their own weak hash, since the
+last one may be shorter than the blocksize
+"""
+class SequenceFilter:
+	def __init__(self, hashes, blocksize):
+		self.blocksize = blocksize
+		weaks = { offset : weak
+			for weak, strongs in hashes.items()
+			for offsets in strongs.values()
+			for offset in offsets }
+		last = max(weaks, default=0)
+		self.pairs = set()
+		self.singles = set()
+		for offset, weak in weaks.items():
+			if offset + blocksize >= last:
+				self.singles.add(weak)
+			else:
+				self.pairs.add((weak, weaks[offset + blocksize]))
+
+	"""
+	Receives the weak hash of a window and the window after it
+	Returns whether both of them could be consecutive blocks of the remote file
+	"""
+	def accepts(self, weak, window):
+		if weak in self.singles:
+			return True
+		return len(window) == self.blocksize and (weak, adler32(window)) in self.pairs
+
+
+"""
+Receives the remote hashes and the blocksize
+Returns the function that checks a weak hash hit and the window after it for seq_matches=2
+"""
+def sequence_filter(hashes, blocksize):
+	if not isinstance(hashes, dict):
+		return hashes.follows
+	return SequenceFilter(hashes, blocksize).accepts
+
+
+"""
+Receives a block, its expected (weak, strong, offsets) instruction and the strong hash function
+Returns whether the block's strong hash matches the expected one. Signatures
+read from a file may keep only the first bytes of the strong hash, and only
+the most significant bytes of the weak one, so the weak hash can't be compared
+directly but a matching strong hash implies it anyway
+"""
+def verify_block(block, instruction, strong=stronghash):
+	expected = instruction[1]
+	return strong(block)[:len(expected)] == expected
+
+
+"""
+Receives the remote instructions (or a signature.SignatureTable) and the first offset of a block
+Returns its (weak, strong, offsets) tuple
+"""
+def remote_instruction(remote_instructions, offset):
+	if not isinstance(remote_instructions, dict):
+		return remote_instructions.instruction(offset)
+	return remote_instructions[offset]
+
+
+"""
+Receives the remote hashes
+Returns what scan_buffer looks the weak hash of every window up in: None for the
+dictionaries, which it tests membership in directly, or the bitmap of the weak hashes
+a signature.SignatureTable still has unclaimed entries for, with the shifts that
+truncate a weak hash like the table and then turn it into a bit (see
+SignatureTable.unclaimed_slots)
+"""
+def weak_lookup(hashes):
+	if isinstance(hashes, dict):
+		return None, 0, 0
+	bits, bit_shift = hashes.unclaimed_slots()
+	return bits, 8 * (4 - hashes.weak_bytes), bit_shift
+
+
+"""
+Receives a bytes-like "buffer" holding part of the unpatched file, the index
+"position" of the current window inside it and that window's "checksum" (or None
+if it has to be calculated from scratch), the remote hashes, the list of local
+instructions to fill, the blocksize, the file offset of buffer[0], whether
+the buffer reaches the end of the file, the strong hash function and, for
+seq_matches=2, the "sequence" filter (see sequence_filter)
+Slides the window over the buffer by index instead of copying bytes around,
+appending every match to local_instructions
+Returns the position and checksum to resume from once more data is appended to
+buffer[position:]. At the end of the file the window shrinks like the
+original per-byte loop did, until only the tail of a block is left
+"""
+def scan_buffer(buffer, position, checksum, hashes, local_instructions, blocksize, offset=0, eof=False, strong=stronghash, sequence=None):
+	bits, shift, bit_shift = weak_lookup(hashes)
+	view = memoryview(buffer)
+	end = len(buffer)
+	tailsize = (offset + end) % blocksize
+	# The sequence filter also needs the window after the current one
+	lookahead = blocksize if sequence else 0
+	while True:
+		limit = position + blocksize
+		if limit + lookahead > end and not eof:
+			# Not enough data for a full window yet
+			break
+		if checksum is None:
+			checksum = adler32(view[position:limit])
+
+		if bits is None:
+			hit = checksum in hashes
+		else:
+			bit = (((checksum >> shift) * 2654435761) & 0xffffffff) >> bit_shift
+			hit = bits[bit >> 3] >> (bit & 7) & 1
+		# Only slice the window when the weak hash matches something
+		if hit and (sequence is None or sequence(checksum, view[limit:limit + blocksize])) and check_block(view[position:limit], checksum, hashes, local_instructions, offset + position, strong):
+			# Jump over the matched block and start a fresh window after it
+			position = limit
+			checksum = None
+			continue
+
+		if limit < end:
+			checksum = adler32_roll(checksum, buffer[position], buffer[limit], blocksize)
+		elif not eof:
+			# The next byte hasn't been read yet
+			break
+		elif end - position <= tailsize:
+			# The likelihood that any blocks will match after this is
+			# nearly nil so call it quits.
+			break
+		else:
+			# No more data from the file; the window slowly shrinks and
+			# the added byte needs to be zero to keep the checksum correct.
+			checksum = adler32_roll(checksum, buffer[position], 0, blocksize)
+		position += 1
+	return position, checksum
+
+"""
+Receives the local instructions (1st result of get_instructions) and a blocksize
+Returns a list of (local_offset, final_offset, size) copies sorted by final offset,
+where blocks that are adjacent in both the unpatched and the patched file are
+merged into a single run. Files with small edits end up as a few long runs
+Instructions with a size of their own as a third item, like those of chunks (see
+chunking.ChunkScanner), copy that many bytes instead of the blocksize
+"""
+def plan_local_copies(local_instructions, blocksize):
+	copies = []
+	for instruction in local_instructions:
+		local_offset, final_offsets = instruction[:2]
+		size = instruction[2] if len(instruction) > 2 else blocksize
+		copies += [(final_offset, local_offset, size) for final_offset in final_offsets]
+	copies.sort()
+	runs = []
+	for final_offset, local_offset, size in copies:
+		if runs and runs[-1][0] + runs[-1][2] == local_offset and runs[-1][1] + runs[-1][2] == final_offset:
+			runs[-1][2] += size
+		else:
+			runs.append([local_offset, final_offset, size])
+	return [tuple(run) for run in runs]
+
+
+# The states of the copies in plan_in_place
+_PENDING, _SAVED, _DROPPED, _DONE = range(4)
+
+
+"""
+Receives the local instructions (1st result of get_instructions), a blocksize and
+the most bytes of "scratch" memory that may be used
+Returns the steps that patch the local blocks into the same file they come from,
+as (action, local_offset, final_offset, size) tuples in the order they must be done:
+	"copy" - copy the local bytes to their final offset, which may overlap them
+	"save" - read the local bytes into memory, since their final offset is still
+	         needed by other copies
+	"restore" - write the bytes saved earlier to their final offset
+	"drop" - the bytes didn't fit in the scratch memory, so they have to be fetched
+	         like the missing blocks. Their hashes are calculated right then,
+	         before anything overwrites them
+Every copy is done before anything is written over the bytes it reads, and the copies
+that depend on each other in a cycle are broken by saving the smallest of them
+"""
+def plan_in_place(local_instructions, blocksize, scratch):
+	moves = [run for run in plan_local_copies(local_instructions, blocksize) if run[0] != run[1]]
+	# Every copy waits for the copies that read from where it writes. The targets
+	# don't overlap, so the ones under each source are found by bisection
+	targets = sorted(range(len(moves)), key=lambda move: moves[move][1])
+	target_starts = [moves[move][1] for move in targets]
+	waiting = [0] * len(moves)
+	blocking = [[] for _ in moves]
+	for reader, (source, _, size) in enumerate(moves):
+		index = max(0, bisect.bisect_right(target_starts, source) - 1)
+		while index < len(targets) and target_starts[index] < source + size:
+			writer = targets[index]
+			if writer != reader and target_starts[index] + moves[writer][2] > source:
+				waiting[writer] += 1
+				blocking[reader].append(writer)
+			index += 1
+
+	steps = []
+	# Whether each copy is pending, saved, dropped or done
+	state = [_PENDING] * len(moves)
+	ready = [move for move in range(len(moves)) if not waiting[move]]
+	candidates = [(size, move) for move, (_, _, size) in enumerate(moves) if blocking[move]]
+	heapq.heapify(candidates)
+	used = 0
+	left = len(moves)
+
+	def release(move):
+		for writer in blocking[move]:
+			waiting[writer] -= 1
+			if not waiting[writer]:
+				ready.append(writer)
+
+	while left:
+		if ready:
+			move = ready.pop()
+			if state[move] == _SAVED:
+				steps.append(("restore",) + moves[move])
+				used -= moves[move][2]
+			elif state[move] == _PENDING:
+				steps.append(("copy",) + moves[move])
+				release(move)
+			else:
+				continue
+			state[move] = _DONE
+			left -= 1
+			continue
+		# Every copy left waits for another one, so there is a cycle to break
+		size, move = heapq.heappop(candidates)
+		if state[move] != _PENDING:
+			continue
+		if used + size <= scratch:
+			steps.append(("save",) + moves[move])
+			state[move] = _SAVED
+			used += size
+		else:
+			steps.append(("drop",) + moves[move])
+			state[move] = _DROPPED
+			left -= 1
+		release(move)
+	return steps
+
+
+"""
+Receives the name of a scanning engine, the remote hashes, the strong hash function
+and the sequence filter
+	None or "python" - common.scan_buffer, rolling the checksum byte by byte
+	"numpy" - vectorized.scan_buffer, checksumming whole buffers at once (requires numpy)
+Returns a function with the same signature as scan_buffer
+"""
+def get_engine(engine, hashes, strong=stronghash, sequence=None):
+	if engine is None or engine == "python":
+		if strong is stronghash and sequence is None:
+			return scan_buffer
+		return functools.partial(scan_buffer, strong=strong, sequence=sequence)
+	if engine == "numpy":
+		import vectorized
+		return vectorized.scanner(hashes, strong, sequence)
+	raise ValueError("Unknown engine: "+str(engine))
+
 """
 A small test using a paragraph of Lorem Ipsum
 """
@@ -0,0 +1,463 @@
+"""
+=== CORE ===
+The algorithms behind the synchronous and asynchronous modules, without any I/O.
+Each object is fed the bytes of a file in chunks of any size and tells what to
+write, so the modules only have to read and write, and other drivers (sockets,
+memory maps, object storage) can be built the same way
+"""
+import common
+import fanout
+import ranges
+import signature
+import transfer
+import tuning
+
+
+"""
+Decides how block_checksums builds a signature (see block_checksums for the
+parameters): the blocksize, which is None until it's chosen (see BlocksizeChooser)
+if it's "auto", whether a cached table is returned as it is, what the blocks are
+added to and in which format the hashes are returned
+"""
+class SignatureBuild:
+	def __init__(self, blocksize, compact=False, algorithm=None, seq_matches=1):
+		self.auto = blocksize == "auto"
+		if self.auto and not compact:
+			raise ValueError("blocksize='auto' requires compact=True, since only a SignatureTable records the blocksize")
+		self.blocksize = None if self.auto else blocksize
+		self.compact = compact
+		self.algorithm = algorithm
+		self.seq_matches = common.sequence_matches(seq_matches, None)
+		self.key = None
+		self.hashes = None
+
+	"""
+	Receives the key and hashes returned by cache.SignatureCache.lookup
+	Returns the result of block_checksums if the cached table is up to date, or
+	else None, and the blocks have to be hashed into what the cache returned
+	"""
+	def cached(self, key, hashes):
+		self.key = key
+		if isinstance(hashes, signature.SignatureTable):
+			return self.result(float(len(hashes.entries)), hashes)
+		self.hashes = hashes
+		return None
+
+	"""
+	Returns the BlockHasher the file has to be fed to
+	"""
+	def hasher(self):
+		hashes = self.hashes
+		if hashes is None:
+			hashes = signature.TableBuilder(self.blocksize, self.algorithm, self.seq_matches) if self.compact else {}
+		return BlockHasher(self.blocksize, hashes, self.algorithm)
+
+	"""
+	Receives the number of blocks and the hashes, built or cached
+	Returns them as block_checksums does: as dictionaries unless compact was asked
+	for, and tuned (see tuning.tune_table) if the blocksize was chosen
+	"""
+	def result(self, count, hashes):
+		if not self.compact and not isinstance(hashes, dict):
+			hashes = hashes.to_hashes()
+		if self.auto:
+			tuning.tune_table(hashes)
+		return count, hashes
+
+
+"""
+Chooses the blocksize for the signature of a file of "length" bytes (see
+tuning.auto_blocksize). Given the signature.SignatureTable of the previous version
+of the file, the windows of "window" bytes at "offsets" have to be read and handed
+to choose, which compares them with it and refines the blocksize for the edits
+found (see tuning.refine_blocksize)
+Raises a ValueError if the length is None, since it couldn't be told
+"""
+class BlocksizeChooser:
+	def __init__(self, length, previous=None, seq_matches=1, samples=64):
+		if length is None:
+			raise ValueError("The blocksize can only be chosen for streams whose size can be told")
+		self.length = length
+		self.previous = previous
+		self.seq_matches = seq_matches
+		self.blocksize = tuning.auto_blocksize(length)
+		self.window = 0
+		self.offsets = []
+		if previous is not None and length:
+			self.window = 2 * previous.blocksize
+			self.offsets = tuning.sample_offsets(length, self.window, samples)
+
+	"""
+	Receives the windows read at the offsets, in order
+	Returns the blocksize
+	"""
+	def choose(self, windows):
+		if not self.offsets:
+			return self.blocksize
+		record_bytes = sum(tuning.checksum_bytes(self.length, self.blocksize, self.seq_matches))
+		unmatched = tuning.unmatched_fraction(self.previous, windows)
+		return tuning.refine_blocksize(self.length, self.previous.blocksize, unmatched, record_bytes)
+
+
+"""
+Builds the signature of a file from its contents
+"hashes" is where the blocks are added: an empty dictionary for the
+{ weak : { strong : [offsets] } } dictionaries, or a signature.TableBuilder
+(or TableUpdater) for a signature.SignatureTable
+"""
+class BlockHasher:
+	def __init__(self, blocksize, hashes, algorithm=None):
+		self.blocksize = blocksize
+		self.hashes = hashes
+		self.strong = common.strong_hash(algorithm)
+		self.offset = 0
+		self.pending = b""
+
+	"""
+	Receives the next bytes of the file
+	Hashes every block completed by them
+	"""
+	def feed(self, data):
+		if self.pending:
+			data = self.pending + data
+		end = len(data) - len(data) % self.blocksize
+		self._add_blocks(data, end)
+		self.pending = data[end:]
+
+	"""
+	Hashes the last block, which may be shorter than the blocksize
+	Returns the number of blocks and the hashes, with the table already built
+	"""
+	def finish(self):
+		self._add_blocks(self.pending, len(self.pending))
+		self.pending = b""
+		hashes = self.hashes
+		if not isinstance(hashes, dict):
+			hashes = hashes.build()
+		return self.offset/self.blocksize, hashes
+
+	def _add_blocks(self, data, end):
+		view = memoryview(data)
+		hashes = self.hashes
+		building = not isinstance(hashes, dict)
+		for start in range(0, end, self.blocksize):
+			block = view[start:start + self.blocksize]
+			if building:
+				hashes.add(block)
+			else:
+				common.populate_block_checksums(block, hashes, self.offset, self.strong)
+			self.offset += self.blocksize
+
+
+"""
+Finds the blocks of a patched file, described by "remote_hashes", in the unpatched
+file it is fed (see get_instructions for the parameters). The unpatched file can
+also start at "offset", like a shard of it. With a metrics.Stats as "stats", every
+strong hash calculated is counted as a weak hit
+Only the unscanned leftover of the previous chunks is kept, which is never larger
+than a block (or two with seq_matches)
+"""
+class DeltaScanner:
+	def __init__(self, remote_hashes, blocksize, engine=None, algorithm=None, seq_matches=None, offset=0, stats=None):
+		self.remote_hashes = remote_hashes
+		self.blocksize = blocksize
+		self.algorithm = common.hash_algorithm(algorithm, remote_hashes)
+		strong = common.strong_hash(self.algorithm)
+		if stats is not None:
+			strong = stats.counting(strong)
+		sequence = None
+		if common.sequence_matches(seq_matches, remote_hashes) > 1:
+			sequence = common.sequence_filter(remote_hashes, blocksize)
+		self.scan_buffer = common.get_engine(engine, remote_hashes, strong, sequence)
+		self.local_instructions = []
+		self.buffer = b""
+		self.offset = offset
+		self.position = 0
+		self.checksum = None
+
+	"""
+	Receives the next bytes of the unpatched file
+	Scans every window that is complete
+	"""
+	def feed(self, data):
+		self._scan(data, False)
+
+	"""
+	Scans the rest of the unpatched file after its last byte was fed
+	"""
+	def flush(self):
+		self._scan(b"", True)
+
+	"""
+	Scans the rest of the unpatched file
+	Returns the local and remote instructions (see get_instructions)
+	"""
+	def finish(self):
+		self.flush()
+		# Now put the block offsets in a dictionary where the key is the first offset
+		return self.local_instructions, common.remote_instructions(self.remote_hashes, self.algorithm)
+
+	def _scan(self, data, eof):
+		self.buffer = self.buffer[self.position:] + data
+		self.offset += self.position
+		self.position, self.checksum = self.scan_buffer(self.buffer, 0, self.checksum, self.remote_hashes,
+			self.local_instructions, self.blocksize, self.offset, eof)
+
+
+"""
+Turns the missing blocks into the writes that patch them, according to the remote
+instructions (2nd result of get_instructions, or the signature.SignatureTable itself)
+If check_hashes is set to True, every block is verified first (see common.verify_block)
+using "algorithm", which defaults to the one recorded by the instructions or otherwise "md5"
+"""
+class Patcher:
+	def __init__(self, remote_instructions, check_hashes=False, algorithm=None):
+		self.remote_instructions = remote_instructions
+		self.check_hashes = check_hashes
+		self.strong = common.strong_hash(common.hash_algorithm(algorithm, remote_instructions))
+
+	"""
+	Receives the first offset of a missing block and its content
+	Returns the offsets of the patched file where the block has to be written
+	Raises an Exception if the block doesn't match its hashes
+	"""
+	def writes(self, first_offset, block):
+		instruction = common.remote_instruction(self.remote_instructions, first_offset)
+		# Optionally check if this block's hashes match the expected hashes
+		if self.check_hashes and not common.verify_block(block, instruction, self.strong):
+			raise Exception("The block at "+str(first_offset)+" doesn't match its hashes")
+		return instruction[2]
+
+
+"""
+Finds the blocks of a patched file in several unpatched files, the seeds, each fed
+to its own DeltaScanner (see get_seed_instructions for the parameters). They all
+claim from the same remote hashes, so every block is taken from the first seed
+scanned that has it. The scanners are set up before any block is claimed, so
+that with seq_matches every seed still sees the whole sequence of blocks
+"""
+class SeedScanner:
+	def __init__(self, remote_hashes, blocksize, seed_ids, engine=None, algorithm=None, seq_matches=None):
+		self.remote_hashes = remote_hashes
+		self.algorithm = common.hash_algorithm(algorithm, remote_hashes)
+		self.scanners = {seed_id: DeltaScanner(remote_hashes, blocksize, engine, self.algorithm, seq_matches)
+			for seed_id in seed_ids}
+
+	"""
+	Returns whether every block is claimed already, so no other seed needs to be scanned
+	"""
+	def complete(self):
+		if isinstance(self.remote_hashes, dict):
+			return not self.remote_hashes
+		return 0 not in self.remote_hashes.claimed
+
+	"""
+	Returns
+		1 - A dictionary with the local instructions (see get_instructions) of every
+		    seed that has any blocks, by seed id
+		2 - The remote instructions of the blocks no seed has
+	"""
+	def finish(self):
+		seed_instructions = {seed_id: scanner.local_instructions
+			for seed_id, scanner in self.scanners.items() if scanner.local_instructions}
+		return seed_instructions, common.remote_instructions(self.remote_hashes, self.algorithm)
+
+
+"""
+Receives the seeds given to get_seed_instructions
+Returns them as a dictionary by seed id, where the ids of a list are the positions
+"""
+def seed_dict(seeds):
+	return seeds if isinstance(seeds, dict) else dict(enumerate(seeds))
+
+
+"""
+Receives the remote hashes
+Returns the length and whole file digest they record
+Raises a ValueError if they don't record them (the dictionaries don't)
+"""
+def recorded_digest(remote_hashes):
+	length = getattr(remote_hashes, "length", None)
+	filehash = getattr(remote_hashes, "filehash", None)
+	if length is None or not filehash:
+		raise ValueError("The signature doesn't record the file's length and digest")
+	return length, filehash
+
+
+"""
+Patches the local blocks of a file into the same file (see patch_in_place for the
+parameters), in the order planned by common.plan_in_place. The driver does the
+steps, handing the bytes it saves to save and the bytes it drops to drop, which
+hashes them into a copy of the remote instructions
+"""
+class InPlacePatcher:
+	def __init__(self, local_instructions, remote_instructions, blocksize, scratch, algorithm=None):
+		algorithm = common.hash_algorithm(algorithm, remote_instructions)
+		if isinstance(remote_instructions, dict):
+			self.remote_instructions = common.Instructions(remote_instructions, algorithm)
+		else:
+			self.remote_instructions = common.remote_instructions(remote_instructions, algorithm)
+		self.blocksize = blocksize
+		self.strong = common.strong_hash(algorithm)
+		self.plan = common.plan_in_place(local_instructions, blocksize, scratch)
+		self.saved = {}
+
+	"""
+	Receives the size of the unpatched file
+	Yields the (action, local_offset, final_offset, size) steps of the plan (see
+	common.plan_in_place), cut so that nothing is read past the unpatched file, even
+	once the copies have extended it
+	"""
+	def steps(self, end):
+		for action, local_offset, final_offset, size in self.plan:
+			yield action, local_offset, final_offset, max(0, min(size, end - local_offset))
+
+	"""
+	Receives the final offset of a "save" step and the bytes read for it
+	"""
+	def save(self, final_offset, data):
+		self.saved[final_offset] = data
+
+	"""
+	Receives the final offset of a "restore" step
+	Returns the bytes to write there
+	"""
+	def restore(self, final_offset):
+		return self.saved.pop(final_offset)
+
+	"""
+	Receives an offset inside the final range of a "drop" step, at a block boundary,
+	and the bytes read for it from there on
+	Adds their blocks to the remote instructions
+	"""
+	def drop(self, final_offset, data):
+		for start in range(0, len(data), self.blocksize):
+			block = data[start:start + self.blocksize]
+			offset = final_offset + start
+			self.remote_instructions[offset] = (common.adler32(block), self.strong(block), [offset], len(block))
+
+
+"""
+Splits the planned ranges of "requests" (see ranges.plan_ranges with the same "gap"),
+received back to back, into the (offset, block) tuples in them
+"""
+class RangeReader:
+	def __init__(self, requests, blocksize, gap=0):
+		self.splitter = ranges.RangeSplitter(requests, blocksize)
+		self.ranges = iter(ranges.plan_ranges(requests, blocksize, gap))
+		self.start = self.end = 0
+
+	"""
+	Returns how many bytes are left in the current range, or 0 once every range is read
+	"""
+	def wanted(self):
+		if self.start == self.end:
+			self.start, self.end = next(self.ranges, (0, 0))
+		return self.end - self.start
+
+	"""
+	Receives the next bytes, which are at most the ones wanted
+	Returns the blocks completed by them
+	"""
+	def feed(self, data):
+		blocks = self.splitter.feed(self.start, data)
+		self.start += len(data)
+		return blocks
+
+	"""
+	Returns the blocks left (see ranges.RangeSplitter.finish)
+	"""
+	def finish(self):
+		return self.splitter.finish()
+
+
+"""
+Decompresses the frames of compress_blocks (see transfer.py) into the (offset, block)
+tuples of "requests". Every frame starts with its header, which tells where its
+dictionary is, and its data is fed once the dictionary is given to prime
+"""
+class FrameReader:
+	def __init__(self, requests, blocksize, codec):
+		self.splitter = ranges.RangeSplitter(requests, blocksize)
+		self.codec = codec
+		self.decompressor = None
+		self.start = 0
+		self.left = 0
+
+	"""
+	Receives the header of the next frame
+	Returns the offset of the patched file where the frame starts
+	"""
+	def header(self, data):
+		self.start, self.left = transfer.decode_frame_header(data)
+		return self.start
+
+	"""
+	Receives the dictionary of the frame (see transfer.py)
+	"""
+	def prime(self, dictionary):
+		self.decompressor = transfer.decompressor(self.codec, dictionary)
+
+	"""
+	Receives the next bytes of the frame, of which "left" are still missing
+	Returns the blocks completed by them
+	Raises a ValueError if there are none, since the frame was cut short
+	"""
+	def feed(self, data):
+		if not data:
+			raise ValueError("Truncated frame at "+str(self.start))
+		self.left -= len(data)
+		data = self.decompressor.decompress(data)
+		blocks = self.splitter.feed(self.start, data)
+		self.start += len(data)
+		return blocks
+
+	"""
+	Returns the blocks left (see ranges.RangeSplitter.finish)
+	"""
+	def finish(self):
+		return self.splitter.finish()
+
+
+"""
+Packs the missing blocks of a fanout.Delta (see build_delta for the parameters): as
+the ranges planned with "gap" or, if "codec" is set, as frames of at most "chunksize"
+bytes of the new version compressed with it (see compress_blocks)
+"""
+class DeltaBuilder:
+	def __init__(self, table, gap=0, codec=None, level=None, dictionary_size=0, chunksize=4 * 1024 * 1024):
+		self.table = table
+		self.gap = gap
+		self.codec = codec
+		self.level = level
+		# The dictionaries only have to be read for the frames
+		self.dictionary_size = dictionary_size if codec is not None else 0
+		self.chunksize = chunksize
+		self.pieces = []
+
+	"""
+	Receives the remote instructions of the old version
+	Returns the (start, end) ranges of the new version that have to be read, in order
+	"""
+	def reads(self, remote_instructions):
+		planned = ranges.plan_ranges(list(remote_instructions), self.table.blocksize, self.gap)
+		if self.codec is None:
+			return planned
+		return ranges.cut_ranges(planned, self.table.blocksize, self.chunksize)
+
+	"""
+	Receives the start of a range, its bytes and the "dictionary_size" bytes before it
+	"""
+	def add(self, start, data, dictionary=b""):
+		if self.codec is not None:
+			data = transfer.encode_frame(start, transfer.compress(data, self.codec, self.level, dictionary))
+		self.pieces.append(data)
+
+	"""
+	Receives the local and remote instructions of the old version
+	Returns the fanout.Delta
+	"""
+	def finish(self, local_instructions, remote_instructions):
+		level = self.level if self.codec is not None else None
+		return fanout.Delta(local_instructions, remote_instructions, b"".join(self.pieces), self.table.blocksize,
+			self.table.length, self.gap, self.codec, self.dictionary_size, level)
@@ -0,0 +1,207 @@
+"""
+=== FAN-OUT ===
+When a release goes out, most clients hold the same previous version, and every one
+of them would scan it for the same instructions and request the same blocks. A server
+that has the previous versions can compute the delta of each (old version, new
+version) pair once instead, and hand it to every client that fingerprints as that
+old version: the instructions and a bundle with the missing blocks packed back to
+back (see fan_out in either module)
+A client fingerprints its unpatched file by its length and whole file digest (see
+file_digest), or sends the signature of it, which records both
+"""
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Roughly what an instruction takes in memory, to weigh the deltas
+_INSTRUCTION_BYTES = 128
+
+
+"""
+Receives a signature.SignatureTable that records the length and whole file digest of
+its file, or a (length, digest) tuple (see file_digest)
+Returns the fingerprint of that file
+Raises a ValueError if the table doesn't record them
+"""
+def fingerprint(source):
+	if isinstance(source, tuple):
+		length, filehash = source
+	else:
+		length, filehash = getattr(source, "length", None), getattr(source, "filehash", None)
+	if length is None or not filehash:
+		raise ValueError("The file can only be fingerprinted by its length and whole file digest")
+	return str(length) + "-" + filehash.hex()
+
+
+"""
+The delta between two versions of a file, which patches any copy of the old version:
+	local_instructions, remote_instructions - from get_instructions
+	bundle - the missing blocks, as the planned ranges back to back (see ranges.plan_ranges
+	         with "gap") or, if "codec" is set, as the frames of compress_blocks
+	         with "dictionary_size"
+	blocksize, length - the blocksize and length of the new version
+	level - the compression level of the frames
+Clients patch it like this:
+	patch_local_blocks(unpatched, result, delta.local_instructions, delta.blocksize, length=delta.length)
+	patch_remote_stream(io.BytesIO(delta.bundle), result, delta.remote_instructions, delta.blocksize,
+		gap=delta.gap, codec=delta.codec, dictionary_size=delta.dictionary_size)
+"""
+class Delta:
+	def __init__(self, local_instructions, remote_instructions, bundle, blocksize, length, gap=0, codec=None, dictionary_size=0, level=None):
+		self.local_instructions = local_instructions
+		self.remote_instructions = remote_instructions
+		self.bundle = bundle
+		self.blocksize = blocksize
+		self.length = length
+		self.gap = gap
+		self.codec = codec
+		self.dictionary_size = dictionary_size
+		self.level = level
+
+	"""
+	Returns about how many bytes of memory the delta takes
+	"""
+	def size(self):
+		return len(self.bundle) + _INSTRUCTION_BYTES * (len(self.local_instructions) + len(self.remote_instructions))
+
+
+"""
+Receives the fingerprints of the old and new versions and the parameters a delta
+between them is packed with (see Delta)
+Returns the key of that delta in a DeltaCache. Without a codec, the level and the
+dictionaries don't change the bundle, so they aren't part of it
+"""
+def delta_key(old, new, gap=0, codec=None, level=None, dictionary_size=0):
+	if codec is None:
+		level, dictionary_size = None, 0
+	return old, new, gap, codec, level, dictionary_size
+
+
+"""
+The deltas computed so far by (old fingerprint, new fingerprint) and the parameters
+they're packed with (see delta_key), evicted in least recently used order once there
+are more than "max_entries" of them or they take more than "max_bytes" together
+(see Delta.size). Either limit can be None
+It can be shared by threads and event loops. Every delta is built by the first caller
+that claims it, while the others wait for that same build, so clients that arrive
+together still only cause one scan, and different deltas are built at the same time
+"""
+class DeltaCache:
+	def __init__(self, max_entries=None, max_bytes=None):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self._mutex = threading.Lock()
+		self._deltas = OrderedDict()
+		self._sizes = {}
+		self._total = 0
+		# The concurrent.futures.Future of every delta being built, by key
+		self._building = {}
+		self._stream_locks = weakref.WeakKeyDictionary()
+		# asyncio locks can only be used by the loop they were first used in
+		self._async_stream_locks = weakref.WeakKeyDictionary()
+
+	"""
+	Receives the fingerprints of the old and new versions and the parameters of the delta
+	Returns their Delta, or None if it isn't cached
+	"""
+	def get(self, old, new, gap=0, codec=None, level=None, dictionary_size=0):
+		key = delta_key(old, new, gap, codec, level, dictionary_size)
+		with self._mutex:
+			delta = self._deltas.get(key)
+			if delta is not None:
+				self._deltas.move_to_end(key)
+			return delta
+
+	"""
+	Receives the fingerprints of the old and new versions and their Delta
+	Stores it under the parameters it was packed with and evicts the least recently
+	used deltas that don't fit anymore, which may be this one if it's larger than max_bytes
+	"""
+	def put(self, old, new, delta):
+		key = delta_key(old, new, delta.gap, delta.codec, delta.level, delta.dictionary_size)
+		with self._mutex:
+			self._forget(key)
+			self._deltas[key] = delta
+			self._sizes[key] = delta.size()
+			self._total += self._sizes[key]
+			while self._deltas and ((self.max_entries is not None and len(self._deltas) > self.max_entries)
+					or (self.max_bytes is not None and self._total > self.max_bytes)):
+				self._forget(next(iter(self._deltas)))
+
+	"""
+	Receives the same parameters as get
+	Returns a concurrent.futures.Future of the delta, and whether the caller has to
+	build it and hand it to release. Everyone else who claims it until then gets the
+	same future, and a cached delta comes back in a future that is already done
+	"""
+	def claim(self, old, new, gap=0, codec=None, level=None, dictionary_size=0):
+		key = delta_key(old, new, gap, codec, level, dictionary_size)
+		with self._mutex:
+			future = self._building.get(key)
+			if future is not None:
+				return future, False
+			future = Future()
+			delta = self._deltas.get(key)
+			if delta is not None:
+				self._deltas.move_to_end(key)
+				future.set_result(delta)
+				return future, False
+			self._building[key] = future
+			return future, True
+
+	"""
+	Receives a future returned by claim to the caller that builds it, and the delta,
+	which has to be put first, or the exception that stopped the build
+	Hands it to every caller waiting for the future
+	"""
+	def release(self, future, outcome):
+		with self._mutex:
+			for key, building in list(self._building.items()):
+				if building is future:
+					del self._building[key]
+		if isinstance(outcome, BaseException):
+			future.set_exception(outcome)
+		else:
+			future.set_result(outcome)
+
+	"""
+	Removes every delta
+	"""
+	def clear(self):
+		with self._mutex:
+			self._deltas.clear()
+			self._sizes.clear()
+			self._total = 0
+
+	def __len__(self):
+		return len(self._deltas)
+
+	"""
+	Receives a stream of a version of the file
+	Returns the threading.Lock that the synchronous builds hold while they read it,
+	since builds of different deltas may share it
+	"""
+	def stream_lock(self, stream):
+		with self._mutex:
+			lock = self._stream_locks.get(stream)
+			if lock is None:
+				lock = self._stream_locks[stream] = threading.Lock()
+			return lock
+
+	"""
+	Receives an async stream of a version of the file
+	Returns the asyncio.Lock that the asynchronous builds in the running loop hold
+	while they read it
+	"""
+	def async_stream_lock(self, stream):
+		locks = self._async_stream_locks.setdefault(asyncio.get_running_loop(), weakref.WeakKeyDictionary())
+		lock = locks.get(stream)
+		if lock is None:
+			lock = locks[stream] = asyncio.Lock()
+		return lock
+
+	def _forget(self, key):
+		self._deltas.pop(key, None)
+		self._total -= self._sizes.pop(key, 0)
@@ -0,0 +1,172 @@
+"""
+=== METRICS ===
+Counts what every stage of a sync did and how long it took, to tune the blocksize
+of each kind of file or to export the numbers elsewhere. A Stats object is passed as
+"stats" to block_checksums, get_instructions, get_blocks, patch_local_blocks,
+patch_remote_blocks and patch_remote_stream in either module (or to
+synchronous.parallel_get_instructions), and keeps adding up until it's discarded,
+so one object can follow a whole sync or many of them
+Without it nothing is counted and the hot loops are exactly the same
+"""
+import contextlib
+import time
+
+_DEFAULT_INTERVAL = 1024 * 1024
+
+
+"""
+The totals of a stage: its wall and CPU time in seconds and the bytes it processed
+The CPU time is the process's, so it includes the threads the work is offloaded to
+(and anything else the process ran meanwhile)
+"""
+class Stage:
+	__slots__ = ("wall", "cpu", "bytes")
+
+	def __init__(self):
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.bytes = 0
+
+
+"""
+The statistics of one or more syncs:
+	stages - a dictionary with the Stage of every function by its name
+	weak_hits - windows whose weak hash matched, so their strong hash was calculated
+	matched_blocks - windows whose strong hash matched too
+	strong_false_positives - weak hits that didn't match any block left
+	bytes_hashed, bytes_scanned, bytes_read, bytes_reused, bytes_fetched - the bytes
+	    processed by block_checksums, get_instructions, get_blocks, patch_local_blocks
+	    and patch_remote_blocks respectively
+If "progress" is given, it's called with the name of a stage and the bytes it has
+processed so far every time it processes at least "interval" more
+"""
+class Stats:
+	def __init__(self, progress=None, interval=_DEFAULT_INTERVAL):
+		self.progress = progress
+		self.interval = interval
+		self.stages = {}
+		self.weak_hits = 0
+		self.matched_blocks = 0
+		self._reported = {}
+
+	@property
+	def strong_false_positives(self):
+		return self.weak_hits - self.matched_blocks
+
+	@property
+	def bytes_hashed(self):
+		return self._bytes("block_checksums")
+
+	@property
+	def bytes_scanned(self):
+		return self._bytes("get_instructions")
+
+	@property
+	def bytes_read(self):
+		return self._bytes("get_blocks")
+
+	@property
+	def bytes_reused(self):
+		return self._bytes("patch_local_blocks")
+
+	@property
+	def bytes_fetched(self):
+		return self._bytes("patch_remote_blocks")
+
+	def _bytes(self, name):
+		stage = self.stages.get(name)
+		return stage.bytes if stage is not None else 0
+
+	def _stage(self, name):
+		stage = self.stages.get(name)
+		if stage is None:
+			stage = self.stages[name] = Stage()
+		return stage
+
+	"""
+	Receives the name of a stage
+	Returns a context manager that adds the time spent inside it to that stage
+	"""
+	@contextlib.contextmanager
+	def timing(self, name):
+		stage = self._stage(name)
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield stage
+		finally:
+			stage.wall += time.perf_counter() - wall
+			stage.cpu += time.process_time() - cpu
+
+	"""
+	Receives the name of a stage and a number of bytes
+	Adds them to the stage, reporting the progress if it's due
+	"""
+	def processed(self, name, size):
+		stage = self._stage(name)
+		stage.bytes += size
+		if self.progress is not None and stage.bytes - self._reported.get(name, 0) >= self.interval:
+			self._reported[name] = stage.bytes
+			self.progress(name, stage.bytes)
+
+	"""
+	Receives the number of blocks matched by a scan
+	"""
+	def matched(self, count):
+		self.matched_blocks += count
+
+	"""
+	Receives the number of weak hits of a scan counted elsewhere, like a shard of it
+	"""
+	def hit(self, count):
+		self.weak_hits += count
+
+	"""
+	Receives a strong hash function
+	Returns the same function, counting every call as a weak hit
+	"""
+	def counting(self, strong):
+		def counted(block):
+			self.weak_hits += 1
+			return strong(block)
+		return counted
+
+	"""
+	Returns every statistic in a dictionary of plain numbers, ready to be exported
+	"""
+	def as_dict(self):
+		return {
+			"weak_hits": self.weak_hits,
+			"matched_blocks": self.matched_blocks,
+			"strong_false_positives": self.strong_false_positives,
+			"bytes_hashed": self.bytes_hashed,
+			"bytes_scanned": self.bytes_scanned,
+			"bytes_read": self.bytes_read,
+			"bytes_reused": self.bytes_reused,
+			"bytes_fetched": self.bytes_fetched,
+			"stages": {name: {"wall": stage.wall, "cpu": stage.cpu, "bytes": stage.bytes}
+				for name, stage in self.stages.items()},
+		}
+
+
+"""
+Stands in for the Stats when none are given, so the functions don't have to check:
+it doesn't count anything and doesn't wrap the strong hash function
+"""
+class _NoStats(Stats):
+	def timing(self, name):
+		return contextlib.nullcontext()
+
+	def processed(self, name, size):
+		pass
+
+	def matched(self, count):
+		pass
+
+	def hit(self, count):
+		pass
+
+	def counting(self, strong):
+		return strong
+
+NO_STATS = _NoStats()
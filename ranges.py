@@ -0,0 +1,132 @@
+"""
+=== RANGES ===
+Missing blocks are usually requested from a remote file, where every request
+has a cost of its own. These tools merge the missing blocks into byte ranges
+and split the data of those ranges back into blocks
+Wherever they take a blocksize, they also take a dictionary with the size of every
+block by its offset, for chunks of different sizes (see chunking.chunk_sizes)
+"""
+
+
+"""
+Receives the offsets of the missing blocks (list(remote_instructions.keys())), a blocksize,
+the largest "gap" in bytes worth over-fetching instead of starting a new range and
+optionally the length of the patched file
+Returns a sorted list of (start, end) byte ranges, with exclusive ends, that cover every block
+"""
+def plan_ranges(offsets, blocksize, gap=0, length=None):
+	ranges = []
+	for offset in sorted(offsets):
+		end = offset + block_size(blocksize, offset)
+		if length is not None:
+			end = min(end, length)
+		if ranges and offset - ranges[-1][1] <= gap:
+			ranges[-1][1] = max(ranges[-1][1], end)
+		else:
+			ranges.append([offset, end])
+	return [tuple(r) for r in ranges]
+
+
+"""
+Receives ranges from plan_ranges, a blocksize and the largest "size" of a range in bytes
+Returns the same ranges, cut between blocks into pieces of at most that size
+(or a single block, if the size is smaller). Ranges of chunks aren't cut
+"""
+def cut_ranges(ranges, blocksize, size):
+	if isinstance(blocksize, dict):
+		return list(ranges)
+	step = max(1, size // blocksize) * blocksize
+	return [(start, min(start + step, end)) for first, end in ranges for start in range(first, end, step)]
+
+
+"""
+Receives a blocksize, or a dictionary of block sizes by offset, and the offset of a block
+Returns the size of that block
+"""
+def block_size(blocksize, offset):
+	return blocksize[offset] if isinstance(blocksize, dict) else blocksize
+
+
+"""
+Receives ranges from plan_ranges
+Returns the value of an HTTP Range header requesting all of them
+"""
+def range_header(ranges):
+	return "bytes=" + ",".join(str(start)+"-"+str(end - 1) for start, end in ranges)
+
+
+"""
+Splits the data of the requested ranges back into (offset, block) tuples for
+patch_remote_blocks, without keeping more than the current range in memory
+The data is fed as (start, data) pieces in file order. A piece may be a whole range
+or any part of one, and a piece that doesn't continue the previous one starts a new
+range. Only the last of the offsets can be the last block of the file, so it's
+the only block that may be shorter than the blocksize when its range ends
+"""
+class RangeSplitter:
+	def __init__(self, offsets, blocksize):
+		self.offsets = sorted(offsets)
+		self.blocksize = blocksize
+		self.index = 0
+		self.buffer = bytearray()
+		self.start = 0
+
+	"""
+	Receives the offset and content of the next piece of data
+	Returns a list with the (offset, block) tuples completed by it
+	"""
+	def feed(self, start, data):
+		blocks = []
+		if start != self.start + len(self.buffer):
+			blocks = self._take(True)
+			self.buffer = bytearray()
+			self.start = start
+		self.buffer += data
+		blocks += self._take(False)
+
+		# Drop whatever no pending block needs anymore
+		keep = self.offsets[self.index] if self.index < len(self.offsets) else self.start + len(self.buffer)
+		drop = min(max(0, keep - self.start), len(self.buffer))
+		del self.buffer[:drop]
+		self.start += drop
+		return blocks
+
+	"""
+	Returns the (offset, block) tuples left in the last range
+	Raises a ValueError if the data didn't include every block, or if a range ended
+	inside a block other than the last one (a truncated response)
+	"""
+	def finish(self):
+		blocks = self._take(True)
+		if self.index < len(self.offsets):
+			raise ValueError("No data was received for the block at "+str(self.offsets[self.index]))
+		return blocks
+
+	def _take(self, ended):
+		blocks = []
+		end = self.start + len(self.buffer)
+		while self.index < len(self.offsets):
+			offset = self.offsets[self.index]
+			size = block_size(self.blocksize, offset)
+			if offset >= end or (offset + size > end and not ended):
+				break
+			if offset < self.start:
+				raise ValueError("No data was received for the block at "+str(offset))
+			if offset + size > end and self.index < len(self.offsets) - 1:
+				raise ValueError("The data ended inside the block at "+str(offset))
+			blocks.append((offset, bytes(self.buffer[offset - self.start:offset - self.start + size])))
+			self.index += 1
+		return blocks
+
+
+"""
+! This function is a generator !
+Receives an iterable of (start, data) pieces of the requested ranges (see RangeSplitter),
+the offsets of the missing blocks and a blocksize
+Yields the (offset, block) tuples in those ranges
+"""
+def split_ranges(pieces, offsets, blocksize):
+	splitter = RangeSplitter(offsets, blocksize)
+	for start, data in pieces:
+		yield from splitter.feed(start, data)
+	yield from splitter.finish()
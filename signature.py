@@ -0,0 +1,482 @@
+import copy
+import hashlib
+import struct
+from array import array
+
+import common
+
+# Marks an empty slot in the weak hash index
+_EMPTY = -1
+# Every slot of the weak hash index gets 2 ** _SLOT_BITS bits in the bitmap of
+# unclaimed weak hashes (see SignatureTable.unclaimed_slots)
+_SLOT_BITS = 5
+
+# Binary signature files start with this header, followed by the name of the
+# strong hash algorithm, the whole file digest and then one record per block in file order. Each record is the
+# truncated weak hash (its most significant "weak_bytes" bytes, big-endian)
+# followed by the first "strong_bytes" bytes of the strong hash
+_MAGIC = b"PYZS"
+_VERSION = 2
+_HEADER = struct.Struct(">4sBBBBIQBB")
+HEADER_SIZE = _HEADER.size
+
+
+"""
+A compact replacement for the { weak : { strong : [offsets] } } dictionaries
+returned by block_checksums, meant for signatures with millions of blocks
+Every unique (weak, strong) pair is an "entry", and entries are stored sorted by
+weak hash in packed arrays:
+	weaks - array('I') with the weak hash of each entry, truncated to its most
+	        significant "weak_bytes" bytes
+	digests - bytes with the strong hashes of every entry, truncated to "digest_size" bytes each
+	starts - array('I') where the blocks of entry i are blocks[starts[i]:starts[i+1]]
+	blocks - array('I') with the block numbers (offset / blocksize) of every entry
+	entries - array('I') with the entry of every block number
+The weak hashes are looked up through an open-addressed index in O(1), and the
+(usually single) entries sharing a weak hash are then compared by digest. While
+scanning, every window is first looked up in a bytearray that flags the index slots
+of the weak hashes that still have unclaimed entries (see unclaimed_slots), which is
+as fast as the dictionaries
+The table records the strong hash "algorithm" (see common.strong_hash) its digests were
+made with and how many consecutive blocks must match their weak hashes ("seq_matches",
+see get_instructions), and can also record the "length" and whole file "filehash" of the file it describes
+and the (weak_bytes, strong_bytes) "record_bytes" write_signature keeps by default
+(see tuning.tune_table)
+Like the dictionaries, get_instructions consumes the table: matched entries are
+claimed and stop matching until reset() is called
+"""
+class SignatureTable:
+	def __init__(self, blocksize, weaks, digests, starts, blocks, digest_size=16, weak_bytes=4, length=None, filehash=None, algorithm="md5", seq_matches=1):
+		self.blocksize = blocksize
+		self.algorithm = algorithm
+		self.seq_matches = seq_matches
+		self.digest_size = digest_size
+		self.weak_bytes = weak_bytes
+		self.length = length
+		self.filehash = filehash
+		self.record_bytes = None
+		self._weak_shift = 8 * (4 - weak_bytes)
+		self.weaks = weaks
+		self.digests = bytes(digests)
+		self.starts = starts
+		self.blocks = blocks
+		self.entries = array('I', [0]) * len(blocks)
+		for entry in range(len(weaks)):
+			for i in range(starts[entry], starts[entry + 1]):
+				self.entries[blocks[i]] = entry
+		self.claimed = bytearray(len(weaks))
+		self._live = None
+		self._build_index()
+
+	"""
+	Receives a blocksize, an array('I') with the weak hash of every block in
+	file order and a bytes-like with their strong hashes
+	Returns a SignatureTable for those blocks
+	"""
+	@classmethod
+	def from_blocks(cls, blocksize, weaks, digests, digest_size=16, weak_bytes=4, length=None, filehash=None, algorithm="md5", seq_matches=1):
+		# Sorting by the weak hash alone is cheap, and blocks sharing a weak
+		# hash are rare enough to be ordered by digest afterwards
+		order = sorted(range(len(weaks)), key=weaks.__getitem__)
+		i = 0
+		while i < len(order):
+			j = i + 1
+			while j < len(order) and weaks[order[j]] == weaks[order[i]]:
+				j += 1
+			if j - i > 1:
+				order[i:j] = sorted(order[i:j], key=lambda b: digests[b * digest_size:(b + 1) * digest_size])
+			i = j
+
+		entry_weaks = array('I')
+		entry_digests = bytearray()
+		starts = array('I')
+		blocks = array('I', order)
+		previous = None
+		for i, block in enumerate(order):
+			key = (weaks[block], digests[block * digest_size:(block + 1) * digest_size])
+			if key != previous:
+				entry_weaks.append(key[0])
+				entry_digests += key[1]
+				starts.append(i)
+				previous = key
+		starts.append(len(order))
+		return cls(blocksize, entry_weaks, entry_digests, starts, blocks, digest_size, weak_bytes, length, filehash, algorithm, seq_matches)
+
+	def _build_index(self):
+		size = 8
+		while size < 2 * len(self.weaks):
+			size *= 2
+		self._shift = 32 - (size.bit_length() - 1)
+		self._mask = size - 1
+		self._index = array('i', [_EMPTY]) * size
+		self._groups = 0
+		for entry in range(len(self.weaks)):
+			if entry and self.weaks[entry] == self.weaks[entry - 1]:
+				# Only the first entry of each weak hash is indexed
+				continue
+			self._groups += 1
+			slot = self._slot(self.weaks[entry])
+			while self._index[slot] != _EMPTY:
+				slot = (slot + 1) & self._mask
+			self._index[slot] = entry
+
+	def _slot(self, weak):
+		return ((weak * 2654435761) & 0xffffffff) >> self._shift
+
+	"""
+	Receives a full weak hash
+	Returns the first entry with that weak hash, or -1 if there is none
+	"""
+	def find(self, weak):
+		weak >>= self._weak_shift
+		index = self._index
+		weaks = self.weaks
+		slot = ((weak * 2654435761) & 0xffffffff) >> self._shift
+		entry = index[slot]
+		while entry != _EMPTY:
+			if weaks[entry] == weak:
+				return entry
+			slot = (slot + 1) & self._mask
+			entry = index[slot]
+		return _EMPTY
+
+	def __contains__(self, weak):
+		entry = self.find(weak)
+		return entry != _EMPTY and self._unclaimed(entry)
+
+	# Whether any entry from "entry" on that shares its weak hash is still unclaimed
+	def _unclaimed(self, entry):
+		weak = self.weaks[entry]
+		while entry < len(self.weaks) and self.weaks[entry] == weak:
+			if not self.claimed[entry]:
+				return True
+			entry += 1
+		return False
+
+	# The bit of a truncated weak hash in the bitmap of unclaimed_slots: its slot
+	# in the index, followed by the next _SLOT_BITS bits of the same hash
+	def _bit(self, weak):
+		return ((weak * 2654435761) & 0xffffffff) >> (self._shift - _SLOT_BITS)
+
+	"""
+	Returns a bytearray bitmap with a few bytes per slot of the weak hash index, and
+	the shift that turns a truncated weak hash into its bit (see _bit). The bits of a
+	slot split the weak hashes that start probing there, and a bit is set while any
+	of its weak hashes has unclaimed entries, so a window whose bit is clear can't
+	match. That rules out all but a few percent of the windows for a fraction of the
+	memory a set of the weak hashes would take. It's only built the first time it's
+	asked for, and claims keep it up to date from then on
+	"""
+	def unclaimed_slots(self):
+		if self._live is None:
+			self._live = bytearray(len(self._index) << (_SLOT_BITS - 3))
+			for entry in self._index:
+				if entry != _EMPTY and self._unclaimed(entry):
+					bit = self._bit(self.weaks[entry])
+					self._live[bit >> 3] |= 1 << (bit & 7)
+		return self._live, self._shift - _SLOT_BITS
+
+	"""
+	Iterates over the unique weak hashes, like iterating the dictionaries would
+	"""
+	def __iter__(self):
+		previous = None
+		for weak in self.weaks:
+			if weak != previous:
+				yield weak
+				previous = weak
+
+	def __len__(self):
+		return self._groups
+
+	def digest(self, entry):
+		return self.digests[entry * self.digest_size:(entry + 1) * self.digest_size]
+
+	def offsets(self, entry):
+		return [block * self.blocksize for block in self.blocks[self.starts[entry]:self.starts[entry + 1]]]
+
+	"""
+	Receives a full weak and strong hash
+	Returns the list of offsets of the matching entry and marks it as claimed,
+	or None if there is no unclaimed entry with both hashes
+	"""
+	def claim(self, weak, strong):
+		entry = self.find(weak)
+		if entry == _EMPTY:
+			return None
+		weak >>= self._weak_shift
+		strong = strong[:self.digest_size]
+		first = entry
+		while entry < len(self.weaks) and self.weaks[entry] == weak:
+			if not self.claimed[entry] and self.digest(entry) == strong:
+				self.claimed[entry] = 1
+				if self._live is not None and not self._unclaimed(first):
+					self._forget_bit(self._bit(weak))
+				return self.offsets(entry)
+			entry += 1
+		return None
+
+	# Clears a bit once none of its weak hashes has unclaimed entries. They all start
+	# probing at the same slot, so they are in the run of used slots that starts there
+	def _forget_bit(self, bit):
+		slot = bit >> _SLOT_BITS
+		entry = self._index[slot]
+		while entry != _EMPTY:
+			if self._bit(self.weaks[entry]) == bit and self._unclaimed(entry):
+				return
+			slot = (slot + 1) & self._mask
+			entry = self._index[slot]
+		self._live[bit >> 3] &= ~(1 << (bit & 7)) & 0xff
+
+	"""
+	Receives the full weak hash of a window and the window after it
+	Returns whether any block with that weak hash is followed by a block with the
+	weak hash of that window (see common.SequenceFilter). The last two blocks are
+	accepted on their own weak hash
+	"""
+	def follows(self, weak, window):
+		entry = self.find(weak)
+		if entry == _EMPTY:
+			return False
+		weak >>= self._weak_shift
+		following = common.adler32(window) >> self._weak_shift if len(window) == self.blocksize else None
+		last = len(self.entries) - 2
+		while entry < len(self.weaks) and self.weaks[entry] == weak:
+			for block in self.blocks[self.starts[entry]:self.starts[entry + 1]]:
+				if block >= last or self.weaks[self.entries[block + 1]] == following:
+					return True
+			entry += 1
+		return False
+
+	"""
+	Receives the offset of any block
+	Returns the (weak, strong, offsets) tuple of the entry that block belongs to
+	"""
+	def instruction(self, offset):
+		entry = self.entries[offset // self.blocksize]
+		return (self.weaks[entry], self.digest(entry), self.offsets(entry))
+
+	"""
+	Claims every entry, for an unpatched file that is identical to this one
+	Returns the local instructions (see get_instructions) that keep every block in place
+	"""
+	def claim_all(self):
+		self.claimed = bytearray(b"\x01") * len(self.weaks)
+		self._live = None if self._live is None else bytearray(len(self._live))
+		return sorted((offsets[0], offsets) for offsets in map(self.offsets, range(len(self.weaks))))
+
+	"""
+	Returns the remote instructions (see get_instructions) for every unclaimed entry
+	"""
+	def remote_instructions(self):
+		instructions = {}
+		for entry, claimed in enumerate(self.claimed):
+			if not claimed:
+				offsets = self.offsets(entry)
+				instructions[offsets[0]] = (self.weaks[entry], self.digest(entry), offsets)
+		return instructions
+
+	"""
+	Returns the { weak : { strong : [offsets] } } dictionaries (see block_checksums)
+	with the unclaimed entries of the table
+	"""
+	def to_hashes(self):
+		hashes = {}
+		for entry, claimed in enumerate(self.claimed):
+			if not claimed:
+				hashes.setdefault(self.weaks[entry], {})[self.digest(entry)] = self.offsets(entry)
+		return hashes
+
+	"""
+	Returns a copy of the table that shares its arrays but claims entries on its own
+	"""
+	def copy(self):
+		table = copy.copy(self)
+		table.claimed = bytearray(self.claimed)
+		table._live = None if self._live is None else bytearray(self._live)
+		return table
+
+	"""
+	Unclaims every entry so the table can be used for another get_instructions
+	"""
+	def reset(self):
+		self.claimed = bytearray(len(self.weaks))
+		self._live = None
+
+
+"""
+Accumulates the hashes of consecutive blocks without keeping any per-block
+Python objects around, and builds a SignatureTable out of them
+Also keeps track of the file's length and whole file hash
+"""
+class TableBuilder:
+	def __init__(self, blocksize, algorithm=None, seq_matches=1):
+		self.blocksize = blocksize
+		self.seq_matches = seq_matches
+		self.algorithm = common.hash_algorithm(algorithm, None)
+		self.strong = common.strong_hash(self.algorithm)
+		self.weaks = array('I')
+		self.digests = bytearray()
+		self.length = 0
+		self.filehash = hashlib.md5()
+
+	def add(self, block):
+		self.weaks.append(common.adler32(block))
+		self.digests += self.strong(block)
+		self.length += len(block)
+		self.filehash.update(block)
+
+	def build(self):
+		return SignatureTable.from_blocks(self.blocksize, self.weaks, self.digests, len(self.strong(b"")),
+			length=self.length, filehash=self.filehash.digest(), algorithm=self.algorithm, seq_matches=self.seq_matches)
+
+
+"""
+Same as TableBuilder, for a file that was modified in place since "table" was built
+from it. Only the blocks that overlap the "modified" list of (start, end) byte ranges,
+with exclusive ends, or that weren't full blocks of the previous file are hashed again,
+and every other one is copied from the table. That saves the weak and strong hashes
+of the unmodified blocks, but not reading them: every block is still added, since
+the whole file hash is calculated over all of them. It's what verify_file, the
+precheck of get_instructions and fanout.fingerprint compare, so an updated table
+can't record a stale or missing one
+"""
+class TableUpdater(TableBuilder):
+	def __init__(self, table, modified):
+		super().__init__(table.blocksize, table.algorithm, table.seq_matches)
+		if table.length is None or table.weak_bytes != 4 or table.digest_size != len(self.strong(b"")):
+			raise ValueError("Only tables with their length and full hashes can be updated")
+		self.table = table
+		self.full_blocks = table.length // table.blocksize
+		self.modified = sorted(modified)
+		self.next_range = 0
+
+	def add(self, block):
+		number = len(self.weaks)
+		start = number * self.blocksize
+		end = start + len(block)
+		# Skip the ranges that end before this block
+		while self.next_range < len(self.modified) and self.modified[self.next_range][1] <= start:
+			self.next_range += 1
+		stale = (number >= self.full_blocks or len(block) != self.blocksize or
+			(self.next_range < len(self.modified) and self.modified[self.next_range][0] < end))
+		if stale:
+			super().add(block)
+			return
+		entry = self.table.entries[number]
+		self.weaks.append(self.table.weaks[entry])
+		self.digests += self.table.digest(entry)
+		self.length += len(block)
+		self.filehash.update(block)
+
+
+"""
+Receives a SignatureTable and the number of bytes to keep from each weak and strong hash
+Returns them, or else the table's record_bytes, or else every byte
+"""
+def record_bytes(table, weak_bytes=None, strong_bytes=None):
+	default_weak, default_strong = table.record_bytes or (table.weak_bytes, table.digest_size)
+	return weak_bytes or default_weak, strong_bytes or default_strong
+
+
+"""
+Receives a SignatureTable and the number of bytes to keep from each weak and strong hash
+(see record_bytes)
+Returns the header of a binary signature file for that table
+"""
+def encode_header(table, weak_bytes=None, strong_bytes=None):
+	weak_bytes, strong_bytes = record_bytes(table, weak_bytes, strong_bytes)
+	if not 1 <= weak_bytes <= table.weak_bytes:
+		raise ValueError("weak_bytes must be between 1 and "+str(table.weak_bytes))
+	if not 2 <= strong_bytes <= table.digest_size:
+		raise ValueError("strong_bytes must be between 2 and "+str(table.digest_size))
+	if table.length is None:
+		raise ValueError("The table doesn't record the length of its file")
+	filehash = table.filehash or b""
+	algorithm = table.algorithm.encode("ascii")
+	return _HEADER.pack(_MAGIC, _VERSION, table.seq_matches, weak_bytes, strong_bytes,
+		table.blocksize, table.length, len(algorithm), len(filehash)) + algorithm + filehash
+
+
+"""
+Receives the first HEADER_SIZE bytes of a binary signature file
+Returns a dictionary with its fields, where "algorithm_size" is the length of the
+algorithm name that follows and "digest_size" the number of bytes of the whole file
+hash after it
+"""
+def decode_header(data):
+	if len(data) != HEADER_SIZE:
+		raise ValueError("The signature file is truncated")
+	magic, version, seq_matches, weak_bytes, strong_bytes, blocksize, length, algorithm_size, digest_size = _HEADER.unpack(data)
+	if magic != _MAGIC:
+		raise ValueError("Not a signature file")
+	if version != _VERSION:
+		raise ValueError("Unsupported signature file version "+str(version))
+	return {"seq_matches": seq_matches, "weak_bytes": weak_bytes, "strong_bytes": strong_bytes,
+		"blocksize": blocksize, "length": length, "algorithm_size": algorithm_size, "digest_size": digest_size}
+
+
+"""
+Receives a decoded header
+Returns the number of blocks and the size of each block record
+"""
+def record_layout(header):
+	count = -(-header["length"] // header["blocksize"])
+	return count, header["weak_bytes"] + header["strong_bytes"]
+
+
+"""
+Receives a SignatureTable, a range of block numbers and the truncation sizes (see record_bytes)
+Returns the records of those blocks, in file order
+"""
+def encode_records(table, start, stop, weak_bytes=None, strong_bytes=None):
+	weak_bytes, strong_bytes = record_bytes(table, weak_bytes, strong_bytes)
+	shift = 8 * (table.weak_bytes - weak_bytes)
+	records = bytearray()
+	for block in range(start, stop):
+		entry = table.entries[block]
+		records += (table.weaks[entry] >> shift).to_bytes(weak_bytes, "big")
+		records += table.digests[entry * table.digest_size:entry * table.digest_size + strong_bytes]
+	return bytes(records)
+
+
+"""
+Collects the records of a binary signature file as they are read and builds
+the SignatureTable they describe
+"""
+class TableReader:
+	def __init__(self, header, filehash, algorithm="md5"):
+		self.header = header
+		self.filehash = filehash
+		self.algorithm = algorithm
+		self.count, self.record_size = record_layout(header)
+		self.weaks = array('I')
+		self.digests = bytearray()
+		self.pending = b""
+
+	"""
+	Returns how many bytes of records are still expected
+	"""
+	def remaining(self):
+		return (self.count - len(self.weaks)) * self.record_size - len(self.pending)
+
+	"""
+	Receives the next bytes of the records, which don't need to end on a record boundary
+	"""
+	def feed(self, data):
+		weak_bytes = self.header["weak_bytes"]
+		data = self.pending + data
+		end = len(data) - len(data) % self.record_size
+		view = memoryview(data)
+		for start in range(0, end, self.record_size):
+			record = view[start:start + self.record_size]
+			self.weaks.append(int.from_bytes(record[:weak_bytes], "big"))
+			self.digests += record[weak_bytes:]
+		self.pending = data[end:]
+
+	def build(self):
+		if self.remaining() or self.pending:
+			raise ValueError("The signature file is truncated")
+		header = self.header
+		return SignatureTable.from_blocks(header["blocksize"], self.weaks, self.digests,
+			header["strong_bytes"], header["weak_bytes"], header["length"], self.filehash, self.algorithm, header["seq_matches"])
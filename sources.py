@@ -0,0 +1,185 @@
+"""
+=== SOURCES ===
+Where asynchronous.fetch_blocks gets the missing blocks from. A source is any object
+with a coroutine fetch(start, end) returning the bytes of the patched file in that
+range, which may only come out shorter at the end of the file. Each fetch is
+independent of the others, so several of them can be in flight at once
+"""
+import asyncio
+import http.client
+import os
+import threading
+import urllib.error
+import urllib.parse
+
+import ranges
+
+# Failures worth fetching a range again for, along with some HTTP errors (see transient)
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, http.client.IncompleteRead, http.client.RemoteDisconnected)
+# The answers of a server that is busy or failing for now, rather than refusing the request
+TRANSIENT_STATUSES = frozenset([429] + list(range(500, 600)))
+# Statuses whose Location is followed, up to _MAX_REDIRECTS times per range
+_REDIRECTS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+
+
+"""
+Receives an exception raised while fetching a range
+Returns whether the range is worth fetching again: for TRANSIENT_ERRORS, an
+urllib.error.HTTPError with one of TRANSIENT_STATUSES, or an urllib.error.URLError
+caused by one of TRANSIENT_ERRORS. Anything else, like a missing file or a 404,
+fails the same way however many times it's tried
+"""
+def transient(error):
+	if isinstance(error, urllib.error.HTTPError):
+		return error.code in TRANSIENT_STATUSES
+	if isinstance(error, urllib.error.URLError):
+		return isinstance(error.reason, TRANSIENT_ERRORS)
+	return isinstance(error, TRANSIENT_ERRORS)
+
+
+"""
+A local file, read in "executor" (the event loop's default executor if None) so that
+concurrent fetches don't block the loop. They don't share a file position either: they
+use os.pread where it exists, or else a file object of their own
+"""
+class FileSource:
+	def __init__(self, path, executor=None):
+		self.path = path
+		self.executor = executor
+		self._fd = None
+
+	async def fetch(self, start, end):
+		if self._fd is None and hasattr(os, "pread"):
+			self._fd = os.open(self.path, os.O_RDONLY)
+		return await asyncio.get_running_loop().run_in_executor(self.executor, self._read, start, end)
+
+	"""
+	Closes the file, if it was opened
+	"""
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+	def _read(self, start, end):
+		if self._fd is None:
+			with open(self.path, "rb") as f:
+				f.seek(start)
+				return f.read(end - start)
+		data = b""
+		while start + len(data) < end:
+			piece = os.pread(self._fd, end - start - len(data), start + len(data))
+			if not piece:
+				break
+			data += piece
+		return data
+
+
+"""
+A file served over HTTP(S) by a server that supports Range requests
+Every range is requested on its own in "executor" (the event loop's default executor
+if None), along with any extra "headers". The connections are kept alive and reused
+by the next ranges, so only as many are opened as there are fetches in flight
+Redirects are followed. An error status raises an urllib.error.HTTPError (see transient),
+and any other answer but the requested range raises a ValueError
+"""
+class HTTPSource:
+	def __init__(self, url, headers=None, timeout=30, executor=None):
+		self.url = url
+		self.headers = dict(headers or {})
+		self.timeout = timeout
+		self.executor = executor
+		# The idle connections by (scheme, host)
+		self._idle = {}
+		self._lock = threading.Lock()
+
+	async def fetch(self, start, end):
+		return await asyncio.get_running_loop().run_in_executor(self.executor, self._get, start, end)
+
+	"""
+	Closes the idle connections
+	"""
+	def close(self):
+		with self._lock:
+			idle, self._idle = self._idle, {}
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+	def _get(self, start, end):
+		headers = dict(self.headers, Range=ranges.range_header([(start, end)]))
+		url = self.url
+		for _ in range(_MAX_REDIRECTS + 1):
+			status, reason, location, data = self._request(url, headers)
+			if status not in _REDIRECTS or location is None:
+				break
+			url = urllib.parse.urljoin(url, location)
+		if status >= 400 or status in _REDIRECTS:
+			raise urllib.error.HTTPError(url, status, reason, None, None)
+		if status != 206:
+			raise ValueError("The server didn't answer with a range, but with status "+str(status))
+		return data
+
+	"""
+	Receives a URL and the headers of the request
+	Returns the status, reason, Location header and body of the answer, read with an
+	idle connection to its host or a new one. An idle connection may have been closed
+	by the server in the meantime, so if it fails before answering, a new one is tried
+	"""
+	def _request(self, url, headers):
+		parts = urllib.parse.urlsplit(url)
+		host = (parts.scheme, parts.netloc)
+		target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+		while True:
+			connection, reused = self._connection(host)
+			try:
+				connection.request("GET", target, headers=headers)
+				response = connection.getresponse()
+			except (ConnectionError, http.client.BadStatusLine):
+				connection.close()
+				if reused:
+					continue
+				raise
+			except BaseException:
+				connection.close()
+				raise
+			try:
+				data = response.read()
+			except BaseException:
+				connection.close()
+				raise
+			if response.will_close:
+				connection.close()
+			else:
+				with self._lock:
+					self._idle.setdefault(host, []).append(connection)
+			return response.status, response.reason, response.getheader("Location"), data
+
+	def _connection(self, host):
+		with self._lock:
+			idle = self._idle.get(host)
+			if idle:
+				return idle.pop(), True
+		scheme, netloc = host
+		if scheme == "https":
+			return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+		if scheme == "http":
+			return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+		raise ValueError("Only http and https URLs are supported, not "+repr(scheme))
+
+
+"""
+A function of (start, end) that returns the bytes in that range. Coroutine functions
+are awaited, and regular functions are called in "executor" (the event loop's
+default executor if None) since they're expected to block
+"""
+class CallableSource:
+	def __init__(self, function, executor=None):
+		self.function = function
+		self.executor = executor
+
+	async def fetch(self, start, end):
+		if asyncio.iscoroutinefunction(self.function):
+			return await self.function(start, end)
+		return await asyncio.get_running_loop().run_in_executor(self.executor, self.function, start, end)
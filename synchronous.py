@@ -1,6 +1,24 @@
+import contextlib
+import hashlib
+import mmap
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import chunking
 import common
+import core
+import fanout
+import metrics
+import ranges
+import signature
+import transfer
 
 _DEFAULT_BLOCKSIZE = 4096
+_DEFAULT_CHUNKSIZE = 4 * 1024 * 1024
+# Number of block records written or read at once in signature files
+_SIGNATURE_BATCH = 65536
 
 
 """
@@ -14,33 +32,265 @@ Returns a dictionary of dictionaries, like so:
 Consider that a weak hash can have several matching strong hashes, and every
 (weak hash, strong hash) block pair can occur on several parts of the file,
 but we only need one offset for retrieving that block
+If "compact" is set to True, the hashes are returned as a signature.SignatureTable
+instead, which stores them in packed arrays and can be used in place of the dictionaries
+The strong hashes are calculated with "algorithm" (see common.strong_hash), and
+"seq_matches" sets how many consecutive blocks get_instructions requires to match
+their weak hashes. The table records both, but the dictionaries don't, so in that
+case they have to be given to get_instructions (and the algorithm to patch_remote_blocks) too
+With a cache.SignatureCache as "cache", the signature of a regular file is only
+calculated if the file changed since it was cached. If the (start, end) byte ranges
+"modified" in place since then are given, only the blocks in them are hashed again
+With blocksize="auto" it's chosen from the size of the stream (see choose_blocksize,
+which is given the "previous" table), and the table records it along with the
+checksum lengths write_signature keeps (see tuning.tune_table). Only the table can
+record them, so it requires compact=True
+The time and bytes are added to the "block_checksums" stage of "stats" (see metrics.Stats)
 """
-def block_checksums(instream, blocksize=_DEFAULT_BLOCKSIZE):
-	hashes = {}
-	block = instream.read(blocksize)
-	offset = 0
-	while block:
-		weak = common.adler32(block)
-		strong = common.stronghash(block)
-		try:
-			hashes[weak][strong]
-		except KeyError:
-			hashes[weak] = {}
+def block_checksums(instream, blocksize=_DEFAULT_BLOCKSIZE, compact=False, algorithm=None, seq_matches=1, cache=None, modified=None, stats=None, previous=None):
+	stats = stats or metrics.NO_STATS
+	build = core.SignatureBuild(blocksize, compact, algorithm, seq_matches)
+	if build.auto:
+		build.blocksize = choose_blocksize(instream, previous, build.seq_matches)
+	if cache is not None:
+		cached = build.cached(*cache.lookup(instream, build.blocksize, common.hash_algorithm(algorithm, None), build.seq_matches, modified))
+		if cached is not None:
+			return cached
+	hasher = build.hasher()
+	# Read whole blocks at a time
+	chunksize = max(1, _DEFAULT_CHUNKSIZE // build.blocksize) * build.blocksize
+	with stats.timing("block_checksums"):
+		for chunk in iter(lambda: instream.read(chunksize), b""):
+			hasher.feed(chunk)
+			stats.processed("block_checksums", len(chunk))
 
-		try:
-			hashes[weak][strong].append(offset)
-		except KeyError:
-			hashes[weak][strong] = [offset]
+		count, hashes = hasher.finish()
+	if build.key is not None:
+		cache.put(build.key, hashes)
+	return build.result(count, hashes)
+
+
+"""
+Receives a readable stream whose size can be told (see tuning.auto_blocksize)
+Returns the blocksize for its signature. Given the signature.SignatureTable of the
+previous version of the file, "samples" windows of the stream are compared with it
+and the blocksize is refined for the edits found (see tuning.refine_blocksize).
+The stream is left where it was
+Raises a ValueError if the size of the stream can't be told
+"""
+def choose_blocksize(instream, previous=None, seq_matches=1, samples=64):
+	chooser = core.BlocksizeChooser(_stream_size(instream), previous, seq_matches, samples)
+	if not chooser.offsets:
+		return chooser.blocksize
+	position = instream.tell()
+	windows = []
+	for offset in chooser.offsets:
+		instream.seek(offset)
+		windows.append(_read_exactly(instream, chooser.window))
+	instream.seek(position)
+	return chooser.choose(windows)
+
+
+"""
+Receives the path of a file
+Same as block_checksums, but the file is split into block-aligned ranges which are
+hashed in parallel by "workers" processes (os.cpu_count() by default), or by
+the given concurrent.futures "executor"
+The partial results are merged in file order, so the offsets end up in the same
+order as with block_checksums
+The whole file hash of a table can't be split between the workers, so it's read
+through once more while they run. With digest=False it's left out instead, which
+keeps the speedup for many workers but leaves the table without the digest that
+verify_file and the precheck of get_instructions need
+"""
+def parallel_block_checksums(path, blocksize=_DEFAULT_BLOCKSIZE, workers=None, compact=False, executor=None, algorithm=None, seq_matches=1, digest=True):
+	algorithm = common.hash_algorithm(algorithm, None)
+	length = os.path.getsize(path)
+	count = -(-length // blocksize)
+	workers = workers or os.cpu_count() or 1
+	# A few ranges per worker evens out the load between them
+	per_range = max(1, -(-count // (workers * 4)))
+	starts = [block * blocksize for block in range(0, count, per_range)]
+	stops = [min(start + per_range * blocksize, length) for start in starts]
+
+	pool = executor or ProcessPoolExecutor(workers)
+	try:
+		results = pool.map(_range_checksums, repeat(path), repeat(blocksize), starts, stops, repeat(algorithm))
+		filehash = None
+		if compact and digest:
+			# The whole file hash can't be split, so calculate it while the workers run
+			with open(path, "rb") as f:
+				filehash = file_digest(f)[1]
+
+		weaks = array('I')
+		digests = bytearray()
+		hashes = {}
+		offset = 0
+		for range_weaks, range_digests in results:
+			if compact:
+				weaks += range_weaks
+				digests += range_digests
+				continue
+			size = len(range_digests) // max(1, len(range_weaks))
+			for i, weak in enumerate(range_weaks):
+				common.add_block_checksums(hashes, weak, range_digests[i * size:(i + 1) * size], offset)
+				offset += blocksize
+	finally:
+		if executor is None:
+			pool.shutdown()
+
+	if compact:
+		hashes = signature.SignatureTable.from_blocks(blocksize, weaks, digests,
+			len(common.strong_hash(algorithm)(b"")), length=length, filehash=filehash, algorithm=algorithm,
+			seq_matches=common.sequence_matches(seq_matches, None))
+	# The same float as block_checksums
+	return float(count), hashes
+
+
+"""
+Receives the path of a file, a blocksize, a block-aligned range of that file and
+the strong hash algorithm
+Returns an array('I') with the weak hash of every block in that range and
+a bytes object with their strong hashes
+"""
+def _range_checksums(path, blocksize, start, stop, algorithm="md5"):
+	strong = common.strong_hash(algorithm)
+	weaks = array('I')
+	digests = bytearray()
+	# Read whole blocks at a time
+	chunksize = max(1, _DEFAULT_CHUNKSIZE // blocksize) * blocksize
+	with open(path, "rb") as f:
+		while start < stop:
+			chunk = _pread(f, min(chunksize, stop - start), start)
+			if not chunk:
+				break
+			view = memoryview(chunk)
+			for i in range(0, len(chunk), blocksize):
+				block = view[i:i + blocksize]
+				weaks.append(common.adler32(block))
+				digests += strong(block)
+			start += len(chunk)
+	return weaks, bytes(digests)
+
+
+"""
+Receives an open file, a size and an offset
+Returns up to "size" bytes at that offset, without moving the file position where os.pread exists
+"""
+def _pread(f, size, offset):
+	if hasattr(os, "pread"):
+		return os.pread(f.fileno(), size, offset)
+	f.seek(offset)
+	return f.read(size)
+
+
+"""
+Receives a writable outstream and a signature.SignatureTable
+Writes the table as a binary signature file, keeping only the most significant
+"weak_bytes" of every weak hash and the first "strong_bytes" of every strong hash
+(by default the table's record_bytes, chosen with blocksize="auto", or else all of it)
+"""
+def write_signature(outstream, table, weak_bytes=None, strong_bytes=None):
+	outstream.write(signature.encode_header(table, weak_bytes, strong_bytes))
+	count = len(table.entries)
+	for start in range(0, count, _SIGNATURE_BATCH):
+		stop = min(start + _SIGNATURE_BATCH, count)
+		outstream.write(signature.encode_records(table, start, stop, weak_bytes, strong_bytes))
+
+
+"""
+Receives a readable instream positioned at the start of a binary signature file
+Returns the signature.SignatureTable it describes
+"""
+def read_signature(instream):
+	header = signature.decode_header(_read_exactly(instream, signature.HEADER_SIZE))
+	algorithm = _read_exactly(instream, header["algorithm_size"]).decode("ascii")
+	filehash = _read_exactly(instream, header["digest_size"])
+	reader = signature.TableReader(header, filehash, algorithm)
+	while reader.remaining():
+		data = instream.read(min(reader.remaining(), _SIGNATURE_BATCH * reader.record_size))
+		if not data:
+			break
+		reader.feed(data)
+	return reader.build()
+
+
+"""
+Receives a readable instream and a size
+Returns exactly that many bytes, or less if the stream ended first
+"""
+def _read_exactly(instream, size):
+	data = b""
+	while len(data) < size:
+		chunk = instream.read(size - len(data))
+		if not chunk:
+			break
+		data += chunk
+	return data
+
+
+"""
+Receives a readable stream
+Returns its length and whole file digest, like the ones recorded by a signature.SignatureTable
+"""
+def file_digest(instream):
+	filehash = hashlib.md5()
+	length = 0
+	for chunk in iter(lambda: instream.read(_DEFAULT_CHUNKSIZE), b""):
+		filehash.update(chunk)
+		length += len(chunk)
+	return length, filehash.digest()
+
+
+"""
+Receives a readable stream, the signature.SignatureTable of a file and optionally
+the already known whole file "digest" of the stream (see file_digest)
+Returns whether the stream is identical to that file. The lengths are compared
+first, so a file of a different size is never read. Use it to confirm the result
+of a patch, or to skip the whole patch when nothing changed
+"""
+def verify_file(instream, remote_hashes, digest=None):
+	length, filehash = core.recorded_digest(remote_hashes)
+	size = _stream_size(instream)
+	if size is not None and size != length:
+		return False
+	if digest is None:
+		size, digest = file_digest(instream)
+	return size in (None, length) and digest == filehash
 
-		offset += blocksize
-		block = instream.read(blocksize)
 
-	return offset/blocksize,hashes
+"""
+Receives a stream
+Returns its size without reading it, or None if that isn't possible
+"""
+def _stream_size(stream):
+	try:
+		return os.fstat(stream.fileno()).st_size
+	except (AttributeError, OSError, ValueError):
+		pass
+	try:
+		position = stream.tell()
+		size = stream.seek(0, os.SEEK_END)
+		stream.seek(position)
+		return size
+	except (AttributeError, OSError, ValueError):
+		return None
 
 
 """
 Used by the system with an unpatched file upon receiving a hash blueprint of the patched file
-Receives an aiofiles input stream and set of hashes for a patched file
+Receives a readable input stream and set of hashes for a patched file
+The stream is read in chunks of "chunksize" bytes and scanned with "engine"
+(see common.get_engine). Strong hashes are calculated with "algorithm", which defaults
+to the one recorded by a signature.SignatureTable or otherwise "md5"
+With "seq_matches" set to 2 (or recorded by the table), a block is only matched if
+the window after it also matches the weak hash of the next block, so the strong hash
+is rarely calculated in vain, even with small blocks
+If "precheck" is set to True or the whole file "digest" of the unpatched file is
+given (see file_digest), and the remote hashes record the length and digest of the
+patched file (a signature.SignatureTable), identical files are recognized before
+scanning and every block is kept in place. Without the digest the stream has to be
+seekable, since it's read once to calculate it
 Returns:
 	1 - A list of tuples where the first element is the local offset and the second
 	    is a list of final offsets
@@ -49,117 +299,605 @@ Returns:
 	    tuples with its (weak, strong, offsets)
 	    464 : (598213681, b'\x80\xfd\xa7T[\x1f\xc3\xf7\n\xf9V\xe7\xcb\xdf3\xbf', [464, 480]) 
 The blocks needed to request can be obtained with list(remote_instructions.keys())
+The time, bytes, weak hits and matches are added to the "get_instructions" stage of
+"stats" (see metrics.Stats)
 """
-def get_instructions(datastream, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE):
-	match = True
-	local_offset = -blocksize
-	local_instructions = []
-
-	while True:
-		if match and datastream is not None:
-			# Whenever there is a match or the loop is running for the first
-			# time, populate the window using weakchecksum instead of rolling
-			# through every single byte which takes at least twice as long.
-			window = bytearray(datastream.read(blocksize))
-			local_offset += blocksize
-			checksum = common.adler32(window)
-			match = False
-
-		if checksum in remote_hashes:
-			# Matched the weak hash
-			strong = common.stronghash(window)
-			try:
-				remote_offset = remote_hashes[checksum][strong]
-				# Matched the strong hash too, so the local block matches to a remote block
-				match = True
-				local_instructions.append((local_offset, remote_offset))
-
-				# After the block match we don't care about this block anymore,
-				# so remove it from the dictionary
-				del remote_hashes[checksum][strong]
-				if not remote_hashes[checksum]: # empty dicts evaluate to false
-					del remote_hashes[checksum]
-			except KeyError:
-				# Did not match the strong hash
-				pass
-
-		if not match:
-			# The current block wasn't matched
-			if datastream:
-				try:
-					# Get the next byte and affix to the window
-					newbyte = ord(datastream.read(1))
-					window.append(newbyte)
-				except TypeError:
-					# No more data from the file; the window will slowly shrink.
-					# "newbyte" needs to be zero from here on to keep the checksum correct.
-					newbyte = 0 # Not necessary to add to the window
-					tailsize = datastream.tell() % blocksize
-					datastream = None
-
-			if datastream is None and len(window) <= tailsize:
-				# The likelihood that any blocks will match after this is
-				# nearly nil so call it quits.
-				break
+def get_instructions(datastream, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE, chunksize=_DEFAULT_CHUNKSIZE, engine=None, algorithm=None, seq_matches=None, precheck=False, digest=None, stats=None):
+	stats = stats or metrics.NO_STATS
+	algorithm = common.hash_algorithm(algorithm, remote_hashes)
+	with stats.timing("get_instructions"):
+		if (precheck or digest is not None) and _identical(datastream, remote_hashes, digest):
+			local_instructions, remote_instructions = remote_hashes.claim_all(), common.Instructions((), algorithm)
+			# The digest stands for the whole file, and every block matched, so every
+			# block counts as a weak hit too and none of them was a false positive
+			stats.processed("get_instructions", remote_hashes.length)
+			stats.hit(len(local_instructions))
+		else:
+			scanner = core.DeltaScanner(remote_hashes, blocksize, engine, algorithm, seq_matches, stats=stats)
+			for chunk in iter(lambda: datastream.read(chunksize), b""):
+				scanner.feed(chunk)
+				stats.processed("get_instructions", len(chunk))
+			local_instructions, remote_instructions = scanner.finish()
+	stats.matched(len(local_instructions))
+	return local_instructions, remote_instructions
 
-			# Remove the first byte from the window and cheaply calculate 
-			# the new checksum for it using the previous checksum
-			oldbyte = window.pop(0)
-			local_offset += 1
-			checksum = common.adler32_roll(checksum, oldbyte, newbyte, blocksize)
 
-	# Now put the block offsets in a dictionary where the key is the first offset
-	remote_instructions = { offsets[0] : (weak, strong, offsets)
-		for weak, strongs in remote_hashes.items()
-		for strong, offsets in strongs.items() }
+"""
+Receives the unpatched datastream, the remote hashes and the cached digest, if any
+Returns whether the unpatched file is identical to the patched one, leaving the
+stream where it was. It's False whenever that can't be told cheaply
+"""
+def _identical(datastream, remote_hashes, digest):
+	try:
+		length, filehash = core.recorded_digest(remote_hashes)
+	except ValueError:
+		return False
+	if _stream_size(datastream) != length:
+		return False
+	if digest is None:
+		position = datastream.tell()
+		digest = file_digest(datastream)[1]
+		datastream.seek(position)
+	return digest == filehash
+
+
+"""
+Receives the path of an unpatched file and the set of hashes for a patched file
+Same as get_instructions, but the file is split into one shard per worker (os.cpu_count()
+by default) and the shards are scanned in parallel by processes, or by the given
+concurrent.futures "executor". Shards overlap by seq_matches*blocksize-1 bytes so that every
+window is scanned by exactly one of them
+Each worker scans with its own copy of the hashes, so remote_hashes is left untouched,
+and the results are reconciled in file order: a match is dropped if it overlaps the
+previous one or if its remote block was already claimed by an earlier shard. This can
+miss a few matches that the sequential scan would find right after a dropped one
+With a metrics.Stats as "stats", every shard counts its own weak hits and they're
+added up once all of them are done, while the matches are counted after reconciling
+"""
+def parallel_get_instructions(path, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE, workers=None, engine=None, executor=None, chunksize=_DEFAULT_CHUNKSIZE, algorithm=None, seq_matches=None, stats=None):
+	stats = stats or metrics.NO_STATS
+	algorithm = common.hash_algorithm(algorithm, remote_hashes)
+	seq_matches = common.sequence_matches(seq_matches, remote_hashes)
+	length = os.path.getsize(path)
+	workers = workers or os.cpu_count() or 1
+	shardsize = max(blocksize, -(-length // workers))
+	starts = list(range(0, length, shardsize)) or [0]
+	# Each shard reads enough to complete the windows starting in it (and
+	# the windows after them with seq_matches), and only the last one
+	# reaches the end of the file
+	stops = [min(start + shardsize + seq_matches * blocksize - 1, length) for start in starts]
+	eofs = [False] * (len(starts) - 1) + [True]
+
+	counting = stats is not metrics.NO_STATS
+	with stats.timing("get_instructions"):
+		pool = executor or ProcessPoolExecutor(workers)
+		try:
+			results = list(pool.map(_shard_instructions, repeat(path), repeat(remote_hashes), repeat(blocksize),
+				starts, stops, eofs, repeat(engine), repeat(chunksize), repeat(algorithm), repeat(seq_matches), repeat(counting)))
+		finally:
+			if executor is None:
+				pool.shutdown()
 
+		remote_instructions = common.remote_instructions(remote_hashes, algorithm)
+		local_instructions = []
+		resume = 0
+		for shard_instructions, weak_hits in results:
+			stats.hit(weak_hits)
+			for local_offset, offsets in shard_instructions:
+				if local_offset < resume or offsets[0] not in remote_instructions:
+					continue
+				del remote_instructions[offsets[0]]
+				local_instructions.append((local_offset, offsets))
+				resume = local_offset + blocksize
+		stats.processed("get_instructions", length)
+	stats.matched(len(local_instructions))
 	return local_instructions, remote_instructions
 
 
+"""
+Receives the path of the unpatched file, the remote hashes, a blocksize, the range
+of the file to scan, whether that range reaches the end of the file, the engine,
+the strong hash algorithm, seq_matches and whether to count the weak hits
+Returns the local instructions for that range, scanned with a copy of the hashes, and
+its weak hits (0 if they aren't counted). Every shard counts into its own Stats, so
+they can run in threads as well as in processes
+"""
+def _shard_instructions(path, remote_hashes, blocksize, start, stop, eof, engine, chunksize, algorithm="md5", seq_matches=1, counting=False):
+	if isinstance(remote_hashes, dict):
+		remote_hashes = { weak : dict(strongs) for weak, strongs in remote_hashes.items() }
+	else:
+		remote_hashes = remote_hashes.copy()
+	stats = metrics.Stats() if counting else None
+	scanner = core.DeltaScanner(remote_hashes, blocksize, engine, algorithm, seq_matches, start, stats)
+
+	with open(path, "rb") as f:
+		while start < stop:
+			chunk = _pread(f, min(chunksize, stop - start), start)
+			if not chunk:
+				break
+			scanner.feed(chunk)
+			start += len(chunk)
+	if eof:
+		scanner.flush()
+	return scanner.local_instructions, stats.weak_hits if counting else 0
+
+
+"""
+Receives several unpatched files, the seeds, and the hashes of the patched file
+The seeds can be a dictionary of readable streams or paths by any seed id, or a list
+of them whose ids are their positions. They are scanned in that order (see
+get_instructions for the other parameters), every block is taken from the first seed
+that has it, and the seeds after the one that leaves no block missing aren't read
+Returns
+	1 - A dictionary with the local instructions (see get_instructions) of every seed
+	    that has any blocks, by seed id, for patch_seed_blocks
+	2 - The remote instructions of the blocks no seed has
+"""
+def get_seed_instructions(seeds, remote_hashes, blocksize=_DEFAULT_BLOCKSIZE, chunksize=_DEFAULT_CHUNKSIZE, engine=None, algorithm=None, seq_matches=None):
+	seeds = core.seed_dict(seeds)
+	seeder = core.SeedScanner(remote_hashes, blocksize, seeds, engine, algorithm, seq_matches)
+	for seed_id, seed in seeds.items():
+		if seeder.complete():
+			break
+		scanner = seeder.scanners[seed_id]
+		with _open_readable(seed) as stream:
+			chunk = stream.read(chunksize)
+			while chunk:
+				scanner.feed(chunk)
+				chunk = stream.read(chunksize)
+		scanner.flush()
+	return seeder.finish()
+
+
+def _open_readable(source):
+	if isinstance(source, (str, bytes, os.PathLike)):
+		return open(source, "rb")
+	return contextlib.nullcontext(source)
+
+
+"""
+Receives a readable stream
+Returns the number of chunks and the chunking.ChunkHashes of its content-defined chunks
+(see chunking.py), which are between "min_size" and "max_size" bytes and "avg_size"
+on average, with the strong hashes calculated with "algorithm" (see common.strong_hash)
+"engine" is None to cut the chunks in pure Python, or "numpy" (see chunking.Chunker)
+"""
+def chunk_checksums(instream, min_size=2048, avg_size=8192, max_size=65536, algorithm=None, engine=None):
+	hasher = chunking.ChunkHasher(min_size, avg_size, max_size, algorithm, engine)
+	chunk = instream.read(_DEFAULT_CHUNKSIZE)
+	while chunk:
+		hasher.feed(chunk)
+		chunk = instream.read(_DEFAULT_CHUNKSIZE)
+	return hasher.finish()
+
+
+"""
+Receives a readable stream of the unpatched file and the chunking.ChunkHashes of the
+patched one, which are consumed like the hashes in get_instructions
+Returns the local and remote instructions of the chunks (see chunking.ChunkScanner.finish)
+for patch_local_blocks, get_blocks and patch_remote_blocks. The unpatched file is cut
+the same way as the patched one and read in chunks of "chunksize" bytes, and every
+chunk is found with a single lookup instead of rolling a checksum over every byte
+Since the chunks have different sizes, pass chunking.chunk_sizes(remote_instructions)
+instead of the blocksize to get_blocks and patch_remote_stream
+"""
+def get_chunk_instructions(datastream, remote_hashes, chunksize=_DEFAULT_CHUNKSIZE, engine=None):
+	scanner = chunking.ChunkScanner(remote_hashes, engine)
+	chunk = datastream.read(chunksize)
+	while chunk:
+		scanner.feed(chunk)
+		chunk = datastream.read(chunksize)
+	return scanner.finish()
+
+
 """
 ! This function is a generator !
 Receives an instream and a list of offsets
 Yields the blocks in that instream at those offsets
+The blocks are read as ranges of adjacent blocks (see ranges.plan_ranges), which
+also include gaps of up to "gap" bytes between blocks when one larger read is
+cheaper than two
+The time spent reading, but not while the blocks are consumed, and the bytes read are
+added to the "get_blocks" stage of "stats" (see metrics.Stats)
 """
-def get_blocks(datastream, requests, blocksize=_DEFAULT_BLOCKSIZE):
-	for offset in requests:
-		datastream.seek(offset)
-		content = datastream.read(blocksize)
-		yield (offset, content)
+def get_blocks(datastream, requests, blocksize=_DEFAULT_BLOCKSIZE, gap=0, stats=None):
+	stats = stats or metrics.NO_STATS
+	splitter = ranges.RangeSplitter(requests, blocksize)
+	for start, end in ranges.plan_ranges(requests, blocksize, gap):
+		datastream.seek(start)
+		while start < end:
+			with stats.timing("get_blocks"):
+				data = datastream.read(min(end - start, _DEFAULT_CHUNKSIZE))
+				blocks = splitter.feed(start, data) if data else []
+			if not data:
+				break
+			stats.processed("get_blocks", len(data))
+			for block in blocks:
+				yield block
+			start += len(data)
+	for block in splitter.finish():
+		yield block
+
+
+"""
+! This function is a generator !
+Receives an instream and a list of offsets, like get_blocks
+Yields the frames of the ranges with those blocks, compressed with "codec" (see transfer.py),
+for patch_remote_stream. Every frame holds at most "chunksize" bytes of the patched
+file and, if "dictionary_size" is set, is primed with up to that many bytes before it
+"""
+def compress_blocks(datastream, requests, blocksize=_DEFAULT_BLOCKSIZE, gap=0, codec="zlib", level=None, dictionary_size=0, chunksize=_DEFAULT_CHUNKSIZE):
+	for start, end in ranges.cut_ranges(ranges.plan_ranges(requests, blocksize, gap), blocksize, chunksize):
+		dictionary = _read_dictionary(datastream, start, dictionary_size)
+		datastream.seek(start)
+		data = _read_exactly(datastream, end - start)
+		yield transfer.encode_frame(start, transfer.compress(data, codec, level, dictionary))
+
+
+"""
+Receives a readable stream of the patched file, the start of a frame and the size of its dictionary
+Returns the dictionary of the frame (see transfer.py)
+"""
+def _read_dictionary(datastream, start, size):
+	if not size or not start:
+		return b""
+	first = max(0, start - size)
+	datastream.seek(first)
+	return _read_exactly(datastream, start - first)
 
 
 """
 Receives a readable instream, a writable outstream, a list of instructions and a blocksize
 Sets outstream to the expected size with the blocks from instream in their positions according to the blueprint
+The copies are sorted and adjacent blocks merged into runs (see common.plan_local_copies),
+which are copied in as few calls as possible:
+	- If both streams are regular files, with os.copy_file_range where available so
+	  the data never goes through Python, or else with os.pread and os.pwrite
+	- If the final "length" of the patched file is given and the outstream is opened
+	  for reading and writing (like "w+b"), between memory maps of both files when
+	  os.copy_file_range isn't available
+	- Otherwise by seeking, reading and writing the streams
+If "length" is given the outstream is also resized to it
 WARNING: There is a possibility that a local block will overwrite another
-if the instream and outstream are the same. Avoid this by using different streams.
+if the instream and outstream are the same. Avoid this by using different streams,
+or patch the file in place with patch_in_place instead
+The time and bytes copied are added to the "patch_local_blocks" stage of "stats" (see metrics.Stats)
 """
-def patch_local_blocks(instream, outstream, local_instructions, blocksize=_DEFAULT_BLOCKSIZE):
-	for instruction in local_instructions:
-		local_offset = instruction[0]
-		final_offsets = instruction[1]
+def patch_local_blocks(instream, outstream, local_instructions, blocksize=_DEFAULT_BLOCKSIZE, length=None, stats=None):
+	stats = stats or metrics.NO_STATS
+	runs = common.plan_local_copies(local_instructions, blocksize)
+	with stats.timing("patch_local_blocks"):
+		_copy_runs(instream, outstream, runs, length)
+	if stats is not metrics.NO_STATS:
+		# The last block of the unpatched file may be shorter than the blocksize
+		end = _stream_size(instream)
+		stats.processed("patch_local_blocks", sum(size if end is None else max(0, min(size, end - local_offset))
+			for local_offset, _, size in runs))
 
-		instream.seek(local_offset)
-		block = instream.read(blocksize)
 
-		for offset in final_offsets:
-			outstream.seek(offset)
+"""
+Copies the runs of patch_local_blocks in the fastest way both streams allow
+"""
+def _copy_runs(instream, outstream, runs, length):
+	if length is not None and not hasattr(os, "copy_file_range") and _copy_runs_mapped(instream, outstream, runs, length):
+		return
+	if _copy_runs_fd(instream, outstream, runs, length):
+		return
+
+	if length is not None:
+		outstream.truncate(length)
+	for local_offset, final_offset, size in runs:
+		instream.seek(local_offset)
+		outstream.seek(final_offset)
+		while size > 0:
+			block = instream.read(min(size, _DEFAULT_CHUNKSIZE))
+			if not block:
+				break
 			outstream.write(block)
+			size -= len(block)
+
+
+"""
+Copies the runs of patch_local_blocks between the file descriptors of both streams
+Returns False without writing anything if either stream isn't a regular file
+"""
+def _copy_runs_fd(instream, outstream, runs, length):
+	try:
+		in_fd = instream.fileno()
+		out_fd = outstream.fileno()
+		# Anything still buffered by Python has to land before writing around it
+		outstream.flush()
+		if length is not None:
+			outstream.truncate(length)
+	except (AttributeError, OSError, ValueError):
+		return False
+	if not hasattr(os, "pwrite"):
+		return False
+
+	use_copy_file_range = hasattr(os, "copy_file_range")
+	for local_offset, final_offset, size in runs:
+		while size > 0:
+			if use_copy_file_range:
+				try:
+					copied = os.copy_file_range(in_fd, out_fd, size, local_offset, final_offset)
+				except OSError:
+					# Not supported between these files, such as across
+					# filesystems on older kernels
+					use_copy_file_range = False
+					continue
+			else:
+				block = os.pread(in_fd, min(size, _DEFAULT_CHUNKSIZE), local_offset)
+				copied = os.pwrite(out_fd, block, final_offset) if block else 0
+			if not copied:
+				# The unpatched file ended
+				break
+			local_offset += copied
+			final_offset += copied
+			size -= copied
+	return True
+
+
+"""
+Copies the runs of patch_local_blocks between memory maps of both files
+Returns False without writing anything if either stream can't be mapped
+"""
+def _copy_runs_mapped(instream, outstream, runs, length):
+	try:
+		outstream.flush()
+		outstream.truncate(length)
+		source = mmap.mmap(instream.fileno(), 0, access=mmap.ACCESS_READ)
+	except (AttributeError, OSError, ValueError):
+		# Not a regular file, not resizable or empty
+		return False
+	try:
+		destination = mmap.mmap(outstream.fileno(), length)
+	except (OSError, ValueError):
+		# Opened write-only or the length is zero
+		source.close()
+		return False
+
+	with source, destination:
+		with memoryview(source) as source_view, memoryview(destination) as destination_view:
+			for local_offset, final_offset, size in runs:
+				size = min(size, len(source) - local_offset, length - final_offset)
+				destination_view[final_offset:final_offset + size] = source_view[local_offset:local_offset + size]
+	return True
+
+
+"""
+Receives the seeds given to get_seed_instructions, a writable outstream, the seed
+instructions it returned and a blocksize
+Copies the blocks of every seed into the outstream (see patch_local_blocks), which
+is also resized to "length" if it's given
+"""
+def patch_seed_blocks(seeds, outstream, seed_instructions, blocksize=_DEFAULT_BLOCKSIZE, length=None):
+	seeds = core.seed_dict(seeds)
+	for seed_id, local_instructions in seed_instructions.items():
+		with _open_readable(seeds[seed_id]) as stream:
+			patch_local_blocks(stream, outstream, local_instructions, blocksize, length)
+
+
+"""
+Receives a stream of the unpatched file opened for reading and writing (like "r+b"),
+the local and remote instructions (see get_instructions) and a blocksize
+Patches the local blocks into the same file instead of a second one, in the order
+planned by common.plan_in_place, keeping at most "scratch" bytes in memory to break
+the cycles of blocks that take each other's place. The blocks that didn't fit are
+hashed before they're overwritten and added to the remote instructions
+If "length" is given the stream is resized to it once every block is in place
+Returns the remote instructions of every block that still has to be patched
+(see patch_remote_blocks), which are a copy: the given ones aren't modified
+"""
+def patch_in_place(stream, local_instructions, remote_instructions, blocksize=_DEFAULT_BLOCKSIZE, length=None, scratch=_DEFAULT_CHUNKSIZE, algorithm=None):
+	patcher = core.InPlacePatcher(local_instructions, remote_instructions, blocksize, scratch, algorithm)
+	# Dropped bytes are read whole blocks at a time
+	chunksize = max(1, _DEFAULT_CHUNKSIZE // blocksize) * blocksize
+	for action, local_offset, final_offset, size in patcher.steps(stream.seek(0, os.SEEK_END)):
+		if action == "copy":
+			_move(stream, local_offset, final_offset, size)
+		elif action == "save":
+			stream.seek(local_offset)
+			patcher.save(final_offset, _read_exactly(stream, size))
+		elif action == "restore":
+			stream.seek(final_offset)
+			stream.write(patcher.restore(final_offset))
+		else:
+			stream.seek(local_offset)
+			for start in range(0, size, chunksize):
+				patcher.drop(final_offset + start, _read_exactly(stream, min(chunksize, size - start)))
+	if length is not None:
+		stream.truncate(length)
+	return patcher.remote_instructions
+
+
+"""
+Receives a stream and the source, target and size of a copy inside it
+Copies the bytes like memmove, backwards when the target overlaps the end of the
+source so that no byte is overwritten before it's read
+"""
+def _move(stream, source, target, size):
+	pieces = [(start, min(_DEFAULT_CHUNKSIZE, size - start)) for start in range(0, size, _DEFAULT_CHUNKSIZE)]
+	if source < target < source + size:
+		pieces.reverse()
+	for start, piece in pieces:
+		stream.seek(source + start)
+		block = _read_exactly(stream, piece)
+		stream.seek(target + start)
+		stream.write(block)
 
 
 """
 Receives a list of tuples of missing blocks in the form (offset, content),
-a dictionary with remote instructions (2nd result of get_instructions) and a writable outstream
+a dictionary with remote instructions (2nd result of get_instructions, or the
+signature.SignatureTable itself) and a writable outstream
 Sets those those offsets in the outstream to their expected content according to the instructions
-If check_hashes is set to True, it will also confirm that both the weak and strong hash match the expected
+The outstream can also be an mmap.mmap of the result file, in which case the blocks
+are copied straight into the mapping
+If check_hashes is set to True, it will also confirm that the block's hashes match the expected (see common.verify_block)
+using "algorithm", which defaults to the one recorded by the instructions or otherwise "md5"
+The time and bytes received are added to the "patch_remote_blocks" stage of "stats" (see metrics.Stats)
+"""
+def patch_remote_blocks(remote_blocks, outstream, remote_instructions, check_hashes=False, algorithm=None, stats=None):
+	_patch_blocks(remote_blocks, outstream, core.Patcher(remote_instructions, check_hashes, algorithm), stats)
+
+
+"""
+Receives the missing blocks, a writable outstream, the core.Patcher of their
+instructions and the stats of patch_remote_blocks
+Writes the blocks and returns how many there were
 """
-def patch_remote_blocks(remote_blocks, outstream, remote_instructions, check_hashes=False):
+def _patch_blocks(remote_blocks, outstream, patcher, stats):
+	stats = stats or metrics.NO_STATS
+	mapped = isinstance(outstream, mmap.mmap)
+	count = 0
 	for first_offset, block in remote_blocks:
-		# Optionally check if this block's hashes match the expected hashes
-		instruction = remote_instructions[first_offset]
-		if check_hashes and (common.adler32(block) != instruction[0] or common.stronghash(block) != instruction[1]):
-			#print(str(first_offset)+" had an error:\n"+str(common.adler32(block))+" != "+str(instruction[0])+" or "+str(common.stronghash(block))+" != "+str(instruction[1]))
-			raise Exception
-		for offset in instruction[2]:
-			outstream.seek(offset)
-			outstream.write(block)
+		with stats.timing("patch_remote_blocks"):
+			for offset in patcher.writes(first_offset, block):
+				if mapped:
+					outstream[offset:offset + len(block)] = block
+				else:
+					outstream.seek(offset)
+					outstream.write(block)
+		stats.processed("patch_remote_blocks", len(block))
+		count += 1
+	return count
+
+
+"""
+Receives a source of missing blocks, a writable outstream and the remote instructions
+Patches the blocks into the outstream as they arrive instead of collecting them first,
+so memory stays bounded however large the delta is. The source can be:
+	- An iterable or generator of (offset, block) tuples, such as get_blocks
+	- A readable stream with the content of the planned ranges back to back (see
+	  ranges.plan_ranges with the same "gap"), which is read "budget" bytes at a
+	  time. In that case remote_instructions must be the dictionary returned by
+	  get_instructions, since its keys are the blocks that were requested
+	- A readable stream of the frames from compress_blocks, if "codec" is set. Their
+	  dictionaries are read from the outstream, which must then be readable and
+	  already patched with the local blocks, and "dictionary_size" must be the same
+If check_hashes is set to True, every block is verified before it's written (see patch_remote_blocks)
+The writes are added to the "patch_remote_blocks" stage of "stats" (see metrics.Stats)
+Returns the number of blocks patched
+"""
+def patch_remote_stream(source, outstream, remote_instructions, blocksize=_DEFAULT_BLOCKSIZE, check_hashes=False, gap=0, budget=_DEFAULT_CHUNKSIZE, algorithm=None, codec=None, dictionary_size=0, stats=None):
+	if codec is not None:
+		source = _read_frames(source, outstream, list(remote_instructions), blocksize, budget, codec, dictionary_size)
+	elif hasattr(source, "read"):
+		source = _read_ranges(source, list(remote_instructions), blocksize, gap, budget)
+	return _patch_blocks(source, outstream, core.Patcher(remote_instructions, check_hashes, algorithm), stats)
+
+
+"""
+! This function is a generator !
+Receives a readable stream with the planned ranges of "requests" back to back
+Yields the (offset, block) tuples in it, reading at most "budget" bytes at a time
+"""
+def _read_ranges(datastream, requests, blocksize, gap, budget):
+	reader = core.RangeReader(requests, blocksize, gap)
+	size = reader.wanted()
+	while size:
+		data = datastream.read(min(size, budget))
+		if not data:
+			break
+		for block in reader.feed(data):
+			yield block
+		size = reader.wanted()
+	for block in reader.finish():
+		yield block
+
+
+"""
+! This function is a generator !
+Receives a readable stream of compressed frames (see compress_blocks), the outstream
+their dictionaries are read from and the parameters of patch_remote_stream
+Yields the (offset, block) tuples in the frames, reading at most "budget" bytes at a time.
+Every block of a frame is yielded, and so written, before the next frame is read
+"""
+def _read_frames(datastream, outstream, requests, blocksize, budget, codec, dictionary_size):
+	reader = core.FrameReader(requests, blocksize, codec)
+	header = _read_exactly(datastream, transfer.FRAME_HEADER.size)
+	while header:
+		start = reader.header(header)
+		reader.prime(_read_dictionary(outstream, start, dictionary_size))
+		while reader.left > 0:
+			for block in reader.feed(datastream.read(min(reader.left, budget))):
+				yield block
+		header = _read_exactly(datastream, transfer.FRAME_HEADER.size)
+	for block in reader.finish():
+		yield block
+
+
+"""
+Receives a fanout.DeltaCache, the fingerprint of a client's unpatched file (see
+fanout.fingerprint), a dictionary with the old versions of the file by their
+fingerprints, the new version and its signature.SignatureTable. The versions are
+paths or readable streams
+Returns the fanout.Delta that patches the client's file into the new version, which
+is only built (see build_delta) the first time it's asked for with these parameters,
+or None if the client's file isn't one of the old versions, so it has to get the
+instructions on its own
+Threads that ask for the same delta wait for a single build, while different deltas
+are built at the same time. Only a stream is read by one of them at a time, so
+paths let the builds read the same version at once
+"""
+def fan_out(cache, client, versions, new, table, gap=0, codec=None, level=None, dictionary_size=0, engine=None):
+	target = fanout.fingerprint(table)
+	delta = cache.get(client, target, gap, codec, level, dictionary_size)
+	if delta is not None or client not in versions:
+		return delta
+	future, build = cache.claim(client, target, gap, codec, level, dictionary_size)
+	if build:
+		try:
+			with _stream_lock(cache, versions[client]):
+				local_instructions, remote_instructions = _scan_delta(versions[client], table, engine)
+			with _stream_lock(cache, new):
+				delta = _pack_delta(new, table, local_instructions, remote_instructions, gap, codec, level, dictionary_size)
+			cache.put(client, target, delta)
+		except BaseException as error:
+			cache.release(future, error)
+			raise
+		cache.release(future, delta)
+	return future.result()
+
+
+def _stream_lock(cache, source):
+	if isinstance(source, (str, bytes, os.PathLike)):
+		return contextlib.nullcontext()
+	return cache.stream_lock(source)
+
+
+"""
+Receives the old and new versions of a file (paths or readable streams) and the
+signature.SignatureTable of the new one
+Returns the fanout.Delta between them: the instructions for the old version, which
+is scanned from its start with a copy of the table, and the missing blocks packed
+as the ranges planned with "gap" or, if "codec" is set, as compressed frames (see compress_blocks)
+"""
+def build_delta(old, new, table, gap=0, codec=None, level=None, dictionary_size=0, engine=None):
+	local_instructions, remote_instructions = _scan_delta(old, table, engine)
+	return _pack_delta(new, table, local_instructions, remote_instructions, gap, codec, level, dictionary_size)
+
+
+"""
+Receives the old version of a file, the signature.SignatureTable of the new one and the engine
+Returns the instructions of build_delta for the old version
+"""
+def _scan_delta(old, table, engine):
+	with _open_readable(old) as stream:
+		stream.seek(0)
+		return get_instructions(stream, table.copy(), table.blocksize, engine=engine)
+
+
+"""
+Receives the new version of a file, its signature.SignatureTable, the instructions of
+the old version and the parameters of build_delta
+Returns the fanout.Delta, with the missing blocks read from the new version
+"""
+def _pack_delta(new, table, local_instructions, remote_instructions, gap, codec, level, dictionary_size):
+	builder = core.DeltaBuilder(table, gap, codec, level, dictionary_size, _DEFAULT_CHUNKSIZE)
+	with _open_readable(new) as stream:
+		for start, end in builder.reads(remote_instructions):
+			dictionary = _read_dictionary(stream, start, builder.dictionary_size)
+			stream.seek(start)
+			builder.add(start, _read_exactly(stream, end - start), dictionary)
+	return builder.finish(local_instructions, remote_instructions)
@@ -0,0 +1,305 @@
+"""
+=== BENCHMARK ===
+Syncs synthetic files with every engine, in both modes and across several blocksizes,
+and reports the numbers of every run as JSON to compare them between versions:
+	PYTHONPATH=. python tests/benchmark.py --sizes 1M 256M --blocksizes 1024 4096 -o results.json
+The files are generated from the seed, so the same arguments always sync the same
+bytes. Every workload starts from the same base file (the unpatched one) and edits it
+into the patched one:
+	identical - no edits
+	different - a patched file with nothing in common with the base
+	insert - random bytes inserted at random offsets
+	delete - random ranges removed
+	append - random bytes added at the end
+	shuffle - the base cut at random offsets and its pieces shuffled
+The files are generated and read a piece at a time, so they can be many GB, and
+every run is a process of its own, so that its peak RSS is its own
+"""
+import argparse
+import asyncio
+import filecmp
+import functools
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import asynchronous
+import metrics
+import synchronous
+
+try:
+	import aiofiles
+except ImportError:
+	aiofiles = None
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+WORKLOADS = ("identical", "different", "insert", "delete", "append", "shuffle")
+_PIECE = 1024 * 1024
+_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+"""
+Receives a size like 4096, 512K, 1M or 2G
+Returns it in bytes
+"""
+def parse_size(text):
+	text = text.strip().upper()
+	if text[-1:] in _UNITS:
+		return int(float(text[:-1]) * _UNITS[text[-1]])
+	return int(text)
+
+
+"""
+! This function is a generator !
+Receives the seed, a label and a size
+Yields that many random bytes in pieces, the same ones for the same seed and label
+"""
+def _random_bytes(seed, label, size):
+	for index, start in enumerate(range(0, size, _PIECE)):
+		rnd = random.Random(str(seed)+":"+label+":"+str(index))
+		yield rnd.randbytes(min(_PIECE, size - start))
+
+
+"""
+! This function is a generator !
+Receives the seed and a (start, end) range of the base file
+Yields the bytes of the base file in that range, in pieces
+"""
+def _base_bytes(seed, start, end):
+	while start < end:
+		index, skip = divmod(start, _PIECE)
+		piece = _base_piece(seed, index)[skip:skip + end - start]
+		yield piece
+		start += len(piece)
+
+
+# The ranges of a layout often start and end in the same piece
+@functools.lru_cache(maxsize=2)
+def _base_piece(seed, index):
+	return random.Random(str(seed)+":base:"+str(index)).randbytes(_PIECE)
+
+
+"""
+Receives the name of a workload, the size of the base file, the seed and the number of edits
+Returns the layout of the patched file: a list of ("base", start, end) ranges of the
+base file and ("random", label, size) runs of new bytes
+"""
+def workload_layout(name, size, seed, edits):
+	rnd = random.Random(str(seed)+":"+name+":"+str(size))
+	if name == "identical":
+		return [("base", 0, size)]
+	if name == "different":
+		return [("random", "different", size)]
+	if name == "append":
+		return [("base", 0, size), ("random", "append", max(1, size // 64))]
+	cuts = sorted(rnd.randrange(size) for _ in range(edits))
+	layout = []
+	start = 0
+	if name == "shuffle":
+		layout = [("base", a, b) for a, b in zip([0] + cuts, cuts + [size]) if a < b]
+		rnd.shuffle(layout)
+		return layout
+	for index, cut in enumerate(cuts):
+		if cut < start:
+			continue
+		layout.append(("base", start, cut))
+		if name == "insert":
+			layout.append(("random", "insert"+str(index), rnd.randrange(1, 4096)))
+			start = cut
+		elif name == "delete":
+			start = min(size, cut + rnd.randrange(1, 4096))
+		else:
+			raise ValueError("Unknown workload: "+name)
+	layout.append(("base", start, size))
+	return layout
+
+
+"""
+Receives a path, a layout (see workload_layout) and the seed
+Writes the file the layout describes
+"""
+def write_layout(path, layout, seed):
+	with open(path, "wb") as f:
+		for kind, first, second in layout:
+			pieces = _base_bytes(seed, first, second) if kind == "base" else _random_bytes(seed, first, second)
+			for piece in pieces:
+				f.write(piece)
+
+
+"""
+Returns the peak RSS of this process in bytes, or None where it can't be told
+"""
+def peak_rss():
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KiB, macOS bytes
+	return peak if sys.platform == "darwin" else peak * 1024
+
+
+"""
+Receives the unpatched and patched files, the result file, a blocksize and an engine
+Syncs them with the synchronous module, collecting the metrics.Stats
+Returns the stats and the size of the binary signature
+"""
+def sync_run(unpatched_file, patched_file, result_file, blocksize, engine):
+	stats = metrics.Stats()
+	with open(patched_file, "rb") as f:
+		num, table = synchronous.block_checksums(f, blocksize, compact=True, stats=stats)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table)
+	with open(unpatched_file, "rb") as f:
+		local, remote = synchronous.get_instructions(f, table, blocksize, engine=engine, stats=stats)
+	with open(unpatched_file, "rb") as unpatched, open(result_file, "w+b") as result:
+		synchronous.patch_local_blocks(unpatched, result, local, blocksize, length=table.length, stats=stats)
+	with open(patched_file, "rb") as f, open(result_file, "r+b") as result:
+		blocks = synchronous.get_blocks(f, list(remote), blocksize, stats=stats)
+		synchronous.patch_remote_stream(blocks, result, remote, blocksize, check_hashes=True, stats=stats)
+	return stats, sig.tell()
+
+
+"""
+Same as sync_run, with the asynchronous module (requires aiofiles)
+"""
+async def async_run(unpatched_file, patched_file, result_file, blocksize, engine):
+	stats = metrics.Stats()
+	async with aiofiles.open(patched_file, "rb") as f:
+		num, table = await asynchronous.block_checksums(f, blocksize, compact=True, stats=stats)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table)
+	async with aiofiles.open(unpatched_file, "rb") as f:
+		local, remote = await asynchronous.get_instructions(f, table, blocksize, engine=engine, stats=stats)
+	async with aiofiles.open(unpatched_file, "rb") as unpatched, aiofiles.open(result_file, "wb") as result:
+		await asynchronous.patch_local_blocks(unpatched, result, local, blocksize, stats=stats)
+	async with aiofiles.open(patched_file, "rb") as f, aiofiles.open(result_file, "r+b") as result:
+		blocks = asynchronous.get_blocks(f, list(remote), blocksize, stats=stats)
+		await asynchronous.patch_remote_stream(blocks, result, remote, blocksize, check_hashes=True, stats=stats)
+		await result.truncate(table.length)
+	return stats, sig.tell()
+
+
+"""
+Receives a case: a dictionary with the files, blocksize, engine and mode of a run
+Runs it in this process
+Returns a dictionary with its results
+"""
+def run_case(case):
+	arguments = (case["unpatched"], case["patched"], case["result"], case["blocksize"], case["engine"])
+	start = time.perf_counter()
+	if case["mode"] == "async":
+		stats, signature_bytes = asyncio.run(async_run(*arguments))
+	else:
+		stats, signature_bytes = sync_run(*arguments)
+	wall = time.perf_counter() - start
+	size = os.path.getsize(case["patched"])
+	results = stats.as_dict()
+	for stage in results["stages"].values():
+		stage["throughput"] = stage["bytes"] / stage["wall"] if stage["wall"] else None
+	results.update({
+		"wall": wall,
+		"throughput": size / wall if wall else None,
+		"peak_rss": peak_rss(),
+		# Of every window scanned, how many matched a weak hash, and of those how many in vain
+		"weak_hit_ratio": stats.weak_hits / stats.bytes_scanned if stats.bytes_scanned else 0.0,
+		"false_positive_ratio": stats.strong_false_positives / stats.weak_hits if stats.weak_hits else 0.0,
+		"signature_bytes": signature_bytes,
+		"transfer_bytes": signature_bytes + stats.bytes_fetched,
+		"correct": filecmp.cmp(case["patched"], case["result"], shallow=False),
+	})
+	return results
+
+
+"""
+Receives a case
+Runs it in a process of its own
+Returns its results
+"""
+def run_isolated(case):
+	output = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+		check=True, stdout=subprocess.PIPE).stdout
+	return json.loads(output)
+
+
+"""
+Returns the engines and modes that can run here
+"""
+def available():
+	engines = ["python"] + (["numpy"] if numpy is not None else [])
+	modes = ["sync"] + (["async"] if aiofiles is not None else [])
+	return engines, modes
+
+
+def main():
+	engines, modes = available()
+	parser = argparse.ArgumentParser(description="Benchmarks the sync of synthetic files and reports the results as JSON")
+	parser.add_argument("-s", "--sizes", nargs="+", default=["1M"], help="sizes of the base file, like 1M or 2G")
+	parser.add_argument("-b", "--blocksizes", nargs="+", type=int, default=[1024, 4096, 16384])
+	parser.add_argument("-w", "--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+	parser.add_argument("-e", "--engines", nargs="+", choices=engines, default=engines)
+	parser.add_argument("-m", "--modes", nargs="+", choices=modes, default=modes)
+	parser.add_argument("--edits", type=int, default=16, help="edits made by the insert, delete and shuffle workloads")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("-d", "--directory", help="where the files are generated (a temporary directory by default)")
+	parser.add_argument("-o", "--output", help="where the JSON is written (the standard output by default)")
+	parser.add_argument("--case", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	if args.case:
+		json.dump(run_case(json.loads(args.case)), sys.stdout)
+		return
+
+	directory = args.directory or tempfile.mkdtemp(prefix="pyzsync-benchmark-")
+	os.makedirs(directory, exist_ok=True)
+	runs = []
+	try:
+		for size in map(parse_size, args.sizes):
+			unpatched = os.path.join(directory, "base-"+str(size))
+			write_layout(unpatched, [("base", 0, size)], args.seed)
+			for name in args.workloads:
+				patched = os.path.join(directory, name+"-"+str(size))
+				write_layout(patched, workload_layout(name, size, args.seed, args.edits), args.seed)
+				for blocksize in args.blocksizes:
+					for engine in args.engines:
+						for mode in args.modes:
+							case = {"unpatched": unpatched, "patched": patched, "result": os.path.join(directory, "result"),
+								"blocksize": blocksize, "engine": None if engine == "python" else engine, "mode": mode}
+							print(name, size, blocksize, engine, mode, file=sys.stderr)
+							results = run_isolated(case)
+							runs.append(dict(workload=name, size=size, blocksize=blocksize, engine=engine, mode=mode, **results))
+				os.remove(patched)
+			os.remove(unpatched)
+	finally:
+		if args.directory is None:
+			shutil.rmtree(directory, ignore_errors=True)
+
+	report = {
+		"seed": args.seed,
+		"edits": args.edits,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"runs": runs,
+	}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		json.dump(report, sys.stdout, indent="\t")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,24 @@
+"""
+The tests run with:
+	python -m pytest tests
+The modules are imported from the repository root, like tests/simple_test.py does
+with PYTHONPATH=.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from .helpers import edit, random_bytes
+
+
+@pytest.fixture
+def data():
+	return random_bytes(64 * 1024)
+
+
+@pytest.fixture
+def modified(data):
+	return edit(data)
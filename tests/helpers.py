@@ -0,0 +1,101 @@
+"""
+Helpers shared by the tests
+"""
+import asyncio
+import io
+import os
+import random
+
+import synchronous
+
+
+"""
+Receives a size and a seed
+Returns that many random bytes, the same ones for the same seed
+"""
+def random_bytes(size, seed=0):
+	return random.Random(seed).randbytes(size)
+
+
+"""
+Receives some data, a seed and a number of edits
+Returns the data with that many random inserts, deletes and overwrites, plus a
+repeated piece appended at the end
+"""
+def edit(data, seed=0, edits=8):
+	rnd = random.Random(seed)
+	data = bytearray(data)
+	for _ in range(edits):
+		kind = rnd.randrange(3)
+		position = rnd.randrange(len(data) + 1)
+		if kind == 0:
+			data[position:position] = rnd.randbytes(rnd.randrange(1, 300))
+		elif kind == 1:
+			del data[position:position + rnd.randrange(1, 300)]
+		else:
+			data[position:position + 10] = rnd.randbytes(10)
+	data += data[:rnd.randrange(1, 200)]
+	return bytes(data)
+
+
+"""
+Wraps a regular stream with the coroutines of an aiofiles stream, for the asynchronous module
+"""
+class AsyncStream:
+	def __init__(self, stream):
+		self.stream = stream
+
+	async def read(self, size=-1):
+		return self.stream.read(size)
+
+	async def write(self, data):
+		return self.stream.write(data)
+
+	async def seek(self, offset, whence=os.SEEK_SET):
+		return self.stream.seek(offset, whence)
+
+	async def tell(self):
+		return self.stream.tell()
+
+	async def truncate(self, size=None):
+		return self.stream.truncate(size)
+
+	def fileno(self):
+		return self.stream.fileno()
+
+	def getvalue(self):
+		return self.stream.getvalue()
+
+
+"""
+Receives a coroutine function and its arguments
+Returns its result, run in a new event loop
+"""
+def run(function, *args, **kwargs):
+	return asyncio.run(function(*args, **kwargs))
+
+
+"""
+Receives the unpatched and patched data, a blocksize, whether the hashes are a
+signature.SignatureTable, the keyword arguments of block_checksums as "checksums"
+and those of get_instructions
+Returns the local and remote instructions of the synchronous module
+"""
+def instructions(unpatched, patched, blocksize, compact=False, checksums=None, **kwargs):
+	num, hashes = synchronous.block_checksums(io.BytesIO(patched), blocksize, compact=compact, **(checksums or {}))
+	return synchronous.get_instructions(io.BytesIO(unpatched), hashes, blocksize, **kwargs)
+
+
+"""
+Receives the unpatched and patched data, a blocksize and the keyword arguments of get_instructions
+Returns the patched data rebuilt with the synchronous module from the unpatched one and
+the blocks it was missing, along with the local and remote instructions
+"""
+def sync_data(unpatched, patched, blocksize, compact=False, **kwargs):
+	local, remote = instructions(unpatched, patched, blocksize, compact, **kwargs)
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(unpatched), result, local, blocksize)
+	blocks = synchronous.get_blocks(io.BytesIO(patched), list(remote), blocksize)
+	synchronous.patch_remote_blocks(blocks, result, remote, check_hashes=True)
+	result.truncate(len(patched))
+	return result.getvalue(), local, remote
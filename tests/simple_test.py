@@ -5,6 +5,7 @@ unpatched_file = "tests/loremipsum" # "tests/BABD"
 patched_file = "tests/loremipsum_modified" # "tests/ABC"
 result_file = "tests/loremipsum_result"
 blocksize = 16
+engine = None
 verbose = False
 very_verbose = False
 
@@ -48,7 +49,7 @@ async def asynchronous_test():
 	# Get the instructions
 	if verbose: print("Getting instructions from " + unpatched_file)
 	async with aiofiles.open(unpatched_file, "rb") as f:
-		local, remote = await zsync.get_instructions(f, hashes, blocksize=blocksize)
+		local, remote = await zsync.get_instructions(f, hashes, blocksize=blocksize, engine=engine)
 	missing = list(remote.keys())
 	if very_verbose: print_instructions(local, remote, missing)
 
@@ -85,7 +86,7 @@ def synchronous_test():
 	# Get the instructions
 	if verbose: print("Getting instructions from "+unpatched_file)
 	with open(unpatched_file, "rb") as f:
-		local, remote = zsync.get_instructions(f, hashes, blocksize=blocksize)
+		local, remote = zsync.get_instructions(f, hashes, blocksize=blocksize, engine=engine)
 	missing = list(remote.keys())
 	if very_verbose: print_instructions(local, remote, missing)
 
@@ -111,11 +112,13 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-a", "--async", "--asynchronous", action="store_true", dest="asynchronous")
 	parser.add_argument("-b", "--blocksize", action="store", dest="blocksize")
+	parser.add_argument("-e", "--engine", action="store", dest="engine")
 	parser.add_argument("-v", "--verbose", action="store_true", dest="verbose")
 	parser.add_argument("-vv", "--very-verbose", action="store_true", dest="very_verbose")
 	args = parser.parse_args()
 	if args.blocksize:
-		blocksize = args.blocksize
+		blocksize = int(args.blocksize)
+	engine = args.engine
 	very_verbose = args.very_verbose
 	verbose = (args.verbose or very_verbose)
 	
@@ -0,0 +1,160 @@
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+import asynchronous
+import sources
+import synchronous
+
+from .helpers import AsyncStream, instructions, random_bytes, run, sync_data
+
+BLOCKSIZE = 128
+
+
+async def _collect(generator):
+	return [item async for item in generator]
+
+
+async def _async_data(unpatched, patched, blocksize, compact=False, **kwargs):
+	num, hashes = await asynchronous.block_checksums(AsyncStream(io.BytesIO(patched)), blocksize, compact=compact)
+	local, remote = await asynchronous.get_instructions(AsyncStream(io.BytesIO(unpatched)), hashes, blocksize, **kwargs)
+	result = AsyncStream(io.BytesIO())
+	await asynchronous.patch_local_blocks(AsyncStream(io.BytesIO(unpatched)), result, local, blocksize)
+	blocks = await _collect(asynchronous.get_blocks(AsyncStream(io.BytesIO(patched)), list(remote), blocksize))
+	await asynchronous.patch_remote_blocks(blocks, result, remote, check_hashes=True)
+	await result.truncate(len(patched))
+	return result.getvalue(), local, remote
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_block_checksums_match_the_synchronous_ones(data, compact):
+	expected = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=compact)
+	num, hashes = run(asynchronous.block_checksums, AsyncStream(io.BytesIO(data)), BLOCKSIZE, compact=compact)
+	assert num == expected[0]
+	if compact:
+		assert (hashes.length, hashes.filehash) == (expected[1].length, expected[1].filehash)
+		hashes, expected = hashes.to_hashes(), (num, expected[1].to_hashes())
+	assert hashes == expected[1]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("chunksize", [100, 1 << 20])
+def test_sync_rebuilds_the_same_file_as_the_synchronous_module(data, modified, compact, chunksize):
+	expected = sync_data(data, modified, BLOCKSIZE, compact=compact, chunksize=chunksize)
+	result = run(_async_data, data, modified, BLOCKSIZE, compact=compact, chunksize=chunksize)
+	assert result[0] == modified
+	assert result[1] == expected[1]
+	assert dict(result[2]) == dict(expected[2])
+
+
+def test_offloader_with_an_executor_of_its_own(data, modified):
+	with ThreadPoolExecutor(2) as executor:
+		offloader = asynchronous.Offloader(executor, limit=1)
+		num, hashes = run(asynchronous.block_checksums, AsyncStream(io.BytesIO(modified)), BLOCKSIZE, offloader=offloader)
+	assert hashes == synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE)[1]
+	with ProcessPoolExecutor(1) as executor, pytest.raises(ValueError):
+		asynchronous.Offloader(executor)
+
+
+def test_concurrent_syncs_share_the_offloader(data):
+	files = [random_bytes(20000, seed) for seed in range(4)]
+
+	async def main():
+		return await asyncio.gather(*(_async_data(data, patched, BLOCKSIZE, compact=True) for patched in files))
+
+	assert [result for result, _, _ in asyncio.run(main())] == files
+
+
+def test_patch_in_place(tmp_path, data, modified):
+	num, hashes = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), hashes, BLOCKSIZE)
+	path = tmp_path / "file"
+	path.write_bytes(data)
+	with open(path, "r+b") as f:
+		stream = AsyncStream(f)
+		missing = run(asynchronous.patch_in_place, stream, local, remote, BLOCKSIZE, length=len(modified), scratch=0)
+		blocks = asynchronous.get_blocks(AsyncStream(io.BytesIO(modified)), list(missing), BLOCKSIZE)
+		run(asynchronous.patch_remote_stream, blocks, stream, missing, check_hashes=True)
+	assert path.read_bytes() == modified
+
+
+def test_patch_local_blocks_resizes_to_the_length(data, modified):
+	local, remote = instructions(data, modified, BLOCKSIZE)
+	result = AsyncStream(io.BytesIO(b"x" * 2 * len(modified)))
+	run(asynchronous.patch_local_blocks, AsyncStream(io.BytesIO(data)), result, local, BLOCKSIZE, length=len(modified))
+	blocks = asynchronous.get_blocks(AsyncStream(io.BytesIO(modified)), list(remote), BLOCKSIZE)
+	run(asynchronous.patch_remote_stream, blocks, result, remote, check_hashes=True)
+	assert result.getvalue() == modified
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_fetch_blocks_from_a_file(tmp_path, modified, concurrency):
+	path = tmp_path / "patched"
+	path.write_bytes(modified)
+	offsets = list(range(0, len(modified), 3 * BLOCKSIZE))
+	source = sources.FileSource(path)
+	try:
+		blocks = run(_collect, asynchronous.fetch_blocks(source, offsets, BLOCKSIZE, concurrency=concurrency, range_size=BLOCKSIZE))
+	finally:
+		source.close()
+	assert sorted(blocks) == [(offset, modified[offset:offset + BLOCKSIZE]) for offset in offsets]
+
+
+"""
+A block source that fails the first "failures" fetches of every range with "error"
+"""
+class FlakySource:
+	def __init__(self, data, error, failures):
+		self.data = data
+		self.error = error
+		self.failures = failures
+		self.calls = {}
+
+	async def fetch(self, start, end):
+		self.calls[start] = self.calls.get(start, 0) + 1
+		if self.calls[start] <= self.failures:
+			raise self.error
+		return self.data[start:end]
+
+
+def test_fetch_blocks_retries_transient_errors(modified):
+	offsets = [0, 10 * BLOCKSIZE, 20 * BLOCKSIZE]
+	source = FlakySource(modified, ConnectionResetError("reset"), 2)
+	blocks = run(_collect, asynchronous.fetch_blocks(source, offsets, BLOCKSIZE, retries=2, backoff=0))
+	assert sorted(blocks) == [(offset, modified[offset:offset + BLOCKSIZE]) for offset in offsets]
+	assert set(source.calls.values()) == {3}
+
+	source = FlakySource(modified, TimeoutError(), 3)
+	with pytest.raises(TimeoutError):
+		run(_collect, asynchronous.fetch_blocks(source, offsets, BLOCKSIZE, retries=2, backoff=0))
+
+
+def test_fetch_blocks_doesnt_retry_fatal_errors(modified):
+	source = FlakySource(modified, ValueError("not a range"), 1)
+	with pytest.raises(ValueError):
+		run(_collect, asynchronous.fetch_blocks(source, [0], BLOCKSIZE, retries=5, backoff=0))
+	assert source.calls == {0: 1}
+
+
+def test_fetch_blocks_from_a_function(modified):
+	offsets = [BLOCKSIZE, 5 * BLOCKSIZE]
+	blocks = run(_collect, asynchronous.fetch_blocks(lambda start, end: modified[start:end], offsets, BLOCKSIZE))
+	assert sorted(blocks) == [(offset, modified[offset:offset + BLOCKSIZE]) for offset in offsets]
+
+
+def test_patch_remote_stream_from_fetched_blocks(data, modified):
+	num, hashes = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), hashes, BLOCKSIZE)
+
+	async def main():
+		result = AsyncStream(io.BytesIO())
+		await asynchronous.patch_local_blocks(AsyncStream(io.BytesIO(data)), result, local, BLOCKSIZE)
+		source = FlakySource(modified, ConnectionError(), 1)
+		blocks = asynchronous.fetch_blocks(source, list(remote), BLOCKSIZE, backoff=0)
+		count = await asynchronous.patch_remote_stream(blocks, result, remote, check_hashes=True)
+		await result.truncate(len(modified))
+		return count, result.getvalue()
+
+	assert asyncio.run(main()) == (len(remote), modified)
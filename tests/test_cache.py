@@ -0,0 +1,188 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import asynchronous
+import cache
+import signature
+import synchronous
+
+from .helpers import AsyncStream, random_bytes, run
+
+BLOCKSIZE = 256
+
+
+class UnreadableFile(io.FileIO):
+	def read(self, size=-1):
+		raise AssertionError("The file was read")
+
+
+def _write(path, data, mtime_ns):
+	with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+		f.write(data)
+		f.truncate(len(data))
+	os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def _checksums(path, signatures, **kwargs):
+	with open(path, "rb") as f:
+		return synchronous.block_checksums(f, BLOCKSIZE, compact=True, cache=signatures, **kwargs)[1]
+
+
+def test_hit_doesnt_read_the_file(tmp_path):
+	path = tmp_path / "file"
+	_write(path, random_bytes(10000), 10 ** 18)
+	signatures = cache.SignatureCache(tmp_path / "cache")
+	table = _checksums(path, signatures)
+	assert len(signatures) == 1
+
+	with UnreadableFile(path) as f:
+		num, cached = synchronous.block_checksums(f, BLOCKSIZE, compact=True, cache=signatures)
+		assert cached.to_hashes() == table.to_hashes()
+		assert (cached.length, cached.filehash) == (table.length, table.filehash)
+		# The dictionaries come from the same table
+		num, hashes = synchronous.block_checksums(f, BLOCKSIZE, cache=signatures)
+		assert hashes == table.to_hashes()
+
+	# A new cache finds the signatures of the previous one
+	assert len(cache.SignatureCache(tmp_path / "cache")) == 1
+
+
+def test_miss_on_a_changed_file_or_parameters(tmp_path):
+	path = tmp_path / "file"
+	data = random_bytes(10000)
+	_write(path, data, 10 ** 18)
+	signatures = cache.SignatureCache(tmp_path / "cache")
+	_checksums(path, signatures)
+
+	data = random_bytes(10000, 1)
+	_write(path, data, 10 ** 18 + 1)
+	table = _checksums(path, signatures)
+	assert table.to_hashes() == synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE)[1]
+	# The signature of the previous version was replaced
+	assert len(signatures) == 1
+
+	table = _checksums(path, signatures, algorithm="blake2b-8")
+	assert table.algorithm == "blake2b-8"
+	assert len(signatures) == 2
+
+	# Streams that aren't regular files are never cached
+	num, hashes = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, cache=signatures)
+	assert hashes == synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE)[1]
+	assert len(signatures) == 2
+
+
+def test_incremental_update_only_hashes_the_modified_blocks(tmp_path):
+	path = tmp_path / "file"
+	data = bytearray(random_bytes(20 * BLOCKSIZE))
+	_write(path, data, 10 ** 18)
+	signatures = cache.SignatureCache(tmp_path / "cache")
+	previous = _checksums(path, signatures)
+
+	data[5 * BLOCKSIZE + 10:5 * BLOCKSIZE + 20] = b"x" * 10
+	# This change isn't reported, so its block keeps the hashes it had
+	data[12 * BLOCKSIZE] ^= 1
+	data += b"appended"
+	_write(path, data, 10 ** 18 + 1)
+	table = _checksums(path, signatures, modified=[(5 * BLOCKSIZE + 10, 5 * BLOCKSIZE + 20)])
+
+	expected = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=True)[1]
+	assert (table.length, table.filehash) == (expected.length, expected.filehash)
+	assert table.instruction(5 * BLOCKSIZE)[:2] == expected.instruction(5 * BLOCKSIZE)[:2]
+	assert table.instruction(20 * BLOCKSIZE)[:2] == expected.instruction(20 * BLOCKSIZE)[:2]
+	assert table.instruction(12 * BLOCKSIZE)[:2] == previous.instruction(12 * BLOCKSIZE)[:2]
+	assert table.instruction(12 * BLOCKSIZE)[:2] != expected.instruction(12 * BLOCKSIZE)[:2]
+	# The update replaced the previous version
+	assert len(signatures) == 1
+	assert _checksums(path, signatures).to_hashes() == table.to_hashes()
+
+
+def test_eviction_in_least_recently_used_order(tmp_path):
+	signatures = cache.SignatureCache(tmp_path / "cache", max_entries=2)
+	paths = [tmp_path / str(number) for number in range(3)]
+	for number, path in enumerate(paths):
+		_write(path, random_bytes(1000, number), 10 ** 18)
+	_checksums(paths[0], signatures)
+	_checksums(paths[1], signatures)
+	# Using the first one makes the second one the oldest
+	_checksums(paths[0], signatures)
+	_checksums(paths[2], signatures)
+	assert len(signatures) == 2
+	with open(paths[1], "rb") as f:
+		assert signatures.get(signatures.key(f, BLOCKSIZE)) is None
+	with open(paths[0], "rb") as f:
+		assert signatures.get(signatures.key(f, BLOCKSIZE)) is not None
+
+	size = os.path.getsize(os.path.join(signatures.directory, os.listdir(signatures.directory)[0]))
+	signatures = cache.SignatureCache(tmp_path / "cache", max_bytes=size)
+	_checksums(paths[1], signatures)
+	assert len(signatures) == 1
+	signatures.clear()
+	assert len(signatures) == 0 and not os.listdir(tmp_path / "cache")
+
+
+def test_broken_signatures_are_dropped(tmp_path):
+	path = tmp_path / "file"
+	_write(path, random_bytes(1000), 10 ** 18)
+	signatures = cache.SignatureCache(tmp_path / "cache")
+	_checksums(path, signatures)
+	name, = os.listdir(tmp_path / "cache")
+	with open(tmp_path / "cache" / name, "r+b") as f:
+		f.truncate(10)
+	with open(path, "rb") as f:
+		assert signatures.get(signatures.key(f, BLOCKSIZE)) is None
+	assert len(signatures) == 0
+
+
+def test_only_full_tables_can_be_updated(tmp_path):
+	table = synchronous.block_checksums(io.BytesIO(random_bytes(1000)), BLOCKSIZE, compact=True)[1]
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table, 2, 4)
+	sig.seek(0)
+	with pytest.raises(ValueError):
+		signature.TableUpdater(synchronous.read_signature(sig), [])
+
+
+def test_threads_share_the_cache(tmp_path):
+	signatures = cache.SignatureCache(tmp_path / "cache", max_entries=4)
+	paths = []
+	for number in range(8):
+		paths.append(tmp_path / str(number))
+		_write(paths[-1], random_bytes(5000, number), 10 ** 18)
+	with ThreadPoolExecutor(8) as executor:
+		tables = list(executor.map(lambda path: _checksums(path, signatures), paths * 3))
+	assert len(signatures) == 4 == len(os.listdir(tmp_path / "cache"))
+	for path, table in zip(paths * 3, tables):
+		assert table.filehash == synchronous.file_digest(io.BytesIO(path.read_bytes()))[1]
+
+
+def test_the_asynchronous_module_uses_the_cache_in_the_offloader(tmp_path, monkeypatch):
+	path = tmp_path / "file"
+	_write(path, random_bytes(10000), 10 ** 18)
+	signatures = cache.SignatureCache(tmp_path / "cache")
+	threads = []
+
+	def recording(method):
+		def recorded(*args):
+			threads.append(threading.current_thread())
+			return method(*args)
+		return recorded
+
+	monkeypatch.setattr(signatures, "lookup", recording(signatures.lookup))
+	monkeypatch.setattr(signatures, "put", recording(signatures.put))
+
+	async def main():
+		with open(path, "rb") as f:
+			with ThreadPoolExecutor(1) as executor:
+				offloader = asynchronous.Offloader(executor)
+				first = await asynchronous.block_checksums(AsyncStream(f), BLOCKSIZE, compact=True, cache=signatures, offloader=offloader)
+				second = await asynchronous.block_checksums(AsyncStream(f), BLOCKSIZE, compact=True, cache=signatures, offloader=offloader)
+		return first[1], second[1]
+
+	first, second = run(main)
+	assert first.to_hashes() == second.to_hashes()
+	# Looked up twice and stored once, never in the event loop's thread
+	assert len(threads) == 3 and threading.main_thread() not in threads
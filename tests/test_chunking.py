@@ -0,0 +1,75 @@
+import io
+
+import pytest
+
+import chunking
+import synchronous
+
+from .helpers import edit, random_bytes
+
+
+def _cuts(data, piece, **kwargs):
+	chunker = chunking.Chunker(**kwargs)
+	chunks = []
+	for start in range(0, len(data), piece):
+		chunks += chunker.feed(data[start:start + piece])
+	return chunks + chunker.finish()
+
+
+def test_chunks_cover_the_file_within_their_sizes():
+	data = random_bytes(200000)
+	chunks = _cuts(data, 1 << 20, min_size=256, avg_size=1024, max_size=4096)
+	assert b"".join(chunk for _, chunk in chunks) == data
+	assert [offset for offset, _ in chunks] == [sum(len(chunk) for _, chunk in chunks[:i]) for i in range(len(chunks))]
+	assert all(256 <= len(chunk) <= 4096 for _, chunk in chunks[:-1])
+	assert 500 < len(data) / len(chunks) < 2000
+
+
+@pytest.mark.parametrize("piece", [1, 100, 5000])
+def test_cuts_dont_depend_on_the_pieces(piece):
+	data = random_bytes(30000)
+	assert _cuts(data, piece, min_size=128, avg_size=512, max_size=2048) == _cuts(data, 1 << 20, min_size=128, avg_size=512, max_size=2048)
+
+
+def test_numpy_cuts_in_the_same_places():
+	pytest.importorskip("numpy")
+	data = random_bytes(100000)
+	for piece in (1000, 1 << 20):
+		assert _cuts(data, piece, min_size=256, avg_size=1024, max_size=4096, engine="numpy") == _cuts(data, piece, min_size=256, avg_size=1024, max_size=4096)
+
+
+def test_insertions_only_change_the_chunks_around_them():
+	data = random_bytes(100000)
+	changed = data[:50000] + b"inserted" + data[50000:]
+	before = {chunk for _, chunk in _cuts(data, 1 << 20, min_size=256, avg_size=1024, max_size=4096)}
+	after = {chunk for _, chunk in _cuts(changed, 1 << 20, min_size=256, avg_size=1024, max_size=4096)}
+	assert len(before - after) <= 3
+
+
+def test_chunker_errors():
+	for sizes in ((32, 64, 128), (512, 256, 1024), (256, 2048, 1024)):
+		with pytest.raises(ValueError):
+			chunking.Chunker(*sizes)
+	with pytest.raises(ValueError):
+		chunking.Chunker(engine="fortran")
+
+
+@pytest.mark.parametrize("engine", [None, "numpy"])
+def test_chunk_instructions_rebuild_the_file(engine):
+	if engine:
+		pytest.importorskip(engine)
+	unpatched = random_bytes(100000, 3)
+	patched = edit(unpatched, 3)
+	num, hashes = synchronous.chunk_checksums(io.BytesIO(patched), 256, 1024, 4096, algorithm="blake2b-16", engine=engine)
+	assert hashes.length == len(patched) and hashes.algorithm == "blake2b-16"
+	local, remote = synchronous.get_chunk_instructions(io.BytesIO(unpatched), hashes, chunksize=1000, engine=engine)
+	assert local
+	sizes = chunking.chunk_sizes(remote)
+	assert sum(size * len(remote[offset][2]) for offset, size in sizes.items()) < len(patched) // 4
+
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(unpatched), result, local, length=len(patched))
+	blocks = synchronous.get_blocks(io.BytesIO(patched), list(remote), sizes)
+	synchronous.patch_remote_stream(blocks, result, remote, sizes, check_hashes=True)
+	result.truncate(len(patched))
+	assert result.getvalue() == patched
@@ -0,0 +1,175 @@
+import io
+
+import pytest
+
+import core
+import ranges
+import signature
+import synchronous
+import transfer
+import tuning
+
+BLOCKSIZE = 128
+
+
+"""
+Receives some data and a size
+Returns the data in pieces of that size, like a driver reading it
+"""
+def _pieces(data, size):
+	return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("piece", [1, 100, 1000, 1 << 20])
+def test_a_whole_sync_in_memory(data, modified, piece):
+	hasher = core.BlockHasher(BLOCKSIZE, {})
+	for chunk in _pieces(modified, piece):
+		hasher.feed(chunk)
+	num, hashes = hasher.finish()
+	scanner = core.DeltaScanner(hashes, BLOCKSIZE)
+	for chunk in _pieces(data, piece):
+		scanner.feed(chunk)
+	local, remote = scanner.finish()
+
+	result = bytearray(len(modified))
+	for local_offset, offsets in local:
+		for offset in offsets:
+			block = data[local_offset:local_offset + BLOCKSIZE]
+			result[offset:offset + len(block)] = block
+	patcher = core.Patcher(remote, check_hashes=True)
+	reader = core.RangeReader(list(remote), BLOCKSIZE)
+	bundle = b"".join(modified[start:end] for start, end in ranges.plan_ranges(list(remote), BLOCKSIZE))
+	blocks = []
+	position = 0
+	size = reader.wanted()
+	while size:
+		chunk = bundle[position:position + min(size, piece)]
+		if not chunk:
+			# The last block is shorter than its range
+			break
+		blocks.extend(reader.feed(chunk))
+		position += len(chunk)
+		size = reader.wanted()
+	assert position == len(bundle)
+	blocks.extend(reader.finish())
+	for first_offset, block in blocks:
+		for offset in patcher.writes(first_offset, block):
+			result[offset:offset + len(block)] = block
+	assert bytes(result) == modified
+
+
+def test_signature_build(data):
+	with pytest.raises(ValueError):
+		core.SignatureBuild("auto")
+	build = core.SignatureBuild(BLOCKSIZE, compact=True)
+	hasher = build.hasher()
+	hasher.feed(data)
+	count, table = build.result(*hasher.finish())
+	assert table.blocksize == BLOCKSIZE and count == len(table.entries)
+
+	# An up to date table is returned as it is, or as dictionaries
+	assert build.cached("key", table) == (count, table)
+	dictionaries = core.SignatureBuild(BLOCKSIZE).cached("key", table)[1]
+	assert dictionaries == synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE)[1]
+	# Otherwise the blocks are added to what the cache returned
+	build = core.SignatureBuild(BLOCKSIZE, compact=True)
+	builder = signature.TableBuilder(BLOCKSIZE)
+	assert build.cached("key", None) is None and build.key == "key"
+	assert build.cached("key", builder) is None and build.hasher().hashes is builder
+
+	build = core.SignatureBuild("auto", compact=True)
+	assert build.blocksize is None
+	build.blocksize = tuning.auto_blocksize(len(data))
+	hasher = build.hasher()
+	hasher.feed(data)
+	count, table = build.result(*hasher.finish())
+	assert table.record_bytes == tuning.checksum_bytes(len(data), build.blocksize)
+
+
+def test_blocksize_chooser(data, modified):
+	with pytest.raises(ValueError):
+		core.BlocksizeChooser(None)
+	chooser = core.BlocksizeChooser(len(data))
+	assert not chooser.offsets and chooser.choose([]) == tuning.auto_blocksize(len(data))
+
+	num, previous = synchronous.block_checksums(io.BytesIO(data), 1024, compact=True)
+	chooser = core.BlocksizeChooser(len(modified), previous, samples=8)
+	assert len(chooser.offsets) == 8 and chooser.window == 2048
+	windows = [modified[offset:offset + chooser.window] for offset in chooser.offsets]
+	assert chooser.choose(windows) == synchronous.choose_blocksize(io.BytesIO(modified), previous, samples=8)
+
+
+@pytest.mark.parametrize("scratch", [0, BLOCKSIZE, 1 << 20])
+def test_in_place_patcher_on_a_bytearray(data, modified, scratch):
+	num, hashes = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), hashes, BLOCKSIZE)
+	patcher = core.InPlacePatcher(local, remote, BLOCKSIZE, scratch)
+	memory = bytearray(data) + bytes(max(0, len(modified) - len(data)))
+	for action, local_offset, final_offset, size in patcher.steps(len(data)):
+		if action == "copy":
+			memory[final_offset:final_offset + size] = memory[local_offset:local_offset + size]
+		elif action == "save":
+			patcher.save(final_offset, bytes(memory[local_offset:local_offset + size]))
+		elif action == "restore":
+			saved = patcher.restore(final_offset)
+			memory[final_offset:final_offset + len(saved)] = saved
+		else:
+			patcher.drop(final_offset, bytes(memory[local_offset:local_offset + size]))
+	assert not patcher.saved
+
+	stream = io.BytesIO(data)
+	expected = synchronous.patch_in_place(stream, local, remote, BLOCKSIZE, scratch=scratch)
+	assert dict(patcher.remote_instructions) == dict(expected)
+	patched = stream.getvalue()
+	assert bytes(memory[:len(patched)]) == patched
+	# The given instructions are left as they were
+	assert patcher.remote_instructions is not remote
+
+
+def test_frame_reader(data, modified):
+	num, hashes = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), hashes, BLOCKSIZE)
+	frames = b"".join(synchronous.compress_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE, chunksize=4096))
+	reader = core.FrameReader(list(remote), BLOCKSIZE, "zlib")
+	stream = io.BytesIO(frames)
+	blocks = []
+	header = stream.read(transfer.FRAME_HEADER.size)
+	while header:
+		start = reader.header(header)
+		reader.prime(b"")
+		assert start in remote
+		while reader.left > 0:
+			blocks.extend(reader.feed(stream.read(min(reader.left, 100))))
+		header = stream.read(transfer.FRAME_HEADER.size)
+	blocks.extend(reader.finish())
+	assert sorted(blocks) == sorted(synchronous.get_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE))
+
+	reader = core.FrameReader(list(remote), BLOCKSIZE, "zlib")
+	reader.header(frames[:transfer.FRAME_HEADER.size])
+	reader.prime(b"")
+	with pytest.raises(ValueError):
+		reader.feed(b"")
+
+
+@pytest.mark.parametrize("codec", [None, "zlib"])
+def test_delta_builder(data, modified, codec):
+	num, table = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE, compact=True)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), table.copy(), BLOCKSIZE)
+	builder = core.DeltaBuilder(table, gap=512, codec=codec, dictionary_size=1024, chunksize=4096)
+	for start, end in builder.reads(remote):
+		dictionary = modified[max(0, start - builder.dictionary_size):start]
+		builder.add(start, modified[start:end], dictionary)
+	delta = builder.finish(local, remote)
+	expected = synchronous.build_delta(io.BytesIO(data), io.BytesIO(modified), table, 512, codec, dictionary_size=1024)
+	assert delta.bundle == expected.bundle
+	assert (delta.gap, delta.codec, delta.dictionary_size) == (expected.gap, expected.codec, expected.dictionary_size)
+
+
+def test_recorded_digest_and_seeds(data):
+	num, table = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=True)
+	assert core.recorded_digest(table) == synchronous.file_digest(io.BytesIO(data))
+	with pytest.raises(ValueError):
+		core.recorded_digest(table.to_hashes())
+	seeds = {"a": 1}
+	assert core.seed_dict(seeds) is seeds
+	assert core.seed_dict(["a", "b"]) == {0: "a", 1: "b"}
@@ -0,0 +1,76 @@
+import io
+
+import pytest
+
+import common
+import synchronous
+
+from .helpers import edit, random_bytes
+
+numpy = pytest.importorskip("numpy")
+
+import vectorized
+
+BLOCKSIZE = 128
+
+
+def test_adler32_roll_matches_a_fresh_checksum():
+	data = random_bytes(1000)
+	checksum = common.adler32(data[:BLOCKSIZE])
+	for position in range(len(data) - BLOCKSIZE):
+		checksum = common.adler32_roll(checksum, data[position], data[position + BLOCKSIZE], BLOCKSIZE)
+		assert checksum == common.adler32(data[position + 1:position + 1 + BLOCKSIZE])
+
+
+@pytest.mark.parametrize("blocksize", [1, 7, BLOCKSIZE, 5000])
+def test_rolling_checksums_match_adler32(blocksize):
+	data = random_bytes(10000, 1) + b"\xff" * 6000
+	stop = len(data) - blocksize + 1
+	checksums = vectorized.rolling_checksums(data, 0, stop, blocksize)
+	assert len(checksums) == stop
+	for position in list(range(0, stop, 97)) + [stop - 1]:
+		assert checksums[position] == common.adler32(data[position:position + blocksize])
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("seq_matches", [1, 2])
+@pytest.mark.parametrize("seed", range(3))
+def test_numpy_engine_finds_the_same_blocks(compact, seq_matches, seed):
+	unpatched = random_bytes(30000 + seed * 1111, seed)
+	patched = edit(unpatched, seed)
+	results = []
+	for engine in ("python", "numpy"):
+		num, hashes = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE, compact=compact, seq_matches=seq_matches)
+		results.append(synchronous.get_instructions(io.BytesIO(unpatched), hashes, BLOCKSIZE, chunksize=5000, engine=engine,
+			seq_matches=None if compact else seq_matches))
+	assert results[0][0] == results[1][0]
+	assert dict(results[0][1]) == dict(results[1][1])
+
+
+def test_numpy_engine_with_truncated_weak_hashes():
+	unpatched = random_bytes(30000, 4)
+	patched = edit(unpatched, 4)
+	num, table = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE, compact=True)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table, weak_bytes=2)
+	results = []
+	for engine in ("python", "numpy"):
+		sig.seek(0)
+		results.append(synchronous.get_instructions(io.BytesIO(unpatched), synchronous.read_signature(sig), BLOCKSIZE, engine=engine))
+	assert results[0][0] == results[1][0]
+
+
+@pytest.mark.parametrize("tail", [1, 40, BLOCKSIZE - 1])
+@pytest.mark.parametrize("chunksize", [100, BLOCKSIZE, 1000, 1 << 20])
+@pytest.mark.parametrize("after_a_match", [False, True])
+def test_both_engines_treat_the_tail_the_same(tail, chunksize, after_a_match):
+	patched = random_bytes(5 * BLOCKSIZE + tail, 6)
+	# The short last block is only found when the window before it matched
+	prefix = patched[4 * BLOCKSIZE:5 * BLOCKSIZE] if after_a_match else random_bytes(1000, 9)
+	unpatched = prefix + patched[-tail:]
+	results = []
+	for engine in ("python", "numpy"):
+		num, hashes = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE)
+		results.append(synchronous.get_instructions(io.BytesIO(unpatched), hashes, BLOCKSIZE, chunksize=chunksize, engine=engine)[0])
+	assert results[0] == results[1]
+	assert ((len(prefix), [5 * BLOCKSIZE]) in results[0]) == after_a_match
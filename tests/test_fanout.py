@@ -0,0 +1,236 @@
+import asyncio
+import io
+import threading
+
+import pytest
+
+import asynchronous
+import fanout
+import synchronous
+
+from .helpers import AsyncStream, edit, random_bytes, run
+
+BLOCKSIZE = 256
+
+
+@pytest.fixture
+def release(tmp_path):
+	new = random_bytes(50000, 1)
+	versions = {}
+	for seed in range(3):
+		old = edit(new, seed)
+		path = tmp_path / ("old" + str(seed))
+		path.write_bytes(old)
+		versions[fanout.fingerprint(synchronous.file_digest(io.BytesIO(old)))] = path
+	(tmp_path / "new").write_bytes(new)
+	num, table = synchronous.block_checksums(io.BytesIO(new), BLOCKSIZE, compact=True)
+	return versions, tmp_path / "new", table
+
+
+def _patch(old, delta):
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(old), result, delta.local_instructions, delta.blocksize, length=delta.length)
+	synchronous.patch_remote_stream(io.BytesIO(delta.bundle), result, delta.remote_instructions, delta.blocksize,
+		check_hashes=True, gap=delta.gap, codec=delta.codec, dictionary_size=delta.dictionary_size)
+	result.truncate(delta.length)
+	return result.getvalue()
+
+
+@pytest.fixture
+def builds(monkeypatch):
+	counted = []
+	scan_delta = synchronous._scan_delta
+
+	def counting(*args, **kwargs):
+		counted.append(args[0])
+		return scan_delta(*args, **kwargs)
+
+	monkeypatch.setattr(synchronous, "_scan_delta", counting)
+	return counted
+
+
+def test_fingerprint():
+	table = synchronous.block_checksums(io.BytesIO(b"data"), BLOCKSIZE, compact=True)[1]
+	assert fanout.fingerprint(table) == fanout.fingerprint(synchronous.file_digest(io.BytesIO(b"data")))
+	with pytest.raises(ValueError):
+		fanout.fingerprint((None, b""))
+
+
+@pytest.mark.parametrize("codec, gap", [(None, 0), (None, 1024), ("zlib", 0)])
+def test_deltas_are_built_once_for_every_client(release, builds, codec, gap):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	for client in list(versions) * 3:
+		delta = synchronous.fan_out(cache, client, versions, new, table, gap=gap, codec=codec, dictionary_size=4096 if codec else 0)
+		assert _patch(versions[client].read_bytes(), delta) == new.read_bytes()
+	assert sorted(builds) == sorted(versions.values())
+	assert len(cache) == len(versions)
+	# The table isn't claimed by the builds
+	assert not any(table.claimed)
+
+
+def test_unknown_clients_get_nothing(release, builds):
+	versions, new, table = release
+	assert synchronous.fan_out(fanout.DeltaCache(), "123-abcd", versions, new, table) is None
+	assert not builds
+
+
+def test_clients_arriving_together_cause_one_build(release, builds):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	client = next(iter(versions))
+	barrier = threading.Barrier(6)
+	deltas = []
+
+	def serve():
+		barrier.wait()
+		deltas.append(synchronous.fan_out(cache, client, versions, new, table))
+
+	threads = [threading.Thread(target=serve) for _ in range(6)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(builds) == 1
+	assert len(deltas) == 6 and all(delta is deltas[0] for delta in deltas)
+
+
+def test_the_parameters_are_part_of_the_key(release, builds):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	client = next(iter(versions))
+	plain = synchronous.fan_out(cache, client, versions, new, table)
+	# Without a codec the level and dictionaries don't change anything
+	assert synchronous.fan_out(cache, client, versions, new, table, level=9, dictionary_size=4096) is plain
+	spaced = synchronous.fan_out(cache, client, versions, new, table, gap=1024)
+	compressed = synchronous.fan_out(cache, client, versions, new, table, codec="zlib")
+	primed = synchronous.fan_out(cache, client, versions, new, table, codec="zlib", dictionary_size=4096)
+	assert len(builds) == len(cache) == 4
+	assert (spaced.gap, compressed.codec, primed.dictionary_size) == (1024, "zlib", 4096)
+	for delta in (plain, spaced, compressed, primed):
+		assert _patch(versions[client].read_bytes(), delta) == new.read_bytes()
+
+
+def test_different_deltas_are_built_at_the_same_time(release, monkeypatch):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	clients = list(versions)[:2]
+	# Each scan waits for the other, which can only end if they run together
+	barrier = threading.Barrier(2, timeout=10)
+	scan_delta = synchronous._scan_delta
+
+	def waiting(*args):
+		barrier.wait()
+		return scan_delta(*args)
+
+	monkeypatch.setattr(synchronous, "_scan_delta", waiting)
+	deltas = {}
+
+	def serve(client):
+		deltas[client] = synchronous.fan_out(cache, client, versions, new, table)
+
+	threads = [threading.Thread(target=serve, args=(client,)) for client in clients]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert set(deltas) == set(clients) and len(cache) == 2
+
+
+def test_a_failed_build_reaches_everyone_waiting(release, monkeypatch):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	client = next(iter(versions))
+	started, failing = threading.Event(), threading.Event()
+
+	def failure(*args):
+		started.set()
+		failing.wait(10)
+		raise OSError("unreadable")
+
+	monkeypatch.setattr(synchronous, "_scan_delta", failure)
+	errors = []
+
+	def serve():
+		try:
+			synchronous.fan_out(cache, client, versions, new, table)
+		except OSError as error:
+			errors.append(error)
+
+	builder = threading.Thread(target=serve)
+	builder.start()
+	started.wait(10)
+	future, build = cache.claim(client, fanout.fingerprint(table))
+	assert not build
+	waiter = threading.Thread(target=serve)
+	waiter.start()
+	failing.set()
+	builder.join()
+	waiter.join()
+	assert len(errors) == 2 and future.exception() is errors[0]
+	# The next request builds it again
+	monkeypatch.undo()
+	assert synchronous.fan_out(cache, client, versions, new, table) is not None
+
+
+def test_eviction(release):
+	versions, new, table = release
+	cache = fanout.DeltaCache(max_entries=2)
+	clients = list(versions)
+	for client in clients:
+		synchronous.fan_out(cache, client, versions, new, table)
+	assert len(cache) == 2
+	target = fanout.fingerprint(table)
+	assert cache.get(clients[0], target) is None
+	assert cache.get(clients[2], target, codec="zlib") is None
+	delta = cache.get(clients[2], target)
+	cache = fanout.DeltaCache(max_bytes=delta.size())
+	cache.put(clients[2], target, delta)
+	cache.put(clients[1], target, delta)
+	assert len(cache) == 1 and cache.get(clients[2], target) is None
+	cache.clear()
+	assert len(cache) == 0
+
+
+def test_asynchronous_fan_out(release):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	client = next(iter(versions))
+	streams = {fingerprint: AsyncStream(io.BytesIO(path.read_bytes())) for fingerprint, path in versions.items()}
+	stream = AsyncStream(io.BytesIO(new.read_bytes()))
+
+	async def main():
+		return await asyncio.gather(*(asynchronous.fan_out(cache, client, streams, stream, table) for _ in range(4)))
+
+	deltas = run(main)
+	assert all(delta is deltas[0] for delta in deltas)
+	assert len(cache) == 1
+	assert _patch(versions[client].read_bytes(), deltas[0]) == new.read_bytes()
+	assert run(asynchronous.fan_out, cache, "1-00", streams, stream, table) is None
+
+
+def test_asynchronous_deltas_are_built_at_the_same_time(release, monkeypatch):
+	versions, new, table = release
+	cache = fanout.DeltaCache()
+	streams = {fingerprint: AsyncStream(io.BytesIO(path.read_bytes())) for fingerprint, path in versions.items()}
+	stream = AsyncStream(io.BytesIO(new.read_bytes()))
+	scanning = []
+	scan_delta = asynchronous._scan_delta
+
+	async def waiting(old, *args):
+		scanning.append(old)
+		# Every scan waits until all of them started
+		while len(scanning) < len(streams):
+			await asyncio.sleep(0.001)
+		return await scan_delta(old, *args)
+
+	monkeypatch.setattr(asynchronous, "_scan_delta", waiting)
+
+	async def main():
+		requests = [asynchronous.fan_out(cache, client, streams, stream, table) for client in streams for _ in range(2)]
+		return await asyncio.wait_for(asyncio.gather(*requests), 10)
+
+	deltas = run(main)
+	assert len(scanning) == len(cache) == len(streams)
+	for delta, client in zip(deltas[::2], streams):
+		assert _patch(versions[client].read_bytes(), delta) == new.read_bytes()
@@ -0,0 +1,96 @@
+import io
+
+import asynchronous
+import metrics
+import synchronous
+
+from .helpers import AsyncStream, run
+
+BLOCKSIZE = 256
+
+
+def _sync(data, modified, stats):
+	num, hashes = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE, compact=True, stats=stats)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), hashes, BLOCKSIZE, stats=stats)
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(data), result, local, BLOCKSIZE, length=len(modified), stats=stats)
+	blocks = synchronous.get_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE, stats=stats)
+	synchronous.patch_remote_blocks(blocks, result, remote, stats=stats)
+	result.truncate(len(modified))
+	return result.getvalue(), local, remote
+
+
+def test_every_stage_is_counted(data, modified):
+	stats = metrics.Stats()
+	result, local, remote = _sync(data, modified, stats)
+	assert result == modified
+	assert stats.bytes_hashed == len(modified)
+	assert stats.bytes_scanned == len(data)
+	assert stats.bytes_read == stats.bytes_fetched == sum(min(BLOCKSIZE, len(modified) - offset) for offset in remote)
+	# Every byte that isn't fetched is reused
+	assert stats.bytes_reused + stats.bytes_fetched == len(modified)
+	assert stats.matched_blocks == sum(len(offsets) for _, offsets in local)
+	assert stats.weak_hits >= len(local)
+	assert stats.strong_false_positives == stats.weak_hits - stats.matched_blocks
+	for name in ("block_checksums", "get_instructions", "get_blocks", "patch_local_blocks", "patch_remote_blocks"):
+		assert stats.stages[name].wall >= 0 and stats.stages[name].cpu >= 0
+
+
+def test_stats_add_up_over_several_syncs(data, modified):
+	stats = metrics.Stats()
+	_sync(data, modified, stats)
+	first = stats.as_dict()
+	_sync(data, modified, stats)
+	second = stats.as_dict()
+	for name in ("weak_hits", "matched_blocks", "bytes_hashed", "bytes_scanned", "bytes_reused", "bytes_fetched"):
+		assert second[name] == 2 * first[name]
+	assert set(second["stages"]) == set(first["stages"])
+
+
+def test_progress_is_reported_every_interval(data, modified):
+	reports = []
+	stats = metrics.Stats(lambda name, size: reports.append((name, size)), interval=10000)
+	_sync(data, modified, stats)
+	hashed = [size for name, size in reports if name == "block_checksums"]
+	assert hashed and hashed == sorted(hashed)
+	assert all(later - earlier >= 10000 for earlier, later in zip(hashed, hashed[1:]))
+
+
+def test_results_dont_change_with_stats(data, modified):
+	assert _sync(data, modified, metrics.Stats()) == _sync(data, modified, None)
+
+
+def test_asynchronous_stages(data, modified):
+	stats = metrics.Stats()
+
+	async def main():
+		num, hashes = await asynchronous.block_checksums(AsyncStream(io.BytesIO(modified)), BLOCKSIZE, compact=True, stats=stats)
+		local, remote = await asynchronous.get_instructions(AsyncStream(io.BytesIO(data)), hashes, BLOCKSIZE, stats=stats)
+		result = AsyncStream(io.BytesIO())
+		await asynchronous.patch_local_blocks(AsyncStream(io.BytesIO(data)), result, local, BLOCKSIZE, stats=stats)
+		blocks = asynchronous.get_blocks(AsyncStream(io.BytesIO(modified)), list(remote), BLOCKSIZE, stats=stats)
+		await asynchronous.patch_remote_stream(blocks, result, remote, BLOCKSIZE, stats=stats)
+		return local
+
+	local = run(main)
+	assert stats.bytes_hashed == len(modified)
+	assert stats.bytes_scanned == len(data)
+	assert stats.matched_blocks == sum(len(offsets) for _, offsets in local)
+	assert stats.bytes_fetched == stats.bytes_read
+
+
+def test_an_identical_file_is_counted_by_the_precheck(data):
+	stats = metrics.Stats()
+	num, table = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=True)
+	local, remote = synchronous.get_instructions(io.BytesIO(data), table, BLOCKSIZE, precheck=True, stats=stats)
+	assert not remote
+	assert stats.bytes_scanned == len(data)
+	assert stats.matched_blocks == len(local) == num
+	assert stats.weak_hits == num and stats.strong_false_positives == 0
+
+	stats = metrics.Stats()
+	num, table = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=True)
+	local, remote = run(asynchronous.get_instructions, AsyncStream(io.BytesIO(data)), table, BLOCKSIZE, precheck=True, stats=stats)
+	assert stats.bytes_scanned == len(data)
+	assert stats.matched_blocks == len(local) == num
+	assert stats.weak_hits == num and stats.strong_false_positives == 0
@@ -0,0 +1,109 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import metrics
+import synchronous
+
+from .helpers import edit, random_bytes
+
+BLOCKSIZE = 128
+
+
+@pytest.fixture
+def files(tmp_path):
+	unpatched = random_bytes(40000, 7)
+	patched = edit(unpatched, 7, edits=12)
+	paths = tmp_path / "unpatched", tmp_path / "patched"
+	paths[0].write_bytes(unpatched)
+	paths[1].write_bytes(patched)
+	return paths
+
+
+@pytest.mark.parametrize("workers", [1, 3, 8])
+@pytest.mark.parametrize("compact", [False, True])
+def test_parallel_block_checksums_match_the_sequential_ones(files, workers, compact):
+	with open(files[1], "rb") as f:
+		expected = synchronous.block_checksums(f, BLOCKSIZE, compact=compact)
+	with ThreadPoolExecutor(workers) as executor:
+		num, hashes = synchronous.parallel_block_checksums(files[1], BLOCKSIZE, workers, compact=compact, executor=executor)
+	assert num == expected[0] and type(num) is type(expected[0])
+	if compact:
+		assert (hashes.length, hashes.filehash) == (expected[1].length, expected[1].filehash)
+		hashes, expected = hashes.to_hashes(), (num, expected[1].to_hashes())
+	assert hashes == expected[1]
+
+
+def test_parallel_block_checksums_can_leave_the_digest_out(files):
+	with ThreadPoolExecutor(2) as executor:
+		num, hashes = synchronous.parallel_block_checksums(files[1], BLOCKSIZE, 2, compact=True, executor=executor, digest=False)
+	assert hashes.filehash is None and hashes.length == len(files[1].read_bytes())
+	with pytest.raises(ValueError, match="digest"):
+		synchronous.verify_file(io.BytesIO(files[1].read_bytes()), hashes)
+
+
+def test_parallel_block_checksums_in_processes(files):
+	with open(files[1], "rb") as f:
+		expected = synchronous.block_checksums(f, BLOCKSIZE)
+	assert synchronous.parallel_block_checksums(files[1], BLOCKSIZE, workers=2) == expected
+
+
+@pytest.mark.parametrize("workers", [1, 2, 5])
+@pytest.mark.parametrize("seq_matches", [1, 2])
+def test_parallel_get_instructions_rebuild_the_file(files, workers, seq_matches):
+	patched = files[1].read_bytes()
+	num, table = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE, compact=True, seq_matches=seq_matches)
+	with ThreadPoolExecutor(workers) as executor:
+		local, remote = synchronous.parallel_get_instructions(files[0], table, BLOCKSIZE, workers, executor=executor)
+	# The table is left untouched
+	assert not any(table.claimed)
+	result = io.BytesIO()
+	with open(files[0], "rb") as unpatched:
+		synchronous.patch_local_blocks(unpatched, result, local, BLOCKSIZE, length=table.length)
+	synchronous.patch_remote_blocks(synchronous.get_blocks(io.BytesIO(patched), list(remote), BLOCKSIZE), result, remote, check_hashes=True)
+	assert result.getvalue() == patched
+
+	with open(files[0], "rb") as f:
+		sequential = synchronous.get_instructions(f, table.copy(), BLOCKSIZE)
+	# Shards may only miss a few matches right after a dropped one
+	assert len(local) >= len(sequential[0]) - workers
+
+
+def test_shards_overlap_so_no_window_is_missed(tmp_path):
+	blocks = [random_bytes(BLOCKSIZE, seed) for seed in range(6)]
+	patched = b"".join(blocks)
+	# Every block straddles a shard boundary of the 3 shards
+	path = tmp_path / "unpatched"
+	path.write_bytes(b"a" * 100 + patched)
+	num, hashes = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE)
+	with ThreadPoolExecutor(3) as executor:
+		local, remote = synchronous.parallel_get_instructions(path, hashes, BLOCKSIZE, 3, executor=executor)
+	assert not remote
+	assert local == [(100 + i * BLOCKSIZE, [i * BLOCKSIZE]) for i in range(6)]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_parallel_stats_add_up_every_shard(files, workers):
+	num, table = synchronous.block_checksums(io.BytesIO(files[1].read_bytes()), BLOCKSIZE, compact=True)
+	stats = metrics.Stats()
+	with ThreadPoolExecutor(workers) as executor:
+		local, remote = synchronous.parallel_get_instructions(files[0], table, BLOCKSIZE, workers, executor=executor, stats=stats)
+	sequential = metrics.Stats()
+	with open(files[0], "rb") as f:
+		synchronous.get_instructions(f, table.copy(), BLOCKSIZE, stats=sequential)
+	assert stats.bytes_scanned == sequential.bytes_scanned == files[0].stat().st_size
+	assert stats.matched_blocks == len(local)
+	# The shards overlap, so they may hash a few windows more than one scan
+	assert stats.weak_hits >= stats.matched_blocks
+	assert stats.weak_hits >= sequential.weak_hits - workers
+	if workers == 1:
+		assert stats.as_dict()["weak_hits"] == sequential.weak_hits
+
+
+def test_parallel_stats_in_processes(files):
+	num, table = synchronous.block_checksums(io.BytesIO(files[1].read_bytes()), BLOCKSIZE, compact=True)
+	stats = metrics.Stats()
+	local, remote = synchronous.parallel_get_instructions(files[0], table, BLOCKSIZE, workers=2, stats=stats)
+	assert stats.matched_blocks == len(local) and stats.weak_hits >= len(local)
+	assert stats.stages["get_instructions"].wall > 0
@@ -0,0 +1,180 @@
+import io
+import mmap
+import os
+
+import pytest
+
+import common
+import ranges
+import synchronous
+
+from .helpers import edit, instructions, random_bytes
+
+BLOCKSIZE = 128
+
+
+"""
+Runs the steps of common.plan_in_place on a bytearray, like patch_in_place does
+Returns the result and the (final_offset, size) of the dropped copies
+"""
+def _apply(steps, unpatched, length):
+	data = bytearray(unpatched)
+	data.extend(b"\0" * max(0, length - len(data)))
+	saved = {}
+	dropped = []
+	for action, local_offset, final_offset, size in steps:
+		if action == "copy":
+			data[final_offset:final_offset + size] = data[local_offset:local_offset + size]
+		elif action == "save":
+			saved[final_offset] = bytes(data[local_offset:local_offset + size])
+		elif action == "restore":
+			data[final_offset:final_offset + size] = saved.pop(final_offset)
+		else:
+			dropped.append((final_offset, size))
+	assert not saved
+	return bytes(data[:length]), dropped
+
+
+def test_plan_local_copies_merges_adjacent_blocks():
+	local = [(0, [256]), (128, [384]), (512, [0, 640]), (1024, [128])]
+	assert common.plan_local_copies(local, BLOCKSIZE) == [(512, 0, 128), (1024, 128, 128), (0, 256, 256), (512, 640, 128)]
+	# Chunks copy their own size
+	assert common.plan_local_copies([(0, [10], 7), (7, [17], 3)], BLOCKSIZE) == [(0, 10, 10)]
+
+
+@pytest.mark.parametrize("kind", ["memory", "file", "mapped"])
+def test_patch_local_blocks_copies_every_block(monkeypatch, tmp_path, data, modified, kind):
+	local, remote = instructions(data, modified, BLOCKSIZE)
+	if kind == "memory":
+		# Longer than the patched file, so it has to be resized
+		outstream = io.BytesIO(b"x" * 2 * len(modified))
+		synchronous.patch_local_blocks(io.BytesIO(data), outstream, local, BLOCKSIZE, length=len(modified))
+		result = outstream.getvalue()
+	else:
+		mapped = []
+		if kind == "mapped":
+			# Like on systems without os.copy_file_range
+			monkeypatch.delattr(os, "copy_file_range", raising=False)
+			copy_runs_mapped = synchronous._copy_runs_mapped
+
+			def spied(*args):
+				mapped.append(copy_runs_mapped(*args))
+				return mapped[-1]
+
+			monkeypatch.setattr(synchronous, "_copy_runs_mapped", spied)
+		(tmp_path / "unpatched").write_bytes(data)
+		with open(tmp_path / "unpatched", "rb") as instream, open(tmp_path / "result", "w+b") as outstream:
+			synchronous.patch_local_blocks(instream, outstream, local, BLOCKSIZE, length=len(modified))
+		result = (tmp_path / "result").read_bytes()
+		if kind == "mapped":
+			assert mapped == [True]
+	for local_offset, final_offsets in local:
+		for final_offset in final_offsets:
+			block = data[local_offset:local_offset + BLOCKSIZE]
+			assert result[final_offset:final_offset + len(block)] == block
+	assert len(result) == len(modified)
+
+
+def test_patch_remote_blocks_into_a_memory_map(tmp_path, data, modified):
+	local, remote = instructions(data, modified, BLOCKSIZE)
+	path = tmp_path / "result"
+	with open(path, "w+b") as f:
+		synchronous.patch_local_blocks(io.BytesIO(data), f, local, BLOCKSIZE, length=len(modified))
+		f.truncate(len(modified))
+		with mmap.mmap(f.fileno(), len(modified)) as mapped:
+			synchronous.patch_remote_blocks(synchronous.get_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE), mapped, remote, check_hashes=True)
+	assert path.read_bytes() == modified
+
+
+def test_patch_remote_blocks_checks_the_hashes(data, modified):
+	local, remote = instructions(data, modified, BLOCKSIZE)
+	offset = next(iter(remote))
+	with pytest.raises(Exception, match="doesn't match its hashes"):
+		synchronous.patch_remote_blocks([(offset, b"x" * BLOCKSIZE)], io.BytesIO(), remote, check_hashes=True)
+	# Unchecked blocks are written as they are
+	outstream = io.BytesIO()
+	synchronous.patch_remote_blocks([(offset, b"x" * BLOCKSIZE)], outstream, remote)
+	assert outstream.getvalue()[offset:] == b"x" * BLOCKSIZE
+
+
+@pytest.mark.parametrize("gap", [0, BLOCKSIZE, 10 * BLOCKSIZE])
+@pytest.mark.parametrize("budget", [1, 100, 1 << 16])
+def test_patch_remote_stream_from_ranges(data, modified, gap, budget):
+	local, remote = instructions(data, modified, BLOCKSIZE)
+	body = b"".join(modified[start:end] for start, end in ranges.plan_ranges(list(remote), BLOCKSIZE, gap))
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(data), result, local, BLOCKSIZE)
+	count = synchronous.patch_remote_stream(io.BytesIO(body), result, remote, BLOCKSIZE, check_hashes=True, gap=gap, budget=budget)
+	result.truncate(len(modified))
+	assert count == len(remote)
+	assert result.getvalue() == modified
+
+
+def test_patch_remote_stream_from_blocks(data, modified):
+	local, remote = instructions(data, modified, BLOCKSIZE)
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(data), result, local, BLOCKSIZE)
+	blocks = synchronous.get_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE)
+	assert synchronous.patch_remote_stream(blocks, result, remote, check_hashes=True) == len(remote)
+	result.truncate(len(modified))
+	assert result.getvalue() == modified
+
+
+def test_plan_in_place_breaks_cycles_with_scratch():
+	blocks = [random_bytes(BLOCKSIZE, seed) for seed in range(4)]
+	unpatched = b"".join(blocks)
+	# Every block takes the place of the next one
+	patched = b"".join(blocks[1:] + blocks[:1])
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+	steps = common.plan_in_place(local, BLOCKSIZE, BLOCKSIZE)
+	assert [step[0] for step in steps].count("save") == 1
+	assert "drop" not in [step[0] for step in steps]
+	assert _apply(steps, unpatched, len(patched)) == (patched, [])
+
+
+def test_plan_in_place_drops_cycles_without_scratch():
+	blocks = [random_bytes(BLOCKSIZE, seed) for seed in range(4)]
+	unpatched = b"".join(blocks)
+	patched = b"".join(blocks[1:] + blocks[:1])
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+	steps = common.plan_in_place(local, BLOCKSIZE, 0)
+	assert [step[0] for step in steps].count("drop") == 1
+	assert "save" not in [step[0] for step in steps]
+	result, dropped = _apply(steps, unpatched, len(patched))
+	# Everything but the dropped block is in place
+	(offset, size), = dropped
+	assert result[:offset] + result[offset + size:] == patched[:offset] + patched[offset + size:]
+
+
+def test_plan_in_place_swaps_and_overlapping_shifts():
+	blocks = [random_bytes(BLOCKSIZE, seed) for seed in range(6)]
+	unpatched = b"".join(blocks)
+	# Two swaps and a shift by half a block, which copies overlap
+	patched = blocks[1] + blocks[0] + blocks[3] + blocks[2] + b"y" * 64 + blocks[4] + blocks[5]
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+	steps = common.plan_in_place(local, BLOCKSIZE, 1 << 20)
+	assert [step[0] for step in steps].count("save") == 2
+	result, dropped = _apply(steps, unpatched, len(patched))
+	assert not dropped
+	for offset in range(0, len(patched), BLOCKSIZE):
+		if offset not in remote:
+			assert result[offset:offset + BLOCKSIZE] == patched[offset:offset + BLOCKSIZE]
+
+
+@pytest.mark.parametrize("scratch", [0, BLOCKSIZE, 1 << 20])
+@pytest.mark.parametrize("seed", range(3))
+def test_patch_in_place(tmp_path, scratch, seed):
+	unpatched = random_bytes(30000, seed)
+	blocks = [unpatched[i:i + 1000] for i in range(0, len(unpatched), 1000)]
+	patched = edit(b"".join(blocks[::-1]), seed, edits=4)
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+	path = tmp_path / "file"
+	path.write_bytes(unpatched)
+	with open(path, "r+b") as f:
+		missing = synchronous.patch_in_place(f, local, remote, BLOCKSIZE, length=len(patched), scratch=scratch)
+		assert set(remote) <= set(missing)
+		if not scratch:
+			assert len(missing) > len(remote)
+		blocks = synchronous.get_blocks(io.BytesIO(patched), list(missing), BLOCKSIZE)
+		synchronous.patch_remote_blocks(blocks, f, missing, check_hashes=True)
+	assert path.read_bytes() == patched
@@ -0,0 +1,81 @@
+import io
+
+import pytest
+
+import ranges
+import synchronous
+
+from .helpers import random_bytes
+
+BLOCKSIZE = 100
+
+
+def test_plan_ranges_merges_adjacent_blocks():
+	offsets = [500, 0, 100, 300, 900]
+	assert ranges.plan_ranges(offsets, BLOCKSIZE) == [(0, 200), (300, 400), (500, 600), (900, 1000)]
+	assert ranges.plan_ranges(offsets, BLOCKSIZE, gap=100) == [(0, 600), (900, 1000)]
+	assert ranges.plan_ranges(offsets, BLOCKSIZE, gap=300) == [(0, 1000)]
+	# The last block is cut at the end of the file
+	assert ranges.plan_ranges(offsets, BLOCKSIZE, length=950)[-1] == (900, 950)
+	assert ranges.plan_ranges([], BLOCKSIZE) == []
+
+
+def test_plan_ranges_of_chunks():
+	sizes = {0: 10, 10: 35, 80: 5}
+	assert ranges.plan_ranges(list(sizes), sizes) == [(0, 45), (80, 85)]
+	assert ranges.cut_ranges([(0, 45), (80, 85)], sizes, 10) == [(0, 45), (80, 85)]
+
+
+def test_cut_ranges_between_blocks():
+	assert ranges.cut_ranges([(0, 1000), (2000, 2050)], BLOCKSIZE, 350) == [(0, 300), (300, 600), (600, 900), (900, 1000), (2000, 2050)]
+	# A size smaller than a block still cuts whole blocks
+	assert ranges.cut_ranges([(0, 200)], BLOCKSIZE, 1) == [(0, 100), (100, 200)]
+
+
+def test_range_header():
+	assert ranges.range_header([(0, 200), (300, 400)]) == "bytes=0-199,300-399"
+
+
+@pytest.mark.parametrize("piece", [1, 7, BLOCKSIZE, 1000])
+def test_range_splitter_returns_every_block(piece):
+	data = random_bytes(2000)
+	offsets = [0, 100, 300, 700, 1000, 1950]
+	planned = ranges.plan_ranges(offsets, BLOCKSIZE, gap=200)
+	pieces = [(position, data[position:min(end, position + piece)]) for start, end in planned for position in range(start, end, piece)]
+	blocks = list(ranges.split_ranges(pieces, offsets, BLOCKSIZE))
+	assert blocks == [(offset, data[offset:offset + BLOCKSIZE]) for offset in offsets]
+
+
+def test_range_splitter_fails_on_missing_data():
+	data = random_bytes(1000)
+	with pytest.raises(ValueError):
+		list(ranges.split_ranges([(0, data[:200])], [0, 500], BLOCKSIZE))
+	with pytest.raises(ValueError):
+		list(ranges.split_ranges([(50, data[50:300])], [0, 100], BLOCKSIZE))
+
+
+def test_range_splitter_fails_on_truncated_blocks():
+	data = random_bytes(1000)
+	# Only the last block may be short, since it can be the end of the file
+	assert list(ranges.split_ranges([(0, data[:250])], [0, 200], BLOCKSIZE)) == [(0, data[:100]), (200, data[200:250])]
+	with pytest.raises(ValueError, match="ended inside the block at 100"):
+		list(ranges.split_ranges([(0, data[:150]), (500, data[500:600])], [0, 100, 500], BLOCKSIZE))
+	with pytest.raises(ValueError, match="ended inside the block at 0"):
+		list(ranges.split_ranges([(0, data[:50])], [0, 100], BLOCKSIZE))
+
+
+@pytest.mark.parametrize("gap", [0, 150, 10000])
+def test_get_blocks_reads_ranges(gap):
+	class CountingStream(io.BytesIO):
+		reads = 0
+
+		def read(self, size=-1):
+			self.reads += 1
+			return super().read(size)
+
+	data = random_bytes(5000)
+	offsets = [0, 100, 200, 500, 600, 4900]
+	stream = CountingStream(data)
+	blocks = list(synchronous.get_blocks(stream, offsets, BLOCKSIZE, gap=gap))
+	assert blocks == [(offset, data[offset:offset + BLOCKSIZE]) for offset in offsets]
+	assert stream.reads == len(ranges.plan_ranges(offsets, BLOCKSIZE, gap))
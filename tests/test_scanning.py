@@ -0,0 +1,126 @@
+import io
+
+import pytest
+
+import common
+import synchronous
+
+from .helpers import edit, instructions, random_bytes, sync_data
+
+BLOCKSIZE = 128
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_sync_rebuilds_the_patched_file(seed):
+	unpatched = random_bytes(20000 + seed * 777, seed)
+	patched = edit(unpatched, seed)
+	assert sync_data(unpatched, patched, BLOCKSIZE)[0] == patched
+
+
+@pytest.mark.parametrize("chunksize", [1, 100, BLOCKSIZE, 1000, 1 << 20])
+def test_chunks_of_any_size_find_the_same_blocks(chunksize):
+	unpatched = random_bytes(6000, 5)
+	patched = edit(unpatched, 5, edits=4)
+	expected = instructions(unpatched, patched, BLOCKSIZE)
+	assert instructions(unpatched, patched, BLOCKSIZE, chunksize=chunksize) == expected
+
+
+def test_moved_blocks_are_found_anywhere():
+	blocks = [random_bytes(BLOCKSIZE, seed) for seed in range(8)]
+	unpatched = b"".join(blocks)
+	patched = b"".join(reversed(blocks))
+	local, remote = instructions(b"xyz" + unpatched, patched, BLOCKSIZE)
+	assert not remote
+	assert sorted(local) == [(3 + i * BLOCKSIZE, [(7 - i) * BLOCKSIZE]) for i in range(8)]
+
+
+def test_identical_short_last_block_is_matched_after_a_match():
+	patched = random_bytes(5 * BLOCKSIZE + 40, 6)
+	local, remote = instructions(patched, patched, BLOCKSIZE)
+	assert not remote
+	assert (5 * BLOCKSIZE, [5 * BLOCKSIZE]) in local
+
+
+def test_empty_files():
+	assert instructions(b"", b"", BLOCKSIZE) == ([], {})
+	local, remote = instructions(b"", random_bytes(300), BLOCKSIZE)
+	assert local == [] and sorted(remote) == [0, BLOCKSIZE, 2 * BLOCKSIZE]
+	assert instructions(random_bytes(300), b"", BLOCKSIZE) == ([], {})
+
+
+@pytest.mark.parametrize("algorithm", ["md5", "md5-8", "blake2b", "blake2b-16", "blake2s-4"])
+def test_strong_hash_algorithms(data, modified, algorithm):
+	num, table = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE, compact=True, algorithm=algorithm)
+	assert table.algorithm == algorithm
+	assert table.digest_size == len(common.strong_hash(algorithm)(b""))
+	local, remote = synchronous.get_instructions(io.BytesIO(data), table, BLOCKSIZE)
+	assert remote.algorithm == algorithm
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(data), result, local, BLOCKSIZE, length=len(modified))
+	blocks = synchronous.get_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE)
+	synchronous.patch_remote_blocks(blocks, result, remote, check_hashes=True)
+	assert result.getvalue() == modified
+
+
+def test_strong_hash_errors():
+	for algorithm in ("sha1", "md5-0", "md5-17", "blake2s-33"):
+		with pytest.raises(ValueError):
+			common.strong_hash(algorithm)
+	with pytest.raises(ValueError):
+		synchronous.get_instructions(io.BytesIO(b""), {}, BLOCKSIZE, engine="fortran")
+
+
+def test_dictionaries_need_the_algorithm_given_again(data, modified):
+	checksums = {"algorithm": "blake2b-16"}
+	expected = instructions(data, modified, BLOCKSIZE, checksums=checksums, algorithm="blake2b-16")
+	assert expected[0]
+	assert instructions(data, modified, BLOCKSIZE, checksums=checksums)[0] == []
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_sequential_matches_skip_lone_blocks(compact):
+	blocks = [random_bytes(BLOCKSIZE, seed) for seed in range(10)]
+	patched = b"".join(blocks)
+	# Block 3 is on its own, blocks 6 to 9 follow each other
+	unpatched = blocks[3] + random_bytes(50, 11) + b"".join(blocks[6:])
+	single = instructions(unpatched, patched, BLOCKSIZE, compact=compact)
+	# The table records seq_matches, the dictionaries need it given again
+	double = instructions(unpatched, patched, BLOCKSIZE, compact=compact, checksums={"seq_matches": 2}, seq_matches=None if compact else 2)
+	assert [offsets[0] for _, offsets in single[0]] == [3 * BLOCKSIZE] + [i * BLOCKSIZE for i in range(6, 10)]
+	assert [offsets[0] for _, offsets in double[0]] == [i * BLOCKSIZE for i in range(6, 10)]
+
+
+def test_sequential_matches_rebuild_the_file(data, modified):
+	assert sync_data(data, modified, BLOCKSIZE, seq_matches=2)[0] == modified
+	with pytest.raises(ValueError):
+		instructions(data, modified, BLOCKSIZE, seq_matches=3)
+
+
+def test_precheck_skips_identical_files(data):
+	num, table = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=True)
+	stream = io.BytesIO(data)
+	local, remote = synchronous.get_instructions(stream, table, BLOCKSIZE, precheck=True)
+	assert not remote
+	assert local == [(offsets[0], offsets) for offsets in sorted(table.offsets(entry) for entry in range(len(table.weaks)))]
+	assert stream.tell() == 0
+
+
+def test_precheck_with_a_known_digest(data, modified):
+	num, table = synchronous.block_checksums(io.BytesIO(modified), BLOCKSIZE, compact=True)
+	length, digest = synchronous.file_digest(io.BytesIO(data))
+	# The digest doesn't match, so the file is scanned as usual
+	local, remote = synchronous.get_instructions(io.BytesIO(data), table, BLOCKSIZE, digest=digest)
+	assert remote
+	table.reset()
+	length, digest = synchronous.file_digest(io.BytesIO(modified))
+	local, remote = synchronous.get_instructions(io.BytesIO(modified), table, BLOCKSIZE, digest=digest)
+	assert not remote
+
+
+def test_verify_file(data, modified):
+	num, table = synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE, compact=True)
+	assert synchronous.verify_file(io.BytesIO(data), table)
+	assert not synchronous.verify_file(io.BytesIO(modified), table)
+	assert not synchronous.verify_file(io.BytesIO(data[:-1] + b"\0"), table)
+	with pytest.raises(ValueError):
+		synchronous.verify_file(io.BytesIO(data), synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE)[1])
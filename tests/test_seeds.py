@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+import asynchronous
+import synchronous
+
+from .helpers import AsyncStream, random_bytes, run
+
+BLOCKSIZE = 128
+
+
+"""
+A seed that fails the test if it's read, since nothing is missing by then
+"""
+class UnreadableStream(io.BytesIO):
+	def read(self, size=-1):
+		raise AssertionError("The seed was read")
+
+
+@pytest.fixture
+def blocks():
+	return [random_bytes(BLOCKSIZE, seed) for seed in range(12)]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_blocks_come_from_the_first_seed_that_has_them(blocks, compact):
+	patched = b"".join(blocks)
+	seeds = [b"".join(blocks[:4]) + blocks[8], random_bytes(50) + b"".join(blocks[2:9])]
+	num, hashes = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE, compact=compact)
+	seed_instructions, remote = synchronous.get_seed_instructions([io.BytesIO(seed) for seed in seeds], hashes, BLOCKSIZE)
+	assert sorted(offsets[0] for _, offsets in seed_instructions[0]) == [i * BLOCKSIZE for i in (0, 1, 2, 3, 8)]
+	assert sorted(offsets[0] for _, offsets in seed_instructions[1]) == [i * BLOCKSIZE for i in range(4, 8)]
+	assert sorted(remote) == [i * BLOCKSIZE for i in range(9, 12)]
+
+	result = io.BytesIO()
+	synchronous.patch_seed_blocks([io.BytesIO(seed) for seed in seeds], result, seed_instructions, BLOCKSIZE, length=len(patched))
+	synchronous.patch_remote_blocks(synchronous.get_blocks(io.BytesIO(patched), list(remote), BLOCKSIZE), result, remote, check_hashes=True)
+	assert result.getvalue() == patched
+
+
+def test_seeds_by_id_and_path(tmp_path, blocks):
+	patched = b"".join(blocks)
+	seeds = {"first": tmp_path / "first", "second": tmp_path / "second", "third": UnreadableStream()}
+	seeds["first"].write_bytes(b"".join(blocks[6:]))
+	seeds["second"].write_bytes(b"".join(blocks[:6]))
+	num, table = synchronous.block_checksums(io.BytesIO(patched), BLOCKSIZE, compact=True)
+	seed_instructions, remote = synchronous.get_seed_instructions(seeds, table, BLOCKSIZE)
+	assert set(seed_instructions) == {"first", "second"}
+	assert not remote
+
+	with open(tmp_path / "result", "wb") as result:
+		synchronous.patch_seed_blocks(seeds, result, seed_instructions, BLOCKSIZE, length=len(patched))
+	assert (tmp_path / "result").read_bytes() == patched
+
+
+def test_asynchronous_seeds(blocks):
+	patched = b"".join(blocks)
+	seeds = [b"".join(blocks[::2]), b"".join(blocks[1::2])]
+
+	async def main():
+		num, hashes = await asynchronous.block_checksums(AsyncStream(io.BytesIO(patched)), BLOCKSIZE, compact=True)
+		seed_instructions, remote = await asynchronous.get_seed_instructions([AsyncStream(io.BytesIO(seed)) for seed in seeds], hashes, BLOCKSIZE)
+		result = AsyncStream(io.BytesIO(b"x" * 2 * len(patched)))
+		await asynchronous.patch_seed_blocks([AsyncStream(io.BytesIO(seed)) for seed in seeds], result, seed_instructions, BLOCKSIZE, length=hashes.length)
+		return seed_instructions, remote, result.getvalue()
+
+	seed_instructions, remote, result = run(main)
+	assert len(seed_instructions[0]) == len(seed_instructions[1]) == 6
+	assert not remote
+	assert result == patched
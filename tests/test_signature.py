@@ -0,0 +1,193 @@
+import io
+from array import array
+
+import pytest
+
+import signature
+import synchronous
+
+from .helpers import edit, random_bytes, sync_data
+
+BLOCKSIZE = 256
+
+
+def _table(data, blocksize=BLOCKSIZE, **kwargs):
+	return synchronous.block_checksums(io.BytesIO(data), blocksize, compact=True, **kwargs)[1]
+
+
+def test_table_finds_the_same_blocks_as_the_dictionaries(data, modified):
+	result, local, remote = sync_data(data, modified, BLOCKSIZE)
+	compact_result, compact_local, compact_remote = sync_data(data, modified, BLOCKSIZE, compact=True)
+	assert result == compact_result == modified
+	assert compact_local == local
+	assert dict(compact_remote) == dict(remote)
+
+
+def test_table_describes_its_file(data):
+	table = _table(data)
+	assert table.length == len(data)
+	assert table.filehash == synchronous.file_digest(io.BytesIO(data))[1]
+	assert len(table.entries) == -(-len(data) // BLOCKSIZE)
+	assert table.to_hashes() == synchronous.block_checksums(io.BytesIO(data), BLOCKSIZE)[1]
+
+
+def test_table_shares_repeated_blocks():
+	block = random_bytes(BLOCKSIZE, 1)
+	data = block * 3 + random_bytes(BLOCKSIZE, 2) + block
+	table = _table(data)
+	assert len(table.weaks) == 2
+	assert table.instruction(0)[2] == [0, BLOCKSIZE, 2 * BLOCKSIZE, 4 * BLOCKSIZE]
+
+
+def test_claimed_entries_stop_matching(data):
+	table = _table(data)
+	weak, strong, offsets = table.instruction(BLOCKSIZE)
+	assert weak in table
+	assert table.claim(weak, strong) == offsets
+	assert weak not in table
+	assert table.claim(weak, strong) is None
+	assert BLOCKSIZE not in table.remote_instructions()
+
+	copy = table.copy()
+	table.reset()
+	assert weak in table
+	assert weak not in copy
+
+
+def test_copies_claim_on_their_own(data, modified):
+	table = _table(modified)
+	first = synchronous.get_instructions(io.BytesIO(data), table.copy(), BLOCKSIZE)
+	second = synchronous.get_instructions(io.BytesIO(data), table.copy(), BLOCKSIZE)
+	assert first[0] == second[0]
+	assert not any(table.claimed)
+
+
+@pytest.mark.parametrize("weak_bytes, strong_bytes", [(4, 16), (3, 8), (2, 4)])
+def test_signature_file_round_trip_patches_the_file(data, modified, weak_bytes, strong_bytes):
+	table = _table(modified)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table, weak_bytes, strong_bytes)
+	assert len(sig.getvalue()) == signature.HEADER_SIZE + len("md5") + 16 + len(table.entries) * (weak_bytes + strong_bytes)
+
+	sig.seek(0)
+	read = synchronous.read_signature(sig)
+	assert (read.blocksize, read.length, read.filehash, read.algorithm) == (BLOCKSIZE, len(modified), table.filehash, "md5")
+	assert (read.weak_bytes, read.digest_size) == (weak_bytes, strong_bytes)
+
+	local, remote = synchronous.get_instructions(io.BytesIO(data), read, BLOCKSIZE)
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(data), result, local, BLOCKSIZE, length=read.length)
+	blocks = synchronous.get_blocks(io.BytesIO(modified), list(remote), BLOCKSIZE)
+	synchronous.patch_remote_blocks(blocks, result, remote, check_hashes=True)
+	assert result.getvalue() == modified
+	assert synchronous.verify_file(io.BytesIO(result.getvalue()), read)
+
+
+def test_signature_file_records_the_parameters(data):
+	table = _table(data, algorithm="blake2b-8", seq_matches=2)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table)
+	sig.seek(0)
+	read = synchronous.read_signature(sig)
+	assert (read.algorithm, read.seq_matches, read.digest_size) == ("blake2b-8", 2, 8)
+	assert read.to_hashes() == table.to_hashes()
+
+
+def test_signature_file_errors(data):
+	table = _table(data)
+	with pytest.raises(ValueError):
+		synchronous.write_signature(io.BytesIO(), table, weak_bytes=5)
+	with pytest.raises(ValueError):
+		synchronous.write_signature(io.BytesIO(), table, strong_bytes=1)
+
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table)
+	with pytest.raises(ValueError):
+		synchronous.read_signature(io.BytesIO(b"NOPE" + sig.getvalue()[4:]))
+	with pytest.raises(ValueError):
+		synchronous.read_signature(io.BytesIO(sig.getvalue()[:-1]))
+	with pytest.raises(ValueError):
+		synchronous.read_signature(io.BytesIO(sig.getvalue()[:10]))
+
+
+def test_truncated_weak_hashes_still_match():
+	data = random_bytes(32 * 1024, 3)
+	table = _table(data)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table, weak_bytes=2, strong_bytes=16)
+	sig.seek(0)
+	read = synchronous.read_signature(sig)
+	shifted = edit(data, 4, edits=2)
+	local, remote = synchronous.get_instructions(io.BytesIO(shifted), read, BLOCKSIZE)
+	assert len(local) + len(remote) == len(read.weaks)
+	assert local
+
+
+def _live_bits(table):
+	bits, shift = table.unclaimed_slots()
+	return {bit for bit in range(8 * len(bits)) if bits[bit >> 3] >> (bit & 7) & 1}
+
+
+def test_unclaimed_slots_follow_the_claims():
+	block = random_bytes(BLOCKSIZE, 1)
+	# Two entries share the weak hash of "block" when their strong hashes differ
+	data = block + random_bytes(BLOCKSIZE, 2) + block
+	table = _table(data)
+	weak, strong, offsets = table.instruction(0)
+	every = {table._bit(weak) for weak in table.weaks}
+	assert _live_bits(table) == every
+	copy = table.copy()
+	assert table.claim(weak, strong) == offsets
+	assert table._bit(weak) not in _live_bits(table)
+	assert weak not in table
+	assert table._bit(weak) in _live_bits(copy)
+	assert weak in copy
+	table.reset()
+	assert _live_bits(table) == every
+	table.claim_all()
+	assert not _live_bits(table)
+
+
+def test_shared_weak_hashes_stay_until_every_entry_is_claimed():
+	# The first two blocks share a weak hash but not their strong hash
+	digests = b"".join(bytes([block]) * 16 for block in range(4))
+	table = signature.SignatureTable.from_blocks(BLOCKSIZE, array("I", [7, 7, 9, 11]), digests)
+	assert len(table.weaks) == 4 and len(table) == 3
+	assert table.claim(7, digests[:16]) == [0]
+	assert 7 in table
+	assert table.claim(7, digests[16:32]) == [BLOCKSIZE]
+	assert 7 not in table and 9 in table
+
+
+def test_unclaimed_slots_keep_a_bit_until_all_its_weak_hashes_are_claimed():
+	digests = bytes(range(32))
+	table = signature.SignatureTable.from_blocks(BLOCKSIZE, array("I", [1, 2]), digests)
+	# Two weak hashes that get the same bit, and so the same slot
+	bits = {}
+	weak = 1
+	while table._bit(weak) not in bits:
+		bits[table._bit(weak)] = weak
+		weak += 1
+	first, second = bits[table._bit(weak)], weak
+	table = signature.SignatureTable.from_blocks(BLOCKSIZE, array("I", [first, second]), digests)
+	bit = table._bit(first)
+	assert bit in _live_bits(table)
+	table.claim(first, table.digest(table.find(first)))
+	assert bit in _live_bits(table) and first not in table
+	table.claim(second, table.digest(table.find(second)))
+	assert bit not in _live_bits(table)
+
+
+def test_scanning_doesnt_look_every_window_up_in_python(monkeypatch, data):
+	table = _table(data)
+	calls = []
+	contains = signature.SignatureTable.__contains__
+
+	def counted(self, weak):
+		calls.append(weak)
+		return contains(self, weak)
+
+	monkeypatch.setattr(signature.SignatureTable, "__contains__", counted)
+	local, remote = synchronous.get_instructions(io.BytesIO(random_bytes(len(data), 1)), table, BLOCKSIZE)
+	# Only the few windows that share a bit of the bitmap with some block get there
+	assert len(calls) < len(data) / 32
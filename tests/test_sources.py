@@ -0,0 +1,132 @@
+import http.server
+import threading
+import urllib.error
+
+import pytest
+
+import asynchronous
+import sources
+
+from .helpers import random_bytes, run
+
+BLOCKSIZE = 256
+
+
+"""
+Serves "data" with Range requests over keep-alive connections, answering the paths
+in "statuses" with that status instead, and counting the connections and requests
+"""
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	# Headers and body in one write, or Nagle's algorithm delays every answer
+	wbufsize = 65536
+
+	def setup(self):
+		super().setup()
+		self.server.connections += 1
+
+	def do_GET(self):
+		self.server.requests.append(self.path)
+		status = self.server.statuses.get(self.path)
+		if status is not None:
+			self.send_response(status)
+			if status in (301, 302, 307):
+				self.send_header("Location", "/file")
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		first, last = self.headers["Range"].split("=")[1].split("-")
+		body = self.server.data[int(first):int(last) + 1]
+		self.send_response(206)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		# Hang up without telling, like a server whose keep-alive timeout ran out
+		self.close_connection = self.server.hang_up
+
+	def log_message(self, *args):
+		pass
+
+
+@pytest.fixture
+def server():
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+	server.data = random_bytes(100 * BLOCKSIZE)
+	server.statuses = {}
+	server.connections = 0
+	server.requests = []
+	server.hang_up = False
+	thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+	thread.start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def _url(server, path="/file"):
+	return "http://127.0.0.1:" + str(server.server_address[1]) + path
+
+
+async def _collect(blocks):
+	return sorted([block async for block in blocks])
+
+
+def test_transient_errors():
+	assert sources.transient(ConnectionResetError())
+	assert sources.transient(TimeoutError())
+	assert sources.transient(urllib.error.HTTPError("url", 503, "Unavailable", None, None))
+	assert sources.transient(urllib.error.HTTPError("url", 429, "Too Many Requests", None, None))
+	assert sources.transient(urllib.error.URLError(ConnectionRefusedError()))
+	assert not sources.transient(urllib.error.HTTPError("url", 404, "Not Found", None, None))
+	assert not sources.transient(urllib.error.HTTPError("url", 403, "Forbidden", None, None))
+	assert not sources.transient(FileNotFoundError())
+	assert not sources.transient(PermissionError())
+	assert not sources.transient(ValueError())
+
+
+def test_http_source_reuses_its_connections(server):
+	source = sources.HTTPSource(_url(server))
+	offsets = list(range(0, 100 * BLOCKSIZE, 2 * BLOCKSIZE))
+	try:
+		blocks = run(_collect, asynchronous.fetch_blocks(source, offsets, BLOCKSIZE, concurrency=1, range_size=BLOCKSIZE))
+	finally:
+		source.close()
+	assert blocks == [(offset, server.data[offset:offset + BLOCKSIZE]) for offset in offsets]
+	assert len(server.requests) == len(offsets)
+	assert server.connections == 1
+
+
+def test_http_source_replaces_connections_closed_by_the_server(server):
+	server.hang_up = True
+	source = sources.HTTPSource(_url(server))
+	offsets = [0, 10 * BLOCKSIZE, 20 * BLOCKSIZE]
+	blocks = run(_collect, asynchronous.fetch_blocks(source, offsets, BLOCKSIZE, concurrency=1, retries=0, range_size=BLOCKSIZE))
+	source.close()
+	assert blocks == [(offset, server.data[offset:offset + BLOCKSIZE]) for offset in offsets]
+	assert server.connections == 3
+
+
+def test_http_source_follows_redirects(server):
+	server.statuses["/old"] = 302
+	source = sources.HTTPSource(_url(server, "/old"))
+	blocks = run(_collect, asynchronous.fetch_blocks(source, [BLOCKSIZE], BLOCKSIZE))
+	source.close()
+	assert blocks == [(BLOCKSIZE, server.data[BLOCKSIZE:2 * BLOCKSIZE])]
+	assert server.requests == ["/old", "/file"]
+
+
+@pytest.mark.parametrize("status, attempts", [(404, 1), (403, 1), (503, 3), (429, 3)])
+def test_only_transient_statuses_are_retried(server, status, attempts):
+	server.statuses["/file"] = status
+	source = sources.HTTPSource(_url(server))
+	with pytest.raises(urllib.error.HTTPError) as error:
+		run(_collect, asynchronous.fetch_blocks(source, [0], BLOCKSIZE, retries=2, backoff=0))
+	source.close()
+	assert error.value.code == status
+	assert len(server.requests) == attempts
+
+
+def test_missing_files_are_not_retried(tmp_path):
+	source = sources.FileSource(tmp_path / "missing")
+	with pytest.raises(FileNotFoundError):
+		run(_collect, asynchronous.fetch_blocks(source, [0], BLOCKSIZE, retries=5, backoff=0))
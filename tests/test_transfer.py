@@ -0,0 +1,132 @@
+import io
+
+import pytest
+
+import asynchronous
+import synchronous
+import transfer
+
+from .helpers import AsyncStream, instructions, random_bytes, run
+
+BLOCKSIZE = 256
+
+
+def _text(size, seed=0):
+	# Compressible data, so that the dictionaries make a difference
+	words = [random_bytes(6, seed * 100 + number).hex().encode() for number in range(50)]
+	data = random_bytes(size // 4, seed)
+	return b" ".join(words[byte % 50] for byte in data)[:size]
+
+
+@pytest.mark.parametrize("codec", transfer.CODECS)
+def test_compress_round_trip(codec):
+	data = _text(50000)
+	dictionary = _text(5000, 1)
+	for level, primer in ((None, b""), (1, dictionary)):
+		compressed = transfer.compress(data, codec, level, primer)
+		decompressor = transfer.decompressor(codec, primer)
+		assert b"".join(decompressor.decompress(compressed[i:i + 100]) for i in range(0, len(compressed), 100)) == data
+
+
+def test_unknown_codecs():
+	with pytest.raises(ValueError):
+		transfer.compress(b"data", "lzma")
+	with pytest.raises(ValueError):
+		transfer.decompressor("lzma")
+	if "zstd" not in transfer.CODECS:
+		with pytest.raises(ValueError, match="zstandard"):
+			transfer.compress(b"data", "zstd")
+
+
+def test_frame_header():
+	frame = transfer.encode_frame(12345, b"compressed")
+	assert transfer.decode_frame_header(frame[:transfer.FRAME_HEADER.size]) == (12345, len(b"compressed"))
+	with pytest.raises(ValueError):
+		transfer.decode_frame_header(frame[:3])
+
+
+@pytest.mark.parametrize("codec", transfer.CODECS)
+@pytest.mark.parametrize("dictionary_size", [0, 32768])
+@pytest.mark.parametrize("budget", [7, 1 << 20])
+def test_compressed_blocks_patch_the_file(codec, dictionary_size, budget):
+	unpatched = _text(100000)
+	patched = bytearray(unpatched)
+	for position in range(1000, len(patched), 9000):
+		patched[position:position + 300] = _text(300, position)
+	patched = bytes(patched)
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+
+	frames = b"".join(synchronous.compress_blocks(io.BytesIO(patched), list(remote), BLOCKSIZE, codec=codec,
+		dictionary_size=dictionary_size, chunksize=4 * BLOCKSIZE))
+	result = io.BytesIO()
+	synchronous.patch_local_blocks(io.BytesIO(unpatched), result, local, BLOCKSIZE)
+	count = synchronous.patch_remote_stream(io.BytesIO(frames), result, remote, BLOCKSIZE, check_hashes=True,
+		budget=budget, codec=codec, dictionary_size=dictionary_size)
+	result.truncate(len(patched))
+	assert count == len(remote)
+	assert result.getvalue() == patched
+
+	if dictionary_size:
+		plain = b"".join(synchronous.compress_blocks(io.BytesIO(patched), list(remote), BLOCKSIZE, codec=codec, chunksize=4 * BLOCKSIZE))
+		assert len(frames) < len(plain)
+
+
+def test_truncated_frames_fail():
+	unpatched = random_bytes(10000)
+	patched = random_bytes(3000, 1) + unpatched
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+	frames = b"".join(synchronous.compress_blocks(io.BytesIO(patched), list(remote), BLOCKSIZE))
+	with pytest.raises(ValueError):
+		synchronous.patch_remote_stream(io.BytesIO(frames[:-5]), io.BytesIO(), remote, BLOCKSIZE, codec="zlib")
+
+
+@pytest.mark.parametrize("dictionary_size", [0, 32768])
+def test_asynchronous_compressed_blocks(dictionary_size):
+	unpatched = _text(60000)
+	patched = _text(2000, 3) + unpatched[:30000] + _text(2000, 4) + unpatched[30000:]
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+
+	async def main():
+		frames = [frame async for frame in asynchronous.compress_blocks(AsyncStream(io.BytesIO(patched)), list(remote),
+			BLOCKSIZE, dictionary_size=dictionary_size, chunksize=4 * BLOCKSIZE)]
+		result = AsyncStream(io.BytesIO())
+		await asynchronous.patch_local_blocks(AsyncStream(io.BytesIO(unpatched)), result, local, BLOCKSIZE)
+		await asynchronous.patch_remote_stream(AsyncStream(io.BytesIO(b"".join(frames))), result, remote, BLOCKSIZE,
+			check_hashes=True, budget=1000, codec="zlib", dictionary_size=dictionary_size)
+		await result.truncate(len(patched))
+		return result.getvalue()
+
+	assert run(main) == patched
+
+
+"""
+An Offloader that records the jobs it runs
+"""
+class RecordingOffloader(asynchronous.Offloader):
+	def __init__(self):
+		super().__init__()
+		self.jobs = []
+
+	async def run(self, function, *args):
+		self.jobs.append(function)
+		return await super().run(function, *args)
+
+
+def test_frames_are_decompressed_by_the_given_offloader(monkeypatch):
+	unpatched = _text(30000)
+	patched = _text(3000, 3) + unpatched
+	local, remote = instructions(unpatched, patched, BLOCKSIZE)
+	frames = b"".join(synchronous.compress_blocks(io.BytesIO(patched), list(remote), BLOCKSIZE, chunksize=4 * BLOCKSIZE))
+	offloader = RecordingOffloader()
+	monkeypatch.setattr(asynchronous, "_OFFLOADER", None)
+
+	async def main():
+		result = AsyncStream(io.BytesIO())
+		await asynchronous.patch_local_blocks(AsyncStream(io.BytesIO(unpatched)), result, local, BLOCKSIZE)
+		await asynchronous.patch_remote_stream(AsyncStream(io.BytesIO(frames)), result, remote, BLOCKSIZE,
+			codec="zlib", offloader=offloader)
+		await result.truncate(len(patched))
+		return result.getvalue()
+
+	assert run(main) == patched
+	assert offloader.jobs
@@ -0,0 +1,99 @@
+import io
+import math
+
+import pytest
+
+import synchronous
+import tuning
+
+from .helpers import edit, random_bytes
+
+
+def test_auto_blocksize_is_the_square_root():
+	assert tuning.auto_blocksize(0) == 700
+	assert tuning.auto_blocksize(10 ** 6) == 1000
+	assert tuning.auto_blocksize(10 ** 8) == 10000
+	assert tuning.auto_blocksize(10 ** 12) == 128 * 1024
+	assert all(tuning.auto_blocksize(length) % 8 == 0 for length in (10 ** 6, 12345678, 10 ** 9))
+
+
+def test_checksum_bytes_grow_with_the_file():
+	small = tuning.checksum_bytes(10 ** 4, 700)
+	large = tuning.checksum_bytes(10 ** 10, 100000)
+	assert small[0] <= large[0] and small[1] <= large[1]
+	assert 2 <= small[0] and large[0] <= 4
+	assert 2 <= small[1] and large[1] <= 16
+	# Two consecutive blocks have to match, so every hash can be shorter
+	paired = tuning.checksum_bytes(10 ** 10, 100000, seq_matches=2)
+	assert paired[0] <= large[0] and paired[1] < large[1]
+	assert tuning.checksum_bytes(0, 700) == tuning.checksum_bytes(1, 700)
+
+
+"""
+Receives the size of a file, its blocksize and seq_matches
+Returns the (weak, strong) lengths as zsync's make.c writes them, in natural logs
+and with its integer division of the file size
+"""
+def _zsync_checksum_bytes(length, blocksize, seq_matches):
+	rsum_len = math.ceil(((math.log(length) + math.log(blocksize)) / math.log(2) - 8.6) / seq_matches / 8)
+	rsum_len = min(4, max(2, rsum_len))
+	checksum_len = math.ceil((20 + (math.log(length) + math.log(1 + length // blocksize)) / math.log(2)) / seq_matches / 8)
+	checksum_len2 = int((7.9 + (20 + math.log(1 + length // blocksize) / math.log(2))) / 8)
+	return rsum_len, min(16, max(checksum_len, checksum_len2))
+
+
+@pytest.mark.parametrize("seq_matches", [1, 2])
+def test_checksum_bytes_follow_zsync(seq_matches):
+	for length in (1, 1000, 10 ** 4, 12345678, 10 ** 9, 10 ** 12, 2 ** 40 + 5):
+		for blocksize in (700, 1024, 2048, 10000, 128 * 1024):
+			assert tuning.checksum_bytes(length, blocksize, seq_matches) == _zsync_checksum_bytes(length, blocksize, seq_matches)
+	# The floor keeps a few blocks of 2 consecutive matches at 3 bytes, like zsync
+	assert tuning.checksum_bytes(10 ** 4, 2048, seq_matches=2)[1] == 3
+
+
+def test_auto_blocksize_signatures():
+	data = random_bytes(1 << 20)
+	num, table = synchronous.block_checksums(io.BytesIO(data), "auto", compact=True)
+	assert table.blocksize == tuning.auto_blocksize(len(data))
+	assert table.record_bytes == tuning.checksum_bytes(len(data), table.blocksize)
+	sig = io.BytesIO()
+	synchronous.write_signature(sig, table)
+	sig.seek(0)
+	read = synchronous.read_signature(sig)
+	assert (read.weak_bytes, read.digest_size) == table.record_bytes
+	local, remote = synchronous.get_instructions(io.BytesIO(edit(data)), read, read.blocksize)
+	assert local
+	with pytest.raises(ValueError):
+		synchronous.block_checksums(io.BytesIO(data), "auto")
+
+
+def test_choose_blocksize_from_the_edits():
+	data = random_bytes(1 << 20)
+	num, previous = synchronous.block_checksums(io.BytesIO(data), 1024, compact=True)
+	# Identical files fetch nothing, so the blocks can be as large as they go
+	stream = io.BytesIO(data)
+	stream.seek(100)
+	assert synchronous.choose_blocksize(stream, previous) == 128 * 1024
+	assert stream.tell() == 100
+
+	few = synchronous.choose_blocksize(io.BytesIO(edit(data, edits=4)), previous)
+	many = synchronous.choose_blocksize(io.BytesIO(edit(data, edits=400)), previous)
+	assert many < few
+	assert synchronous.choose_blocksize(io.BytesIO(data)) == tuning.auto_blocksize(len(data))
+
+
+def test_unmatched_fraction():
+	data = random_bytes(64 * 1024)
+	num, table = synchronous.block_checksums(io.BytesIO(data), 1024, compact=True)
+	windows = [data[offset + 100:offset + 2148] for offset in range(0, 60000, 6000)]
+	assert tuning.unmatched_fraction(table, windows) == 0
+	assert tuning.unmatched_fraction(table, [random_bytes(2048, 1)] + windows[1:]) == 0.1
+	assert tuning.unmatched_fraction(table, []) == 0
+	# The table itself isn't claimed
+	assert not any(table.claimed)
+
+
+def test_sample_offsets():
+	assert tuning.sample_offsets(100, 200) == [0]
+	offsets = tuning.sample_offsets(10 ** 6, 2048, 10)
+	assert len(offsets) == 10 and offsets[0] == 0 and offsets[-1] == 10 ** 6 - 2048
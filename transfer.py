@@ -0,0 +1,88 @@
+"""
+=== TRANSFER ===
+The missing blocks can be sent compressed instead of raw (see compress_blocks and
+patch_remote_stream in either module). The ranges are compressed on their own, as
+frames of a header with their start and compressed size followed by the compressed
+data, so every frame can be decompressed as soon as it arrives
+Each frame can be primed with a dictionary: the bytes of the patched file right
+before it. The receiving side patches the frames in file order, so by then it has
+them in the result file, either because they matched its unpatched file or because
+they came in an earlier frame, and the dictionary never has to be sent
+"""
+import struct
+import zlib
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+FRAME_HEADER = struct.Struct(">QI")
+
+"""
+The codecs that can compress the blocks
+	zlib - from the standard library. Its window is 32KiB, so a dictionary is only
+	       useful up to that size
+	zstd - better and faster compression, with dictionaries of any size (requires zstandard)
+"""
+CODECS = ("zlib", "zstd") if zstandard is not None else ("zlib",)
+
+
+def _check_codec(codec):
+	if codec not in CODECS:
+		if codec == "zstd":
+			raise ValueError("The zstd codec requires the zstandard module")
+		raise ValueError("Unknown codec "+repr(codec)+", expected one of "+", ".join(CODECS))
+
+
+"""
+Receives some data, a codec, a compression level (None for the codec's default) and a dictionary
+Returns the compressed data
+"""
+def compress(data, codec="zlib", level=None, dictionary=b""):
+	_check_codec(codec)
+	if codec == "zstd":
+		compressor = zstandard.ZstdCompressor(level=3 if level is None else level, dict_data=_zstd_dictionary(dictionary))
+		return compressor.compress(data)
+	if level is None:
+		level = zlib.Z_DEFAULT_COMPRESSION
+	compressor = zlib.compressobj(level, zdict=dictionary) if dictionary else zlib.compressobj(level)
+	return compressor.compress(data) + compressor.flush()
+
+
+"""
+Receives a codec and the dictionary the data was compressed with
+Returns an object whose decompress(data) method takes the compressed data in pieces
+of any size and returns the decompressed bytes available so far
+"""
+def decompressor(codec="zlib", dictionary=b""):
+	_check_codec(codec)
+	if codec == "zstd":
+		return zstandard.ZstdDecompressor(dict_data=_zstd_dictionary(dictionary)).decompressobj()
+	return zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+
+
+def _zstd_dictionary(dictionary):
+	if not dictionary:
+		return None
+	return zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+"""
+Receives the start of a range and its compressed data
+Returns the frame with both
+"""
+def encode_frame(start, data):
+	return FRAME_HEADER.pack(start, len(data)) + data
+
+
+"""
+Receives the FRAME_HEADER.size bytes that start a frame
+Returns the start of its range and the size of its compressed data
+Raises a ValueError if the header is incomplete
+"""
+def decode_frame_header(data):
+	if len(data) != FRAME_HEADER.size:
+		raise ValueError("Truncated frame header")
+	return FRAME_HEADER.unpack(data)
+
@@ -0,0 +1,104 @@
+"""
+=== TUNING ===
+Picks the blocksize of a signature and how much of each hash to keep, instead of
+tuning them by hand for every kind of file. Larger blocks make the signature and
+the scan cheaper, and smaller ones fetch less around every edit
+	- The blocksize is the square root of the file size, like rsync does, which
+	  balances both costs when the number of edits grows with the file
+	- Given the signature of the previous version of the file, the edits are counted
+	  on samples of the new one, and the blocksize is the one that balances both
+	  costs for that many edits
+	- The weak and strong hashes are truncated to the fewest bytes that keep false
+	  matches unlikely for that many blocks, like zsync does
+"""
+import math
+
+import common
+
+# Like rsync's BLOCK_SIZE and MAX_BLOCK_SIZE
+_MIN_BLOCKSIZE = 700
+_MAX_BLOCKSIZE = 128 * 1024
+_DEFAULT_SAMPLES = 64
+
+
+def _clamp(blocksize):
+	return min(_MAX_BLOCKSIZE, max(_MIN_BLOCKSIZE, blocksize // 8 * 8))
+
+
+"""
+Receives the size of a file
+Returns the blocksize for it: its square root in multiples of 8, between 700 bytes and 128KiB
+"""
+def auto_blocksize(length):
+	return _clamp(math.isqrt(length))
+
+
+"""
+Receives the size of a file, its blocksize and the "seq_matches" of its signature
+Returns how many bytes to keep of each (weak, strong) hash, as zsync's make.c works
+them out. Every extra block, and every extra byte of the file to scan, makes a false
+match more likely, while with seq_matches=2 two consecutive blocks have to match, so
+each hash can be shorter. The strong hash never drops below zsync's floor, which
+keeps a single block (with 7.9 bits of margin) apart even with seq_matches
+"""
+def checksum_bytes(length, blocksize, seq_matches=1):
+	length = max(length, 1)
+	blocks = 1 + length // blocksize
+	weak = math.ceil((math.log2(length) + math.log2(blocksize) - 8.6) / seq_matches / 8)
+	strong = math.ceil((20 + math.log2(length) + math.log2(blocks)) / seq_matches / 8)
+	strong = max(strong, int((7.9 + 20 + math.log2(blocks)) / 8))
+	return min(4, max(2, weak)), min(16, max(2, strong))
+
+
+"""
+Receives a signature.SignatureTable made with blocksize="auto"
+Records on it the checksum_bytes that write_signature keeps by default
+"""
+def tune_table(table):
+	weak, strong = checksum_bytes(table.length or 0, table.blocksize, table.seq_matches)
+	table.record_bytes = (min(weak, table.weak_bytes), min(strong, table.digest_size))
+
+
+"""
+Receives the size of a file, the size of the windows to sample and how many of them
+Returns the offsets of the windows, spread evenly over the file
+"""
+def sample_offsets(length, window, samples=_DEFAULT_SAMPLES):
+	if length <= window:
+		return [0]
+	last = length - window
+	count = min(samples, last // window + 1)
+	return sorted({last * i // max(1, count - 1) for i in range(count)})
+
+
+"""
+Receives the signature.SignatureTable of the previous version of a file and windows
+of the new one, each twice as long as its blocksize
+Returns the fraction of the windows where no block of the previous version was found,
+wherever it moved inside them
+"""
+def unmatched_fraction(previous, windows):
+	table = previous.copy()
+	table.reset()
+	strong = common.strong_hash(table.algorithm)
+	unmatched = 0
+	for window in windows:
+		matches = []
+		common.scan_buffer(window, 0, None, table, matches, table.blocksize, strong=strong)
+		if not matches:
+			unmatched += 1
+	return unmatched / len(windows) if windows else 0.0
+
+
+"""
+Receives the size of a file, the blocksize of its previous version, the fraction of
+its blocks that were edited (see unmatched_fraction) and the bytes each block takes
+in the signature
+Returns the blocksize that balances the signature against the data fetched around
+the edits: the signature costs length / blocksize * record_bytes, and each of the
+unmatched * length / previous_blocksize edits costs about a block
+"""
+def refine_blocksize(length, previous_blocksize, unmatched, record_bytes):
+	if not unmatched:
+		return _clamp(length)
+	return _clamp(int(math.sqrt(record_bytes * previous_blocksize / unmatched)))
@@ -0,0 +1,135 @@
+import functools
+
+import common
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Number of windows checksummed at once, which keeps the prefix sums well
+# inside int64 and the temporary arrays at a few dozen MB
+_BATCH = 1 << 20
+
+
+"""
+Receives a bytes-like "buffer", the first and last+1 window positions and a blocksize
+Returns a numpy array with the Adler-32 checksum of buffer[i:i+blocksize] for
+every position "start <= i < stop", computed in bulk from cumulative sums
+"""
+def rolling_checksums(buffer, start, stop, blocksize):
+	count = stop - start
+	data = numpy.frombuffer(buffer, dtype=numpy.uint8, count=count + blocksize - 1, offset=start)
+	# Prefix sums of the bytes and of the bytes weighted by their index
+	sums = numpy.zeros(len(data) + 1, dtype=numpy.int64)
+	numpy.cumsum(data, out=sums[1:])
+	weighted = numpy.zeros(len(data) + 1, dtype=numpy.int64)
+	numpy.cumsum(numpy.arange(len(data), dtype=numpy.int64) * data, out=weighted[1:])
+
+	total = sums[blocksize:] - sums[:count]
+	a = (total + 1) % common._PRIME_MOD
+	# b is the sum of every partial "a", so each byte counts once for every
+	# position from its own to the end of the window
+	total %= common._PRIME_MOD
+	total *= numpy.arange(blocksize, blocksize + count, dtype=numpy.int64)
+	total -= weighted[blocksize:]
+	total += weighted[:count] + blocksize
+	total %= common._PRIME_MOD
+	total <<= 16
+	total |= a
+	return total
+
+
+"""
+Receives the remote hashes
+Returns a sorted numpy array with their weak hashes, a boolean filter indexed
+by _bucket(weak), so that most windows are discarded with a single lookup
+instead of a binary search, and the shift that truncates a weak hash like the keys
+"""
+def weak_keys(hashes):
+	if isinstance(hashes, dict):
+		keys = numpy.fromiter(hashes, dtype=numpy.int64, count=len(hashes))
+		keys.sort()
+		shift = 0
+	else:
+		# A SignatureTable already keeps its weak hashes sorted, but they may
+		# be truncated to their most significant bytes
+		keys = numpy.frombuffer(hashes.weaks, dtype=numpy.uintc).astype(numpy.int64)
+		shift = 8 * (4 - hashes.weak_bytes)
+	bits = min(max(len(keys).bit_length() + 3, 16), 24)
+	table = numpy.zeros(1 << bits, dtype=bool)
+	table[_bucket(keys, bits)] = True
+	return keys, table, shift
+
+
+def _bucket(weaks, bits):
+	# Multiplicative hashing so that both halves of the checksum are mixed in
+	return ((weaks * 2654435761) & 0xffffffff) >> (32 - bits)
+
+
+"""
+Same contract as common.scan_buffer
+Calculates the weak hash of every full window in the buffer at once, finds the
+candidates present in "keys" (see weak_keys) with the filter and a sorted
+search and only falls back to common.check_block for those. The shrinking tail of the file is
+left to common.scan_buffer
+"""
+def scan_buffer(buffer, position, checksum, hashes, local_instructions, blocksize, offset=0, eof=False, strong=common.stronghash, sequence=None, keys=None):
+	if keys is None:
+		keys = weak_keys(hashes)
+	keys, table, shift = keys
+	bits = table.size.bit_length() - 1
+	view = memoryview(buffer)
+	# The sequence filter also needs the window after the last one
+	last = len(buffer) - (2 * blocksize if sequence and not eof else blocksize)
+	rolled = None
+	if not len(keys):
+		# Nothing left that could match
+		return (len(buffer) if eof else max(position, last + 1)), None
+
+	while position <= last:
+		stop = min(last + 1, position + _BATCH)
+		weaks = rolling_checksums(buffer, position, stop, blocksize)
+		truncated = weaks >> shift if shift else weaks
+		candidates = numpy.flatnonzero(table[_bucket(truncated, bits)])
+		found = numpy.minimum(numpy.searchsorted(keys, truncated[candidates]), len(keys) - 1)
+		candidates = candidates[keys[found] == truncated[candidates]]
+
+		resume = position
+		for index in candidates.tolist():
+			local_offset = position + index
+			if local_offset < resume:
+				# Inside a block that was just matched
+				continue
+			weak = int(weaks[index])
+			if weak in hashes and (sequence is None or sequence(weak, view[local_offset + blocksize:local_offset + 2 * blocksize])) and common.check_block(view[local_offset:local_offset + blocksize], weak, hashes, local_instructions, offset + local_offset, strong):
+				resume = local_offset + blocksize
+
+		checksum = None
+		if resume < stop:
+			# The last window of the batch was checked and didn't match
+			rolled = int(weaks[-1])
+			position = stop
+		else:
+			rolled = None
+			position = resume
+
+	if rolled is not None:
+		# Resume from the last full window with its checksum, like common.scan_buffer
+		# does, so that it keeps rolling into the tail of the file. A fresh checksum
+		# of a shorter window could match a short last block the python engine can't
+		position, checksum = position - 1, rolled
+	if not eof:
+		return position, checksum
+	return common.scan_buffer(buffer, position, checksum, hashes, local_instructions, blocksize, offset, eof, strong, sequence)
+
+
+"""
+Receives the remote hashes, the strong hash function and the sequence filter
+Returns a function with the same signature as common.scan_buffer that uses the
+vectorized engine, with the weak hash table sorted only once
+"""
+def scanner(hashes, strong=common.stronghash, sequence=None):
+	if numpy is None:
+		raise ImportError("The numpy engine requires numpy to be installed")
+	return functools.partial(scan_buffer, strong=strong, sequence=sequence, keys=weak_keys(hashes))